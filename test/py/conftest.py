@@ -43,20 +43,39 @@ def host(request):
     return request.config.getoption("--host")
 
 
-@pytest.fixture()
-def pgdb(request):
-    "set up test fixtures"
-    from versa.driver import postgres
+@pytest.fixture
+def pgconnstr(request):
     user = request.config.getoption("--user")
     passwd = request.config.getoption("--pass")
     host = request.config.getoption("--host")
-    conn = postgres.connection("host={0} dbname=versa_test user={1} password={2}".format(host, user, passwd))
+    return "host={0} dbname=versa_test user={1} password={2}".format(host, user, passwd)
+
+
+@pytest.fixture()
+def pgdb(request, pgconnstr):
+    "set up test fixtures"
+    from versa.driver import postgres
+    conn = postgres.connection(pgconnstr)
     conn.create_space()
     def teardown():
         "tear down test fixture"
-        #conn.drop_space()
+        conn.drop_space()
         conn.close()
         return
     request.addfinalizer(teardown)
     return conn
 
+
+@pytest.fixture()
+def pgdb_jsonb(request, pgconnstr):
+    "set up test fixtures, with the JSONB attributes schema variant"
+    from versa.driver import postgres
+    conn = postgres.connection(pgconnstr, jsonb=True)
+    conn.create_space()
+    def teardown():
+        "tear down test fixture"
+        conn.drop_space()
+        conn.close()
+        return
+    request.addfinalizer(teardown)
+    return conn
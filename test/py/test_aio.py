@@ -0,0 +1,68 @@
+# test_aio.py (use py.test)
+'''
+
+Note: to see stdout, stderr & logging regardless of outcome:
+
+py.test -s test/py/test_aio.py
+
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from versa.driver import memory, sqlite
+from versa.driver.aio import executor_connection
+
+
+def test_executor_memory():
+    async def run():
+        async with executor_connection(memory.connection(), chunk_size=2) as model:
+            await model.add_many(iter(RELS_1))
+            await model.add('http://example.org/spam', 'http://example.org/vocab/n', 'eggs')
+            assert await model.size() == len(RELS_1) + 1
+
+            results = [ link async for link in model.match(origin='http://uche.ogbuji.net') ]
+            assert results == RELS_1[2:]
+            results = [ link async for link in model.match(origin='http://uche.ogbuji.net', attrs={'@lang': 'ig'}, include_ids=True) ]
+            assert results == [(4, RELS_1[4])]
+            assert [ item async for item in model ] == list(model.model)
+
+            # Concurrent lookups
+            async def lookup(origin):
+                return [ link async for link in model.match(origin=origin) ]
+            results = await asyncio.gather(*[ lookup(o) for o in ['http://copia.ogbuji.net', 'http://uche.ogbuji.net'] * 5 ])
+            assert [ len(r) for r in results ] == [2, 3] * 5
+
+    asyncio.run(run())
+
+
+def test_executor_sqlite():
+    # SQLite connections are tied to a thread, so create it in the executor's one thread
+    executor = ThreadPoolExecutor(max_workers=1)
+    model = executor.submit(sqlite.newmodel).result()
+
+    async def run():
+        amodel = executor_connection(model, executor=executor)
+        rawids = await amodel.add_many(RELS_1)
+        assert [ item async for item in amodel ] == list(zip(rawids, RELS_1))
+        # Abandoned part way
+        async for link in amodel.match(rel='http://purl.org/dc/elements/1.1/title'):
+            break
+        assert await amodel.size() == len(RELS_1)
+        await amodel.close()
+
+    asyncio.run(run())
+    executor.submit(model.close).result()
+    executor.shutdown()
+
+
+RELS_1 = [
+    ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://copia.ogbuji.net#_metadata"}),
+    ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Copia", {"@context": "http://copia.ogbuji.net#_metadata", '@lang': 'en'}),
+    ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://uche.ogbuji.net#_metadata"}),
+    ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Uche's home", {"@context": "http://uche.ogbuji.net#_metadata", '@lang': 'en'}),
+    ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Ulo Uche", {"@context": "http://uche.ogbuji.net#_metadata", '@lang': 'ig'}),
+]
+
+if __name__ == '__main__':
+    raise SystemExit("use py.test")
@@ -0,0 +1,144 @@
+# test_columnar.py (use py.test)
+'''
+
+Note: to see stdout, stderr & logging regardless of outcome:
+
+py.test -s test/py/test_columnar.py
+
+'''
+
+from collections import OrderedDict
+
+import pytest
+
+from versa import I
+from versa.driver import columnar, memory
+
+
+def test_basics():
+    model = columnar.connection()
+    for (subj, pred, obj, attrs) in RELS_1:
+        model.add(subj, pred, obj, attrs)
+    assert model.size() == 5
+
+    results = list(model.match(origin='http://copia.ogbuji.net'))
+    assert len(results) == 2
+
+    results = tuple(model.match(origin='http://uche.ogbuji.net', attrs={u'@lang': u'ig'}))
+    expected = (('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Ulo Uche', {'@context': 'http://uche.ogbuji.net#_metadata', '@lang': 'ig'}),)
+    assert results == expected, (results, expected)
+
+    # Does it behave properly on non-matches?
+    assert list(model.match(origin='SPAM')) == []
+    assert list(model.match(rel='SPAM')) == []
+    assert list(model.match(target='SPAM')) == []
+    assert list(model.match(attrs={'SPAM': 'EGGS'})) == []
+
+
+def test_same_as_memory():
+    cmodel = columnar.connection()
+    mmodel = memory.connection()
+    for model in (cmodel, mmodel):
+        for (subj, pred, obj, attrs) in RELS_1:
+            model.add(subj, pred, obj, attrs)
+        model.add('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/creator', I('http://uche.ogbuji.net/about'))
+        # Dupe
+        model.add('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Copia', {'@lang': 'en', '@context': 'http://copia.ogbuji.net#_metadata'})
+    assert cmodel == mmodel
+    assert list(cmodel) == list(mmodel)
+
+    for origin, rel, target in [
+            ('http://uche.ogbuji.net', None, None),
+            (None, 'http://purl.org/dc/elements/1.1/title', None),
+            (None, None, 'Uche Ogbuji'),
+            (None, None, 'http://uche.ogbuji.net/about'),
+            ('http://copia.ogbuji.net', None, 'Uche Ogbuji')]:
+        assert list(cmodel.match(origin, rel, target, include_ids=True)) == list(mmodel.match(origin, rel, target, include_ids=True))
+
+    # IRI targets come back as IRIs
+    results = list(cmodel.match(target='http://uche.ogbuji.net/about'))
+    assert isinstance(results[0][2], I)
+
+
+def test_dupes():
+    # Dupes are equal links, as with the memory driver, even with different classes of value
+    cmodel = columnar.connection()
+    mmodel = memory.connection()
+    for model in (cmodel, mmodel):
+        model.add('a', 'r', 'x')
+        model.add('a', 'r', I('x'))
+        model.add(I('a'), 'r', 'x', {})
+        model.add('a', 'r', 'x', {'k': {'a': 1, 'b': 2}})
+        model.add('a', 'r', 'x', {'k': {'b': 2, 'a': 1}})
+        model.add('a', 'r', [1, 2])
+        model.add('a', 'r', (1, 2))
+    assert cmodel.size() == mmodel.size() == 4
+    assert list(cmodel) == list(mmodel)
+
+    # Rejected or failed adds leave the term dictionary & attribute mappings as they were
+    terms, attrsets = len(cmodel._terms), len(cmodel._attrsets)
+    cmodel.add('a', 'r', 'x', {'k': {'b': 2, 'a': 1}})
+    with pytest.raises(TypeError):
+        cmodel.add('b', 'r', bytearray(b'x'))
+    assert (len(cmodel._terms), len(cmodel._attrsets)) == (terms, attrsets)
+
+    # Ordered attributes are equal only in the same order
+    cmodel = columnar.connection(attr_cls=OrderedDict)
+    mmodel = memory.connection(attr_cls=OrderedDict)
+    for model in (cmodel, mmodel):
+        model.add('a', 'r', 'x', OrderedDict([('a', '1'), ('b', '2')]))
+        model.add('a', 'r', 'x', OrderedDict([('b', '2'), ('a', '1')]))
+    assert cmodel.size() == mmodel.size() == 2
+
+
+def test_shared_attrs():
+    model = columnar.connection()
+    model.add('s1', 'p0', 'lit0', {'a': '1'})
+    model.add('s2', 'p0', 'lit0', {'a': '1'})
+    model.add('s3', 'p0', 'lit0')
+    assert len(model._attrsets) == 2
+
+    # Results are copies, so changes don't leak into the shared mapping
+    results = list(model.match('s1'))
+    results[0][3]['a'] = '2'
+    assert list(model.match('s2'))[0][3] == {'a': '1'}
+
+
+def test_ordering_removal():
+    model = columnar.connection()
+    model.add('s1','p1','lit1',{})
+    model.add('s1','p2','lit2',{})
+    model.add('s1','p0','lit0',{},index=1)
+    model.add('s2','p3','lit3',{})
+    assert [ link[1] for ix, link in model ] == ['p1', 'p0', 'p2', 'p3']
+
+    model.remove([3,0])
+    assert [ link[2] for ix, link in model ] == ['lit0', 'lit2']
+    # IDs are stable until compacted
+    assert model[2][2] == 'lit2'
+    assert list(model.match(rel='p2', include_ids=True)) == [(2, ('s1', 'p2', 'lit2', {}))]
+    assert model.size() == 2
+    # Once removed, the same link can be added again
+    model.add('s2','p3','lit3',{})
+    assert model.size() == 3
+    model.remove(4)
+
+    model.compact()
+    assert model[1][2] == 'lit2'
+    assert list(model.match(rel='p2', include_ids=True)) == [(1, ('s1', 'p2', 'lit2', {}))]
+
+    model2 = model.copy()
+    assert model == model2
+    assert model.copy(contents=False).size() == 0
+
+
+RELS_1 = [
+    ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://copia.ogbuji.net#_metadata"}),
+    ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Copia", {"@context": "http://copia.ogbuji.net#_metadata", '@lang': 'en'}),
+    ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://uche.ogbuji.net#_metadata"}),
+    ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Uche's home", {"@context": "http://uche.ogbuji.net#_metadata", '@lang': 'en'}),
+    ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Ulo Uche", {"@context": "http://uche.ogbuji.net#_metadata", '@lang': 'ig'}),
+]
+
+if __name__ == '__main__':
+    raise SystemExit("use py.test")
@@ -13,7 +13,7 @@ import pytest
 diskcache = pytest.importorskip("diskcache")
 #from testconfig import config
 
-from versa.driver.diskcache import newmodel
+from versa.driver.diskcache import newmodel, connection
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
 
@@ -134,5 +134,76 @@ def test_handling_braces(tmp_path, rels_2):
     assert len(results) == 1
 
 
+def test_shared_abbreviations(tmp_path, rels_1):
+    model1 = newmodel(dbdir=str(tmp_path))
+    model2 = connection(dbdir=str(tmp_path))
+    model1.add(*rels_1[0])
+    # model2's cached abbreviations are now out of date, so it must reload them before adding
+    model2.add("http://uche.ogbuji.net", "http://example.org/vocab/homepage", "http://uche.ogbuji.net/")
+    model1.add(*rels_1[1])
+
+    for model in (model1, model2):
+        results = list(model.match(rel="http://example.org/vocab/homepage"))
+        assert [ r[TARGET] for r in results ] == ['http://uche.ogbuji.net/']
+        results = list(model.match(rel="http://purl.org/dc/elements/1.1/title"))
+        assert [ r[TARGET] for r in results ] == ['Copia']
+        assert model.size() == 3
+
+
+def test_migrate_legacy(tmp_path):
+    # Store in the old format, with str.format style abbreviations
+    from diskcache import Index
+    db = Index(str(tmp_path))
+    db['@_abbreviations'] = {'a0': 'http://purl.org/dc/elements/1.1/'}
+    db['http://copia.ogbuji.net'] = {'{a0}title': [('Copia', {'@lang': 'en'})], '{a0}creator': [('Uche Ogbuji', {})]}
+    del db
+
+    model = connection(dbdir=str(tmp_path))
+    results = list(model.match(origin='http://copia.ogbuji.net', rel='http://purl.org/dc/elements/1.1/title'))
+    assert results == [('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Copia', {'@lang': 'en'})]
+    assert model.size() == 2
+
+    # Literals which look like old style abbreviations are no longer mangled
+    model.add('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', '{a0}')
+    results = list(model.match(target='{a0}'))
+    assert [ r[TARGET] for r in results ] == ['{a0}']
+    assert [ link[RELATIONSHIP] for ix, link in model ] == ['http://purl.org/dc/elements/1.1/title'] * 2 + ['http://purl.org/dc/elements/1.1/creator']
+
+
+def test_counts(tmp_path, rels_1):
+    model = newmodel(dbdir=str(tmp_path))
+    assert model.size() == len(model) == model.origin_count() == 0
+    assert model.rel_counts() == {}
+    for link in rels_1:
+        model.add(*link)
+    model.add("http://example.org/spam", "http://example.org/vocab/homepage", "http://example.org/")
+    assert model.size() == len(model) == 6
+    assert model.origin_count() == 3
+    assert model.rel_counts() == {
+        'http://purl.org/dc/elements/1.1/creator': 2,
+        'http://purl.org/dc/elements/1.1/title': 3,
+        'http://example.org/vocab/homepage': 1,
+    }
+
+    # Counts persist, and are rebuilt if missing
+    model2 = connection(dbdir=str(tmp_path))
+    assert model2.size() == 6
+    del model2._db['@_counts']
+    model2 = connection(dbdir=str(tmp_path))
+    assert model2.size() == 6
+    assert model2.rel_counts() == model.rel_counts()
+
+
+def test_list_targets(tmp_path):
+    # Tuples & lists with the same items are stored & matched the same way
+    model = newmodel(dbdir=str(tmp_path))
+    model.add('http://example.org/spam', 'http://example.org/vocab/pair', ('a', 'b'))
+    model.add('http://example.org/eggs', 'http://example.org/vocab/pair', ['c', 'd'])
+    for target in (('a', 'b'), ['a', 'b']):
+        assert list(model.match(target=target)) == [('http://example.org/spam', 'http://example.org/vocab/pair', ['a', 'b'], {})]
+        assert list(model.match('http://example.org/spam', 'http://example.org/vocab/pair', target)) == [('http://example.org/spam', 'http://example.org/vocab/pair', ['a', 'b'], {})]
+    assert len(list(model.match(target=('c', 'd')))) == 1
+
+
 if __name__ == '__main__':
     raise SystemExit("use pytest command line")
@@ -14,7 +14,7 @@ docutils = pytest.importorskip("lmdb")
 
 #from testconfig import config
 
-from versa.driver.lmdb import newmodel
+from versa.driver.lmdb import newmodel, connection
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
 ##If you do this you also need --nologcapture
@@ -134,5 +134,187 @@ def test_handling_braces(tmp_path, rels_2):
     assert len(results) == 1
 
 
+def test_add_many(tmp_path, rels_1):
+    model = newmodel(dbname=str(tmp_path))
+    # Small batches, so some origins are merged across transactions
+    model.add_many(rels_1, batch_size=2)
+    assert model.size() == 5
+    model.add_many([
+        ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/subject", "Blogs"),
+        ("http://zz.example.org", "http://purl.org/dc/elements/1.1/title", "Last"),
+        ("http://aa.example.org", "http://purl.org/dc/elements/1.1/title", "First"),
+    ])
+    assert model.size() == 8
+
+    results = list(model.match(origin='http://copia.ogbuji.net'))
+    assert [ r[TARGET] for r in results ] == ['Uche Ogbuji', 'Copia', 'Blogs']
+
+    results = list(model.match(origin='http://uche.ogbuji.net', rel='http://purl.org/dc/elements/1.1/title'))
+    assert [ r[TARGET] for r in results ] == ["Uche's home", 'Ulo Uche']
+    assert results[1][ATTRIBUTES] == {"@context": "http://uche.ogbuji.net#_metadata", '@lang': 'ig'}
+
+    assert len(list(model.match(origin='http://aa.example.org'))) == 1
+    assert len(list(model.match(origin='http://zz.example.org'))) == 1
+
+    with pytest.raises(ValueError):
+        model.add_many([("http://copia.ogbuji.net", None, "Oops")])
+
+
+def test_abbreviations_persist(tmp_path, rels_1):
+    model = newmodel(dbname=str(tmp_path))
+    model.add_many(rels_1)
+    model.close()
+
+    # Reopening an existing DB mustn't lose the abbreviations
+    model = connection(dbname=str(tmp_path))
+    results = list(model.match(origin='http://copia.ogbuji.net', rel='http://purl.org/dc/elements/1.1/title'))
+    assert [ r[TARGET] for r in results ] == ['Copia']
+    model.add("http://uche.ogbuji.net", "http://example.org/vocab/homepage", "http://uche.ogbuji.net/")
+    results = list(model.match(rel="http://example.org/vocab/homepage"))
+    assert [ r[TARGET] for r in results ] == ['http://uche.ogbuji.net/']
+
+    # Clearing does just that
+    model.close()
+    model = newmodel(dbname=str(tmp_path))
+    assert model.size() == 0
+
+
+def test_indexed(tmp_path, rels_1):
+    model = newmodel(dbname=str(tmp_path), indexed=True)
+    model.add_many(rels_1)
+    model.add("http://uche.ogbuji.net", "http://example.org/vocab/homepage", "http://uche.ogbuji.net/")
+
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/creator'))
+    assert sorted(r[ORIGIN] for r in results) == ['http://copia.ogbuji.net', 'http://uche.ogbuji.net']
+    results = list(model.match(target='Uche Ogbuji', rel='http://purl.org/dc/elements/1.1/creator'))
+    assert len(results) == 2
+    results = list(model.match(target='http://uche.ogbuji.net/'))
+    assert results == [("http://uche.ogbuji.net", "http://example.org/vocab/homepage", "http://uche.ogbuji.net/", {})]
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/title', attrs={'@lang': 'ig'}))
+    assert [ r[TARGET] for r in results ] == ['Ulo Uche']
+    assert list(model.match(rel='SPAM')) == []
+    assert list(model.match(target='http://example.org/SPAM')) == []
+
+    # IDs are assigned as links are added, the same whether or not the indexes are used
+    extent = dict(model)
+    assert sorted(extent) == list(range(6))
+    for kwargs in ({'rel': 'http://purl.org/dc/elements/1.1/title'}, {'target': 'Uche Ogbuji'},
+                    {'origin': 'http://uche.ogbuji.net'},
+                    {'origin': 'http://uche.ogbuji.net', 'rel': 'http://purl.org/dc/elements/1.1/title'}):
+        results = list(model.match(include_ids=True, **kwargs))
+        assert results
+        assert all(extent[ix] == link for ix, link in results)
+
+    # Nor do they change as other links are added, even under origins which sort first
+    model.add("http://aaa.example.org", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji")
+    assert [ (ix, link) for ix, link in model if ix < 6 ] == list(extent.items())
+    assert [ ix for ix, link in model.match(target='Uche Ogbuji', include_ids=True) ] == [6] + \
+        [ ix for ix, link in extent.items() if link[TARGET] == 'Uche Ogbuji' ]
+
+    # Clearing also clears the indexes
+    model.close()
+    model = newmodel(dbname=str(tmp_path))
+    assert model.size() == 0
+    assert list(model.match(target='Uche Ogbuji')) == []
+
+
+def test_index_existing(tmp_path, rels_1):
+    model = newmodel(dbname=str(tmp_path))
+    model.add_many(rels_1)
+    expected = list(model.match(target='Uche Ogbuji'))
+    model.close()
+
+    # Indexes are built for data already there, then maintained from then on
+    model = connection(dbname=str(tmp_path), indexed=True)
+    assert list(model.match(target='Uche Ogbuji')) == expected
+    model.close()
+    model = connection(dbname=str(tmp_path))
+    model.add("http://example.org/spam", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji")
+    results = list(model.match(target='Uche Ogbuji'))
+    assert len(results) == 3
+
+
+def test_migrate_legacy(tmp_path):
+    # Store in the old format, with str.format style abbreviations
+    import lmdb, msgpack
+    env = lmdb.open(str(tmp_path))
+    with env.begin(write=True) as txn:
+        txn.put(b'@_abbreviations', msgpack.dumps({'a0': 'http://purl.org/dc/elements/1.1/'}))
+        txn.put(b'http://copia.ogbuji.net', msgpack.dumps({'{a0}title': [['Copia', {'@lang': 'en'}]], '{a0}creator': [['Uche Ogbuji', {}]]}))
+    env.close()
+
+    model = connection(dbname=str(tmp_path), indexed=True)
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/title'))
+    assert results == [('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Copia', {'@lang': 'en'})]
+    assert model.size() == 2
+
+    # Literals which look like old style abbreviations are no longer mangled
+    model.add('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', '{a0}')
+    results = list(model.match(target='{a0}'))
+    assert [ r[TARGET] for r in results ] == ['{a0}']
+    assert [ link[TARGET] for ix, link in model ] == ['Copia', '{a0}', 'Uche Ogbuji']
+    # Links from before IDs were stored get them by position
+    assert [ ix for ix, link in model ] == [0, 2, 1]
+
+
+def test_counts(tmp_path, rels_1):
+    model = newmodel(dbname=str(tmp_path))
+    assert model.size() == len(model) == model.origin_count() == 0
+    assert model.rel_counts() == {}
+    for link in rels_1:
+        model.add(*link)
+    model.add("http://example.org/spam", "http://example.org/vocab/homepage", "http://example.org/")
+    assert model.size() == len(model) == 6
+    assert model.origin_count() == 3
+    assert model.rel_counts() == {
+        'http://purl.org/dc/elements/1.1/creator': 2,
+        'http://purl.org/dc/elements/1.1/title': 3,
+        'http://example.org/vocab/homepage': 1,
+    }
+
+    # Counts persist, and are rebuilt if missing
+    rel_counts = model.rel_counts()
+    model.close()
+    model = connection(dbname=str(tmp_path))
+    assert model.size() == 6
+    with model._db_env.begin(write=True) as txn:
+        txn.delete(b'@_counts')
+    model.close()
+    model = connection(dbname=str(tmp_path))
+    assert model.size() == 6
+    assert model.rel_counts() == rel_counts
+
+
+def test_match_many(tmp_path, rels_1):
+    model = newmodel(dbname=str(tmp_path / 'test.lmdb'))
+    model.add_many(rels_1)
+    patterns = [
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Copia'),
+        ('http://example.org/spam', 'http://purl.org/dc/elements/1.1/title'),
+        (None, 'http://purl.org/dc/elements/1.1/creator', None),
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net',),
+    ]
+    results = model.match_many(patterns)
+    assert results == [ list(model.match(*p)) for p in patterns ]
+    assert [ len(r) for r in results ] == [2, 1, 0, 2, 2, 2]
+    assert model.match_many([(None, 'http://example.org/spam')]) == [[]]
+    # IDs are stored with the links, so the same with or without the indexes
+    assert [ ix for ix, link in model.match(rel='http://purl.org/dc/elements/1.1/title', include_ids=True) ] == \
+        [ ix for ix, link in model if link[1] == 'http://purl.org/dc/elements/1.1/title' ]
+
+
+def test_list_targets(tmp_path):
+    # Tuples & lists with the same items are stored & matched the same way
+    model = newmodel(dbname=str(tmp_path / 'test.lmdb'))
+    model.add('http://example.org/spam', 'http://example.org/vocab/pair', ('a', 'b'))
+    model.add('http://example.org/eggs', 'http://example.org/vocab/pair', ['c', 'd'])
+    for target in (('a', 'b'), ['a', 'b']):
+        assert list(model.match(target=target)) == [('http://example.org/spam', 'http://example.org/vocab/pair', ['a', 'b'], {})]
+        assert list(model.match('http://example.org/spam', 'http://example.org/vocab/pair', target)) == [('http://example.org/spam', 'http://example.org/vocab/pair', ['a', 'b'], {})]
+    assert len(list(model.match(target=('c', 'd')))) == 1
+
+
 if __name__ == '__main__':
     raise SystemExit("use pytest command line")
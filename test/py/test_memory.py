@@ -7,9 +7,13 @@ py.test test/py/test_memory.py --tc=debug:y --nologcapture
 '''
 
 import logging
+from collections import OrderedDict
+
+import pytest
 
 #from testconfig import config
 
+from versa import util
 from versa.driver import memory
 
 #If you do this you also need --nologcapture
@@ -64,10 +68,55 @@ def test_removal():
     assert list(model)[1][1][2] == 'lit2'
     assert model.size() == 2
 
-    model.remove(0)
+    # IDs of the remaining links are stable
+    assert list(model)[0][0] == 1
+    assert list(model.match(rel='p2', include_ids=True))[0][0] == 2
+    assert list(model.match('s2')) == []
+    with pytest.raises(IndexError):
+        model[0]
+
+    model.remove(1)
     assert list(model)[0][1][2] == 'lit2'
     assert model.size() == 1
 
+    # Removing something already removed is harmless
+    model.remove(1)
+    assert model.size() == 1
+
+
+def test_compact():
+    model = memory.connection()
+    model.add('s1','p0','lit0',{})
+    model.add('s1','p1','lit1',{})
+    model.add('s1','p2','lit2',{'a': '1'})
+    model.add('s2','p3','lit3',{'a': '1'})
+    assert model.remove_matching(attrs={'a': '1'}) == 2
+    assert model.remove_matching('s1', 'p0') == 1
+    assert model.size() == 1
+    assert list(model.match('s1', include_ids=True)) == [(1, ('s1', 'p1', 'lit1', {}))]
+
+    model.compact()
+    assert model.size() == 1
+    assert list(model.match('s1', include_ids=True)) == [(0, ('s1', 'p1', 'lit1', {}))]
+    assert list(model.match(rel='p2')) == []
+    assert model[0][1] == 'p1'
+
+    # Removed links can be added back
+    model.add('s2','p3','lit3',{'a': '1'})
+    assert list(model.match(attrs={'a': '1'}, include_ids=True)) == [(1, ('s2', 'p3', 'lit3', {'a': '1'}))]
+
+
+def test_replace_entity_resource():
+    model = memory.connection()
+    model.add('s1','p0','s2',{})
+    model.add('s2','p1','lit1',{'a': 's2'})
+    model.add('s3','p2','lit2',{})
+    util.replace_entity_resource(model, 's2', 's4')
+    assert model.size() == 3
+    assert list(model.match('s1')) == [('s1', 'p0', 's4', {})]
+    assert list(model.match('s4')) == [('s4', 'p1', 'lit1', {'a': 's4'})]
+    assert list(model.match('s2')) == []
+
 def test_index():
     model = memory.connection()
     r1 = model.add('s1','p0','lit0',{})
@@ -91,6 +140,203 @@ def test_copy():
     assert model3.size() == 0
 
 
+def test_copy_on_write():
+    model = memory.connection()
+    model.add_many(RELS_1)
+    model2 = model.copy()
+    # Storage is shared until either changes
+    assert model2._relationships is model._relationships
+
+    model2.add('s1', 'p0', 'lit0')
+    model.remove(0)
+    assert model.size() == len(RELS_1) - 1
+    assert model2.size() == len(RELS_1) + 1
+    assert list(model2.match('s1')) == [('s1', 'p0', 'lit0', {})]
+    assert list(model.match('s1')) == []
+    assert len(list(model2.match('http://copia.ogbuji.net'))) == 2
+
+    model3 = model.copy()
+    model.compact()
+    assert model3[1] == model[0]
+    with pytest.raises(IndexError):
+        model3[0]
+
+
+def test_snapshot():
+    model = memory.connection()
+    model.add_many(RELS_1)
+    snap = model.snapshot()
+    for change in (lambda: snap.add('s1', 'p0', 'lit0'), lambda: snap.remove(0),
+                   lambda: snap.add_many(RELS_1), snap.compact, snap.drop_space):
+        with pytest.raises(TypeError):
+            change()
+    # Later changes to the model don't show up in the snapshot
+    model.add('s1', 'p0', 'lit0')
+    model.remove_matching('http://uche.ogbuji.net')
+    assert snap.size() == len(RELS_1)
+    assert list(snap.match('http://uche.ogbuji.net', attrs={'@lang': 'ig'})) == [RELS_1[4]]
+    assert list(snap.match('s1')) == []
+
+    # Copies of a snapshot can be changed
+    model2 = snap.copy()
+    model2.add('s1', 'p0', 'lit0')
+    assert model2.size() == len(RELS_1) + 1
+    assert snap.size() == len(RELS_1)
+
+def test_indexed_match():
+    model = memory.connection()
+    for (subj, pred, obj, attrs) in RELS_1:
+        model.add(subj, pred, obj, attrs)
+    # Full scan and index lookups should agree, in insertion order
+    for origin, rel, target in [
+            ('http://uche.ogbuji.net', None, None),
+            (None, 'http://purl.org/dc/elements/1.1/title', None),
+            (None, None, 'Uche Ogbuji'),
+            ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', None),
+            ('http://copia.ogbuji.net', None, 'Uche Ogbuji'),
+            ('SPAM', None, None)]:
+        expected = [ (ix, link) for (ix, link) in model
+                        if (origin is None or link[0] == origin)
+                            and (rel is None or link[1] == rel)
+                            and (target is None or link[2] == target) ]
+        assert list(model.match(origin, rel, target, include_ids=True)) == expected
+
+    results = list(model.multimatch(origin={'http://copia.ogbuji.net', 'http://uche.ogbuji.net'}, rel='http://purl.org/dc/elements/1.1/title', include_ids=True))
+    assert [ ix for (ix, link) in results ] == [1, 3, 4]
+
+
+def test_indexed_match_after_shift():
+    model = memory.connection()
+    model.add('s1','p1','lit1',{})
+    model.add('s1','p2','lit2',{})
+    model.add('s1','p0','lit0',{},index=0)
+    assert [ link[2] for link in model.match('s1') ] == ['lit0', 'lit1', 'lit2']
+    assert list(model.match(rel='p1', include_ids=True)) == [(1, ('s1', 'p1', 'lit1', {}))]
+
+    model.remove(0)
+    model.compact()
+    assert list(model.match(rel='p1', include_ids=True)) == [(0, ('s1', 'p1', 'lit1', {}))]
+    assert list(model.match(target='lit0')) == []
+
+def test_dupes():
+    model = memory.connection()
+    model.add('s1','p0','lit0',{'a': '1', 'b': '2'})
+    model.add('s1','p0','lit0',{'b': '2', 'a': '1'})
+    model.add('s1','p0',['lit0', 'lit1'],{'a': ['1']})
+    model.add('s1','p0',['lit0', 'lit1'],{'a': ['1']})
+    assert model.size() == 2
+    model.add('s1','p0','lit0',{'a': '1'})
+    assert model.size() == 3
+
+    # Once removed, the same link can be added again
+    model.remove(0)
+    model.add('s1','p0','lit0',{'a': '1', 'b': '2'})
+    assert model.size() == 3
+
+    model2 = model.copy()
+    model2.update(model)
+    assert model2.size() == 3
+
+    # Dupes are links which are equal (==): lists & tuples differ, nested dict order doesn't matter
+    model = memory.connection()
+    model.add('s1', 'p0', [1, 2])
+    model.add('s1', 'p0', (1, 2))
+    model.add('s1', 'p0', 'lit0', {'k': {'a': 1, 'b': 2}})
+    model.add('s1', 'p0', 'lit0', {'k': {'b': 2, 'a': 1}})
+    model.add('s1', 'p0', 'lit0', {'k': [1, 2]})
+    model.add('s1', 'p0', 'lit0', {'k': (1, 2)})
+    assert model.size() == 5
+    assert len(list(model.match(target=[1, 2]))) == 1
+    assert len(list(model.match(target=(1, 2)))) == 1
+
+    # Ordered attributes are equal only in the same order
+    model = memory.connection(attr_cls=OrderedDict)
+    model.add('s1', 'p0', 'lit0', OrderedDict([('a', '1'), ('b', '2')]))
+    model.add('s1', 'p0', 'lit0', OrderedDict([('b', '2'), ('a', '1')]))
+    model.add('s1', 'p0', 'lit0', OrderedDict([('a', '1'), ('b', '2')]))
+    assert model.size() == 2
+
+    # Targets which can't be hashed are checked for dupes by equality
+    class point:
+        __hash__ = None
+        def __init__(self, x): self.x = x
+        def __eq__(self, other): return isinstance(other, point) and other.x == self.x
+    model = memory.connection()
+    model.add('s1', 'p0', point(1))
+    model.add('s1', 'p0', point(1))
+    model.add('s1', 'p0', point(2))
+    model.add('s1', 'p0', [point(2)])
+    assert model.size() == 3
+    assert [ l[2].x for l in model.match(target=point(2)) ] == [2]
+    model.remove(0)
+    model.add('s1', 'p0', point(1))
+    assert model.size() == 3
+
+def test_zero_copy_attrs():
+    model = memory.connection()
+    model.add('s1','p0','lit0',{'a': '1'})
+
+    # By default results carry private copies of attributes
+    results = list(model.match('s1'))
+    results[0][3]['a'] = '2'
+    assert list(model.match('s1'))[0][3] == {'a': '1'}
+
+    # Zero-copy views are read-only
+    results = list(model.match('s1', copy_attrs=False))
+    assert results[0][3] == {'a': '1'}
+    with pytest.raises(TypeError):
+        results[0][3]['a'] = '2'
+
+    model = memory.connection(copy_attrs=False)
+    model.add('s1','p0','lit0',{'a': '1'})
+    for link in (next(iter(model))[1], model[0], next(model.match('s1'))):
+        with pytest.raises(TypeError):
+            link[3]['a'] = '2'
+    assert next(model.match('s1', copy_attrs=True))[3] == {'a': '1'}
+    # Results can still be fed back into a model
+    model2 = model.copy()
+    model2.update(model)
+    assert model2 == model
+
+
+def test_match_many():
+    model = memory.connection()
+    model.add_many(RELS_1)
+    model.add('http://uche.ogbuji.net', util.VTYPE_REL, 'http://example.org/Person')
+    patterns = [
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Copia'),
+        ('http://example.org/spam', 'http://purl.org/dc/elements/1.1/title'),
+        (None, 'http://purl.org/dc/elements/1.1/creator', None),
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net',),
+    ]
+    results = model.match_many(patterns)
+    assert results == [ list(model.match(*p)) for p in patterns ]
+    assert [ len(r) for r in results ] == [2, 1, 0, 2, 2, 2]
+    assert model.match_many([('http://copia.ogbuji.net', None, 'Copia')], include_ids=True) == [[(1, RELS_1[1])]]
+    assert model.match_many([]) == []
+
+    assert list(util.all_origins(model, of_types={'http://example.org/Person'})) == ['http://uche.ogbuji.net']
+    assert list(util.all_origins(model, of_types='*')) == ['http://uche.ogbuji.net']
+
+
+def test_all_origins_batches(monkeypatch):
+    # Types are looked up in batches, with results from the first before the rest are read
+    monkeypatch.setattr(util, 'ALL_ORIGINS_BATCH_SIZE', 3)
+    model = memory.connection()
+    for i in range(10):
+        model.add('http://example.org/{0}'.format(i), util.VTYPE_REL, 'http://example.org/Type{0}'.format(i % 2))
+    calls = []
+    match_many = model.match_many
+    model.match_many = lambda patterns: calls.append(len(patterns)) or match_many(patterns)
+    origins = util.all_origins(model, of_types={'http://example.org/Type1'})
+    assert next(origins) == 'http://example.org/1'
+    assert calls == [3]
+    assert list(origins) == [ 'http://example.org/{0}'.format(i) for i in (3, 5, 7, 9) ]
+    assert calls == [3, 3, 3, 1]
+
+
 RELS_1 = [
     ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://copia.ogbuji.net#_metadata"}),
     ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Copia", {"@context": "http://copia.ogbuji.net#_metadata", '@lang': 'en'}),
@@ -37,6 +37,23 @@ def mongo_collection():
     return DEMOCOLL
 
 
+@pytest.fixture
+def mock_collection():
+    '''
+    Empty mongomock collection. Skips the test if mongomock isn't installed, or if its
+    bulk write support doesn't work with the installed pymongo (e.g. mongomock 4.3 with
+    pymongo 4.9 or later, which pass a sort option to UpdateOne)
+    '''
+    mongomock = pytest.importorskip("mongomock")
+    coll = mongomock.MongoClient().versademo.model1
+    try:
+        coll.bulk_write([pymongo.UpdateOne({'origin': 'spam'}, {'$set': {'eggs': 1}}, upsert=True)])
+    except TypeError as e:
+        pytest.skip('mongomock bulk writes incompatible with this pymongo: {0}'.format(e))
+    coll.delete_many({})
+    return coll
+
+
 @pytest.fixture
 def rels_1():
     return [
@@ -79,5 +96,140 @@ def test_attribute_basics_1(mongo_collection, rels_1):
     assert len(results) == 1
 
 
+def test_add_many_mock(mock_collection, rels_1):
+    coll = mock_collection
+    model = newmodel(collection=coll)
+    #Small batches, so that some origins span more than one bulk write
+    model.add_many(rels_1, batch_size=2)
+    model.add_many([('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/creator', 'Uche Ogbuji')])
+    assert model.size() == 6
+    assert model.origin_count() == 2
+    assert model.rel_counts() == {'http://purl.org/dc/elements/1.1/creator': 3, 'http://purl.org/dc/elements/1.1/title': 3}
+    assert coll.count_documents({'origin': 'http://uche.ogbuji.net'}) == 1
+
+    results = list(model.match(origin='http://uche.ogbuji.net', attrs={u'@lang': u'ig'}))
+    assert results == [rels_1[4]]
+    assert len(list(model.match(origin='http://copia.ogbuji.net'))) == 3
+    assert [ link for ix, link in model ][:2] == rels_1[:2]
+
+    with pytest.raises(ValueError):
+        model.add_many([(None, 'http://purl.org/dc/elements/1.1/title', 'Spam', {})])
+
+
+def test_match_pushdown_mock(mock_collection, rels_1):
+    model = newmodel(collection=mock_collection)
+    model.add_many(rels_1)
+    model.add('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/creator', I('http://uche.ogbuji.net/about'))
+    # A literal which is the same as the tail of an abbreviated IRI
+    model.add('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'about')
+
+    # No origin means any origin
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/creator'))
+    assert len(results) == 3
+    assert set(r[0] for r in results) == {'http://copia.ogbuji.net', 'http://uche.ogbuji.net'}
+
+    results = list(model.match(target='Uche Ogbuji'))
+    assert [ r[0] for r in results ] == ['http://copia.ogbuji.net', 'http://uche.ogbuji.net']
+
+    results = list(model.match(target='http://uche.ogbuji.net/about'))
+    assert results == [('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/creator', 'http://uche.ogbuji.net/about', {})]
+    assert [ r[2] for r in model.match(target='about') ] == ['about']
+
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/title', attrs={'@lang': 'en'}))
+    assert [ r[2] for r in results ] == ['Copia', "Uche's home"]
+    assert list(model.match(None, 'http://purl.org/dc/elements/1.1/title', 'Ulo Uche', include_ids=True)) == [(0, rels_1[4])]
+
+    assert list(model.match(rel='http://example.org/spam')) == []
+    assert list(model.match(target='SPAM')) == []
+    assert list(model.match(attrs={'SPAM': 'EGGS'})) == []
+    assert len(list(model.match())) == 7
+
+
+def test_async(mongo_collection, rels_1):
+    import asyncio
+    from versa.driver import mongo_aio
+    # PyMongo's async API, from 4.9
+    AsyncMongoClient = pytest.importorskip("pymongo", minversion="4.9").AsyncMongoClient
+
+    async def run():
+        client = AsyncMongoClient(MONGOCONN)
+        try:
+            model = await mongo_aio.connect(client.versademo.model1)
+            await model.add_many(rels_1)
+            await model.add('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/creator', 'Uche')
+            assert await model.size() == 6
+            assert await model.origin_count() == 2
+            results = [ link async for link in model.match(origin='http://uche.ogbuji.net', attrs={u'@lang': u'ig'}) ]
+            assert results == [rels_1[4]]
+            assert len([ link async for link in model.match(rel='http://purl.org/dc/elements/1.1/creator') ]) == 3
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+    # Visible to the sync driver on the same collection
+    assert len(list(newmodel(collection=mongo_collection).match(origin='http://copia.ogbuji.net'))) == 2
+
+
+def test_match_many_mock(mock_collection, rels_1):
+    model = newmodel(collection=mock_collection)
+    model.add_many(rels_1)
+    patterns = [
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Copia'),
+        ('http://example.org/spam', 'http://purl.org/dc/elements/1.1/title'),
+        (None, 'http://purl.org/dc/elements/1.1/creator', None),
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net',),
+    ]
+    results = model.match_many(patterns)
+    assert results == [ list(model.match(*p)) for p in patterns ]
+    assert [ len(r) for r in results ] == [2, 1, 0, 2, 2, 2]
+
+
+def test_list_targets_mock(mock_collection):
+    # Tuples & lists with the same items are stored & matched the same way
+    model = newmodel(collection=mock_collection)
+    model.add('http://example.org/spam', 'http://example.org/vocab/pair', ('a', 'b'))
+    model.add('http://example.org/eggs', 'http://example.org/vocab/pair', ['c', 'd'])
+    for target in (('a', 'b'), ['a', 'b']):
+        assert list(model.match(target=target)) == [('http://example.org/spam', 'http://example.org/vocab/pair', ['a', 'b'], {})]
+        assert list(model.match('http://example.org/spam', 'http://example.org/vocab/pair', target)) == [('http://example.org/spam', 'http://example.org/vocab/pair', ['a', 'b'], {})]
+    assert len(list(model.match(target=('c', 'd')))) == 1
+
+
+def test_concurrent_upsert_mock(mock_collection):
+    # The origin index is unique, so an upsert which loses a race with another writer
+    # fails on it & is retried, rather than splitting the origin across documents
+    from pymongo.errors import BulkWriteError, DuplicateKeyError
+    model = newmodel(collection=mock_collection)
+    assert any(info.get('unique') for info in mock_collection.index_information().values())
+    with pytest.raises(DuplicateKeyError):
+        mock_collection.insert_one({'origin': '@_counts'})
+
+    bulk_write = mock_collection.bulk_write
+    raced = []
+    def racing_bulk_write(requests, **kwargs):
+        # Another writer inserts the node between this batch's upsert finding no
+        # document & inserting one, so the server fails that upsert on the index
+        if raced:
+            return bulk_write(requests, **kwargs)
+        raced.append(True)
+        mock_collection.insert_one({'origin': 'http://example.org/spam',
+            'rels': [{'rid': '@_other', 'instances': [['x', {}]]}]})
+        result = bulk_write(requests[1:], **kwargs)
+        raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 11000, 'errmsg': 'duplicate key'}],
+            'nUpserted': result.upserted_count})
+    mock_collection.bulk_write = racing_bulk_write
+
+    model.add_many([('http://example.org/spam', 'http://example.org/vocab/a', 'b', {}),
+                    ('http://example.org/eggs', 'http://example.org/vocab/a', 'c', {})])
+    assert mock_collection.count_documents({'origin': 'http://example.org/spam'}) == 1
+    assert list(model.match('http://example.org/spam', 'http://example.org/vocab/a')) == [('http://example.org/spam', 'http://example.org/vocab/a', 'b', {})]
+    assert len(list(model.match('http://example.org/eggs'))) == 1
+    # Only eggs was inserted by this model's upserts
+    assert model.origin_count() == 1
+    assert model.size() == 2
+
+
 if __name__ == '__main__':
     raise SystemExit("use pytest command line")
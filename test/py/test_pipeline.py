@@ -16,6 +16,7 @@ from amara3 import iri
 from versa import I, VTYPE_REL
 from versa import util
 from versa.driver.memory import newmodel
+from versa.driver import columnar
 from versa.serial import literate
 from versa.pipeline import *
 
@@ -415,5 +416,215 @@ def test_basics_5(testresourcepath):
     assert [ l[0] for l in modout.match(None, MB_NS('remark'), 'test')] == [I('i5GvPVm7ClA')]
 
 
+def test_fingerprint_many():
+    # Fingerprinting indexes types in one pass, so it scales with the number of links
+    modin = newmodel()
+    for i in range(2000):
+        rid = I('http://example.org/records/{0}'.format(i))
+        modin.add(rid, SCH_NS('name'), 'Book {0}'.format(i))
+        modin.add(rid, SCH_NS('isbn'), str(i))
+        if i % 2 == 0:
+            modin.add(rid, VTYPE_REL, SCH_NS('Book'))
+        if i % 4 == 0:
+            modin.add(rid, VTYPE_REL, SCH_NS('CreativeWork'))
+
+    FINGERPRINT_RULES = {
+        SCH_NS('Book'): materialize(BF_NS('Instance'), fprint=[(BF_NS('isbn'), follow(SCH_NS('isbn')))]),
+        SCH_NS('CreativeWork'): materialize(BF_NS('Work'), fprint=[(BF_NS('name'), follow(SCH_NS('name')))]),
+    }
+    ppl = generic_pipeline(FINGERPRINT_RULES, {}, {})
+    ppl.input_model, ppl.output_model, ppl.fingerprints = modin, newmodel(), {}
+    ppl.fingerprint_helper(FINGERPRINT_RULES)
+
+    assert list(util.resourcetypes_index(modin))[:2] == [I('http://example.org/records/0'), I('http://example.org/records/1')]
+    assert len(ppl.fingerprints) == 1000
+    assert list(ppl.fingerprints)[:2] == [I('http://example.org/records/0'), I('http://example.org/records/2')]
+    # Resources with both types have an output resource for each
+    mains, others = ppl.fingerprints[I('http://example.org/records/0')]
+    assert len(mains) == 2 and not others
+    assert len(ppl.fingerprints[I('http://example.org/records/2')][0]) == 1
+    assert len(list(util.all_origins(ppl.output_model, only_types={BF_NS('Instance')}))) == 1000
+
+
+def test_transform_dispatch():
+    # Rules are compiled into a rel-keyed dispatch, scalar & (rel, T1, T2...) specs both honored
+    modin = newmodel()
+    for i in range(3):
+        rid = I('http://example.org/records/{0}'.format(i))
+        modin.add(rid, VTYPE_REL, SCH_NS('Book'))
+        modin.add(rid, SCH_NS('name'), 'Book {0}'.format(i))
+        modin.add(rid, SCH_NS('isbn'), str(i))
+        modin.add(rid, SCH_NS('genre'), 'Fiction')
+
+    FINGERPRINT_RULES = {
+        SCH_NS('Book'): materialize(BF_NS('Instance'), fprint=[(BF_NS('isbn'), follow(SCH_NS('isbn')))]),
+    }
+    TRANSFORM_RULES = {
+        SCH_NS('name'): link(rel=BF_NS('name')),
+        (SCH_NS('name'), BF_NS('Work'), BF_NS('Instance')): link(rel=BF_NS('title')),
+        (SCH_NS('isbn'), BF_NS('Instance')): link(rel=BF_NS('isbn')),
+        (SCH_NS('genre'), BF_NS('Work')): link(rel=BF_NS('genre')),
+    }
+    dispatch = compile_rel_rules(TRANSFORM_RULES)
+    scalar_rule, typed_rules = dispatch[SCH_NS('name')]
+    assert scalar_rule is TRANSFORM_RULES[SCH_NS('name')]
+    assert [ typs for (typs, rule) in typed_rules ] == [frozenset([BF_NS('Work'), BF_NS('Instance')])]
+    assert dispatch[SCH_NS('isbn')][0] is None
+
+    ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, {})
+    ppl.input_model, ppl.output_model, ppl.fingerprints = modin, newmodel(), {}
+    ppl.fingerprint_helper(FINGERPRINT_RULES)
+    misses = []
+    applied = ppl.transform_by_rel_helper(TRANSFORM_RULES, handle_misses=misses.append)
+    assert applied == 9
+    # No Work resources, so the genre links all miss, as do the unruled type links
+    assert [ m[2] for m in misses if m[1] == SCH_NS('genre') ] == ['Fiction'] * 3
+    assert len(misses) == 6
+    assert len(list(ppl.output_model.match(None, BF_NS('name')))) == 3
+    assert len(list(ppl.output_model.match(None, BF_NS('title')))) == 3
+    assert len(list(ppl.output_model.match(None, BF_NS('isbn')))) == 3
+
+
+def test_parallel_transform():
+    # With rules that don't read the output model, such as these, the transform stage
+    # spread over worker processes gives the same output as a serial run
+    modin = newmodel()
+    for i in range(40):
+        rid = I('http://example.org/records/{0}'.format(i))
+        modin.add(rid, VTYPE_REL, SCH_NS('Book'))
+        modin.add(rid, SCH_NS('isbn'), str(i))
+        modin.add(rid, SCH_NS('name'), 'Book {0}'.format(i))
+        # Authors are shared across records, so materialized in more than one shard
+        modin.add(rid, SCH_NS('author'), 'Author {0}'.format(i % 3))
+        modin.add(rid, SCH_NS('genre'), 'Fiction')
+
+    FINGERPRINT_RULES = {
+        SCH_NS('Book'): materialize(BF_NS('Instance'), fprint=[(BF_NS('isbn'), follow(SCH_NS('isbn')))]),
+    }
+    TRANSFORM_RULES = {
+        (SCH_NS('name'), IT): link(rel=BF_NS('name')),
+        (SCH_NS('author'), IT): materialize(BF_NS('Person'), BF_NS('creator'),
+                                    fprint=[(BF_NS('name'), target())],
+                                    links=[(BF_NS('name'), target())]),
+    }
+
+    outputs = []
+    for workers in (None, 3):
+        ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, LABELIZE_RULES,
+                                root_ctx=context(None, None))
+        ppl.input_model, ppl.output_model, ppl.fingerprints = modin, newmodel(), {}
+        ppl.fingerprint_helper(FINGERPRINT_RULES, root_context=ppl._root_ctx)
+        misses = []
+        applied = ppl.transform_by_rel_helper(TRANSFORM_RULES, handle_misses=misses.append,
+                                                root_context=ppl._root_ctx, workers=workers)
+        assert applied == 80
+        assert [ m[2] for m in misses if m[1] == SCH_NS('genre') ] == ['Fiction'] * 40
+        outputs.append([ link for (_, link) in ppl.output_model ])
+
+    serial, parallel = outputs
+    # One Person per distinct author, however the records were split up
+    assert len([ l for l in parallel if l[1] == VTYPE_REL and l[2] == BF_NS('Person') ]) == 3
+    assert parallel == serial
+
+    ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, LABELIZE_RULES, root_ctx=context(None, None))
+    modout = ppl.run(input_model=modin, workers=2)
+    assert len(list(modout.match(None, BF_NS('creator')))) == 40
+
+    # Links added by rules are all carried back, even if rules remove others & compact
+    def genre(ctx):
+        out_rid = ctx.current_link[0]
+        ctx.output_model.remove([ ix for ix, l in ctx.output_model.match(out_rid, VTYPE_REL, include_ids=True) ])
+        ctx.output_model.compact()
+        ctx.output_model.add(out_rid, BF_NS('genreForm'), ctx.current_link[2])
+    ppl = generic_pipeline(FINGERPRINT_RULES, {SCH_NS('genre'): genre}, LABELIZE_RULES, root_ctx=context(None, None))
+    ppl.input_model, ppl.output_model, ppl.fingerprints = modin, newmodel(), {}
+    ppl.fingerprint_helper(FINGERPRINT_RULES, root_context=ppl._root_ctx)
+    ppl.transform_by_rel_helper({SCH_NS('genre'): genre}, root_context=ppl._root_ctx, workers=3)
+    assert len(list(ppl.output_model.match(None, BF_NS('genreForm')))) == 40
+
+    # Pipelines which don't call definition.__init__ still work
+    class old_pipeline(generic_pipeline):
+        def __init__(self, fingerprint_rules, transform_rules, labelize_rules, root_ctx):
+            self.fingerprint_rules = fingerprint_rules
+            self.transform_rules = transform_rules
+            self.labelize_rules = labelize_rules
+            self._root_ctx = root_ctx
+    ppl = old_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, LABELIZE_RULES, root_ctx=context(None, None))
+    ppl.input_model, ppl.output_model, ppl.fingerprints = modin, newmodel(), {}
+    ppl.fingerprint_helper(FINGERPRINT_RULES, root_context=ppl._root_ctx)
+    assert ppl.transform_by_rel_helper(TRANSFORM_RULES, root_context=ppl._root_ctx) == 80
+
+    # Other output models can't be shared with forked workers, so the stage runs serially
+    def no_parallel(*args):
+        raise AssertionError('parallel transform with a columnar output model')
+    ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, LABELIZE_RULES, root_ctx=context(None, None))
+    ppl.parallel_transform_by_rel = no_parallel
+    modout = ppl.run(input_model=modin, output_model=columnar.newmodel(), workers=2)
+    assert len(list(modout.match(None, BF_NS('creator')))) == 40
+
+def test_run_stream():
+    # Records run one at a time, each output with its materialized resources
+    def records():
+        for i in range(10):
+            modin = newmodel()
+            rid = I('http://example.org/records/{0}'.format(i))
+            modin.add(rid, VTYPE_REL, SCH_NS('Book'))
+            modin.add(rid, SCH_NS('isbn'), str(i))
+            modin.add(rid, SCH_NS('name'), 'Book {0}'.format(i))
+            modin.add(rid, SCH_NS('author'), 'Author {0}'.format(i % 3))
+            yield modin
+        # Empty record, e.g. from a blank row, skipped
+        yield newmodel()
+
+    FINGERPRINT_RULES = {
+        SCH_NS('Book'): materialize(BF_NS('Instance'), fprint=[(BF_NS('isbn'), follow(SCH_NS('isbn')))]),
+    }
+    TRANSFORM_RULES = {
+        (SCH_NS('name'), IT): link(rel=BF_NS('name')),
+        (SCH_NS('author'), IT): materialize(BF_NS('Person'), BF_NS('creator'),
+                                    fprint=[(BF_NS('name'), target())],
+                                    links=[(BF_NS('name'), target())]),
+    }
+
+    ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, LABELIZE_RULES, root_ctx=context(None, None))
+    sink = newmodel()
+    assert ppl.run_stream(records(), sink) == 10
+    assert len(list(util.all_origins(sink, only_types={BF_NS('Instance')}))) == 10
+    assert len(list(util.all_origins(sink, only_types={BF_NS('Person')}))) == 3
+    assert len(list(sink.match(None, BF_NS('creator')))) == 10
+    # Only the last record is held on to
+    assert len(ppl.fingerprints) == 1
+
+    # Same output as all records run together
+    modin = newmodel()
+    for record in records():
+        modin.add_many(list(record.match()))
+    ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, LABELIZE_RULES, root_ctx=context(None, None))
+    modout = ppl.run(input_model=modin)
+    assert sorted(map(repr, modout.match())) == sorted(map(repr, sink.match()))
+
+    # Or to a serializer
+    written = []
+    ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, LABELIZE_RULES, root_ctx=context(None, None))
+    assert ppl.run_stream(records(), lambda model: written.append(len(model))) == 10
+    # Each Person is written with every record which has it
+    assert written == [7] * 10
+
+    # Unless shared resources are deduped, so each Person is only written with the first record which has it
+    written = []
+    ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, LABELIZE_RULES, root_ctx=context(None, None))
+    assert ppl.run_stream(records(), lambda model: written.append(len(model)), dedupe_shared=True) == 10
+    assert written == [7, 7, 7, 4, 4, 4, 4, 4, 4, 4]
+    assert sum(written) == len(sink)
+
+    # All records into one given output model, which can't be deduped
+    ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, LABELIZE_RULES, root_ctx=context(None, None))
+    modout = newmodel()
+    assert all( model is modout for model in ppl.run_iter(records(), output_model=modout) )
+    assert sorted(map(repr, modout.match())) == sorted(map(repr, sink.match()))
+    with pytest.raises(ValueError):
+        ppl.run_stream(records(), sink, dedupe_shared=True, output_model=newmodel())
+
+
 if __name__ == '__main__':
     raise SystemExit("use py.test")
@@ -95,5 +95,38 @@ def test_basics_1(testresourcepath, expected_modout1):
     assert len(list(modout.match(None, 'http://example.org/materializedBy', None))) == 2
 
 
+def test_resource_map(testresourcepath):
+    modin = newmodel()
+    modin_fpath = 'schemaorg/catcherintherye-ugly.md'
+    literate.parse(open(os.path.join(testresourcepath, modin_fpath)).read(), modin)
+
+    FINGERPRINT_RULES = {
+        SCH_NS('Book'): materialize(BF_NS('Instance'), fprint=[(BF_NS('isbn'), follow(SCH_NS('isbn')))]),
+    }
+
+    seen = []
+    def check_resources(ctx):
+        resources = ctx.extras['@resource']
+        seen.append(resources)
+        # Same values as the fingerprints' main output resources, read-only
+        assert { k: v for k, v in resources.items() } == { k: list(m) for (k, (m, o)) in ppl.fingerprints.items() }
+        with pytest.raises(TypeError):
+            resources['spam'] = []
+        # A mutable copy, for rules which want a plain dict
+        assert dict(resources) == { k: list(m) for (k, (m, o)) in ppl.fingerprints.items() }
+        return None
+
+    TRANSFORM_RULES = {
+        SCH_NS('name'): check_resources,
+        SCH_NS('author'): check_resources,
+    }
+
+    ppl = generic_pipeline(FINGERPRINT_RULES, TRANSFORM_RULES, {})
+    ppl.run(input_model=modin)
+    assert len(seen) == 2
+    # One mapping for the whole run
+    assert seen[0] is seen[1]
+
+
 if __name__ == '__main__':
     raise SystemExit("use py.test")
@@ -118,6 +118,193 @@ def test_basics(pgdb):
     assert results[0] == expected, (results[0], expected)
 
 
+def test_add_many(pgdb):
+    conn = pgdb
+    rawids = conn.add_many(RELS_1 + [
+        ("http://example.org/spam", "http://example.org/vocab/note", "Tab\there,\nnewline & back\\slash", {}, "http://example.org/rels/1"),
+        ("http://example.org/spam", "http://example.org/vocab/note", "No attributes"),
+    ], batch_size=3)
+    assert len(rawids) == len(RELS_1) + 2
+    assert rawids == sorted(rawids)
+    assert conn.size() == len(RELS_1) + 2
+
+    results = list(conn.match(origin='http://uche.ogbuji.net', attrs={'@lang': 'ig'}))
+    assert results == [RELS_1[4]]
+    results = list(conn.match(origin='http://example.org/spam'))
+    assert [ r[2] for r in results ] == ["Tab\there,\nnewline & back\\slash", "No attributes"]
+
+    # Nothing from a failed batch is kept
+    with pytest.raises(ValueError):
+        conn.add_many([("http://example.org/eggs", "http://example.org/vocab/note", "Fine"), ("http://example.org/eggs",)])
+    assert conn.size() == len(RELS_1) + 2
+
+    # Booleans bulk loaded as add() stores them, so they're matched alike
+    conn.add_many([("http://example.org/ham", "http://example.org/vocab/cured", True, {"smoked": False})])
+    conn.add("http://example.org/bacon", "http://example.org/vocab/cured", True, {"smoked": False})
+    results = list(conn.match(rel="http://example.org/vocab/cured", target=True, attrs={"smoked": False}))
+    assert [ r[0] for r in results ] == ["http://example.org/ham", "http://example.org/bacon"]
+    assert list(conn.match(rel="http://example.org/vocab/cured", attrs={"smoked": True})) == []
+
+    # Add returns the raw ID too
+    assert conn.add("http://example.org/eggs", "http://example.org/vocab/note", "Fine") > rawids[-1] + 1
+
+
+def test_streaming(pgdb):
+    conn = pgdb
+    conn.add_many([ ('http://example.org/{0}'.format(i), 'http://example.org/vocab/n', str(i), {'n': str(i)}) for i in range(50) ])
+    results = conn.match(rel='http://example.org/vocab/n', include_ids=True)
+    rawid, first = next(results)
+    assert first == ('http://example.org/0', 'http://example.org/vocab/n', '0', {'n': '0'})
+    # Writes while streaming don't disturb the stream
+    conn.add('http://example.org/spam', 'http://example.org/vocab/n', 'eggs')
+    assert len(list(results)) == 49
+    assert conn._stream_conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    # Nor do failed writes, which roll back the shared connection
+    results = conn.match(rel='http://example.org/vocab/n')
+    next(results)
+    with pytest.raises(ValueError):
+        conn.add_many([('http://example.org/eggs', 'http://example.org/vocab/n', 'Fine'), ('http://example.org/eggs',)])
+    assert len(list(results)) == 50
+    assert conn._stream_conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    # Nor does abandoning one, once closed
+    results = iter(conn)
+    next(results)
+    results.close()
+    assert conn._stream_conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    assert len(list(conn.match())) == 51
+
+
+def test_transaction(pgdb):
+    conn = pgdb
+    conn.add_many(RELS_1)
+    # Model operations within the block leave the session's transaction be
+    with pytest.raises(RuntimeError):
+        with conn.transaction() as sess:
+            sess.add('http://example.org/spam', 'http://example.org/vocab/n', 'eggs')
+            assert conn.size() == len(RELS_1)
+            conn.add('http://example.org/spam', 'http://example.org/vocab/n', 'ham')
+            assert sess.size() == len(RELS_1) + 2
+            raise RuntimeError
+    assert [ link[2] for link in conn.match(origin='http://example.org/spam') ] == ['ham']
+
+    with conn.transaction() as sess:
+        sess.add('http://example.org/spam', 'http://example.org/vocab/n', 'eggs')
+        assert conn.match_many([('http://example.org/spam',)]) == [[('http://example.org/spam', 'http://example.org/vocab/n', 'ham')]]
+    assert conn.size() == len(RELS_1) + 2
+
+
+def test_pooled(pgdb, pgconnstr):
+    from concurrent.futures import ThreadPoolExecutor
+    pgdb.add_many(RELS_1)
+    model = postgres.connection(pgconnstr, maxconn=4)
+    try:
+        # Each stream has its own DB connection & transaction
+        streams = [ model.match(origin='http://uche.ogbuji.net') for i in range(3) ]
+        assert [ next(s) for s in streams ] == [RELS_1[2]] * 3
+        assert [ len(list(s)) for s in streams ] == [2] * 3
+
+        origins = ['http://copia.ogbuji.net', 'http://uche.ogbuji.net'] * 10
+        with ThreadPoolExecutor(4) as executor:
+            counts = list(executor.map(lambda o: len(list(model.match(origin=o))), origins))
+        assert counts == [2, 3] * 10
+
+        with pytest.raises(RuntimeError):
+            with model.transaction() as sess:
+                sess.add('http://example.org/spam', 'http://example.org/vocab/n', 'eggs')
+                assert sess.size() == len(RELS_1) + 1
+                # Not visible outside the transaction
+                assert model.size() == len(RELS_1)
+                raise RuntimeError
+        assert model.size() == len(RELS_1)
+
+        with model.transaction() as sess:
+            sess.add_many([('http://example.org/spam', 'http://example.org/vocab/n', 'eggs', {'n': '1'})])
+            assert list(sess.match(origin='http://example.org/spam')) == [('http://example.org/spam', 'http://example.org/vocab/n', 'eggs', {'n': '1'})]
+        assert pgdb.size() == len(RELS_1) + 1
+    finally:
+        model.close()
+
+
+def test_jsonb(pgdb_jsonb):
+    conn = pgdb_jsonb
+    conn.add_many(RELS_1[:3])
+    for link in RELS_1[3:]:
+        conn.add(*link)
+    conn.add('http://example.org/spam', 'http://example.org/vocab/n', 'eggs')
+    assert conn.size() == len(RELS_1) + 1
+
+    results = list(conn.match(origin='http://uche.ogbuji.net', attrs={'@lang': 'ig'}))
+    assert results == [RELS_1[4]]
+    results = list(conn.match(attrs={'@context': 'http://uche.ogbuji.net#_metadata'}, include_ids=True))
+    assert [ link for rawid, link in results ] == RELS_1[2:]
+    assert list(conn.match(attrs={'@lang': 'en', '@context': 'http://copia.ogbuji.net#_metadata'})) == [RELS_1[1]]
+    assert list(conn.match(attrs={'SPAM': 'EGGS'})) == []
+    assert list(conn)[-1] == ('http://example.org/spam', 'http://example.org/vocab/n', 'eggs')
+
+    with conn.transaction() as sess:
+        sess.add('http://example.org/spam', 'http://example.org/vocab/n', 'more eggs', {'n': 1})
+        assert list(sess.match(attrs={'n': 1})) == [('http://example.org/spam', 'http://example.org/vocab/n', 'more eggs', {'n': 1})]
+
+
+def test_async(pgdb, pgconnstr):
+    import asyncio
+    # Optional async driver requirements (see pyreqs-db.txt)
+    pytest.importorskip("psycopg")
+    pytest.importorskip("psycopg_pool")
+    from versa.driver import postgres_aio
+
+    async def lookup(model, origin):
+        return [ link async for link in model.match(origin=origin) ]
+
+    async def run():
+        async with postgres_aio.connection(pgconnstr, maxconn=4) as model:
+            rawids = await model.add_many(RELS_1)
+            assert len(rawids) == len(RELS_1)
+            await model.add('http://example.org/spam', 'http://example.org/vocab/n', 'eggs')
+            assert await model.size() == len(RELS_1) + 1
+
+            # Concurrent lookups, each on its own pooled DB connection
+            origins = ['http://copia.ogbuji.net', 'http://uche.ogbuji.net'] * 5
+            results = await asyncio.gather(*[ lookup(model, o) for o in origins ])
+            assert [ len(r) for r in results ] == [2, 3] * 5
+            assert results[1] == RELS_1[2:]
+
+            results = [ link async for link in model.match(origin='http://uche.ogbuji.net', attrs={'@lang': 'ig'}) ]
+            assert results == [RELS_1[4]]
+            results = [ item async for item in model ]
+            assert [ rawid for rawid, link in results ] == rawids + [rawids[-1] + 1]
+            assert results[-1][1] == ('http://example.org/spam', 'http://example.org/vocab/n', 'eggs')
+
+    asyncio.run(run())
+    # Visible to the sync driver on the same schema
+    assert pgdb.size() == len(RELS_1) + 1
+
+
+def test_match_many(pgdb):
+    pgdb.add_many(RELS_1 + [("http://example.org/spam", "http://example.org/vocab/n", "eggs")])
+    patterns = [
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Copia'),
+        ('http://example.org/spam', 'http://purl.org/dc/elements/1.1/title'),
+        (None, 'http://purl.org/dc/elements/1.1/creator', None),
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net',),
+    ]
+    results = pgdb.match_many(patterns)
+    assert results == [ list(pgdb.match(*p)) for p in patterns ]
+    assert [ len(r) for r in results ] == [2, 1, 0, 2, 2, 2]
+    results = pgdb.match_many([("http://example.org/spam", "http://example.org/vocab/n"), (None, None, None)], include_ids=True)
+    assert [ link for rawid, link in results[0] ] == [("http://example.org/spam", "http://example.org/vocab/n", "eggs")]
+    assert results[1] == list(pgdb.match(include_ids=True))
+    # Non-text values, as with match()
+    pgdb.add("http://example.org/spam", "http://example.org/vocab/count", 5)
+    results = pgdb.match_many([(None, None, 5), ("http://example.org/spam", None, 5)])
+    assert results == [ list(pgdb.match(None, None, 5)), list(pgdb.match("http://example.org/spam", None, 5)) ]
+    assert [ len(r) for r in results ] == [1, 1]
+
+
 RELS_1 = [
     ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://copia.ogbuji.net#_metadata"}),
     ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Copia", {"@context": "http://copia.ogbuji.net#_metadata", '@lang': 'en'}),
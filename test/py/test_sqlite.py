@@ -0,0 +1,105 @@
+# test_sqlite.py (use py.test)
+'''
+
+Note: to see stdout, stderr & logging regardless of outcome:
+
+py.test -s test/py/test_sqlite.py
+
+'''
+
+import pytest
+
+from versa.driver.sqlite import newmodel, connection
+from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
+
+
+@pytest.fixture
+def rels_1():
+    return [
+        ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://copia.ogbuji.net#_metadata"}),
+        ("http://copia.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Copia", {"@context": "http://copia.ogbuji.net#_metadata", '@lang': 'en'}),
+        ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/creator", "Uche Ogbuji", {"@context": "http://uche.ogbuji.net#_metadata"}),
+        ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Uche's home", {"@context": "http://uche.ogbuji.net#_metadata", '@lang': 'en'}),
+        ("http://uche.ogbuji.net", "http://purl.org/dc/elements/1.1/title", "Ulo Uche", {"@context": "http://uche.ogbuji.net#_metadata", '@lang': 'ig'}),
+    ]
+
+
+def test_basics(rels_1):
+    model = newmodel()
+    for link in rels_1:
+        model.add(*link)
+    assert model.size() == len(model) == 5
+
+    results = list(model.match(origin='http://copia.ogbuji.net'))
+    assert results == rels_1[:2]
+
+    results = list(model.match(origin='http://uche.ogbuji.net', attrs={'@lang': 'ig'}))
+    assert results == [rels_1[4]]
+
+    results = list(model.match(rel='http://purl.org/dc/elements/1.1/creator', target='Uche Ogbuji'))
+    assert [ r[ORIGIN] for r in results ] == ['http://copia.ogbuji.net', 'http://uche.ogbuji.net']
+
+    # Does it behave properly on non-matches?
+    assert list(model.match(origin='SPAM')) == []
+    assert list(model.match(rel='SPAM')) == []
+    assert list(model.match(target='SPAM')) == []
+    assert list(model.match(attrs={'SPAM': 'EGGS'})) == []
+
+
+def test_add_many_remove(tmp_path, rels_1):
+    dbfile = str(tmp_path / 'versa.db')
+    model = newmodel(dbfile)
+    rawids = model.add_many(rels_1 + [("http://example.org/spam", "http://example.org/vocab/n", 1)])
+    assert len(rawids) == 6
+    assert [ ix for ix, link in model ] == rawids
+    assert model[rawids[-1]] == ("http://example.org/spam", "http://example.org/vocab/n", 1, {})
+
+    # A bad link means nothing in the batch is added
+    with pytest.raises(ValueError):
+        model.add_many([("http://example.org/eggs", "http://example.org/vocab/n", 2), ("http://example.org/eggs",)])
+    assert model.size() == 6
+
+    model.remove([rawids[0], rawids[-1]])
+    assert list(model) == list(zip(rawids[1:5], rels_1[1:]))
+    with pytest.raises(IndexError):
+        model[rawids[-1]]
+    # IDs of removed links aren't reused
+    assert model.add_many([("http://example.org/eggs", "http://example.org/vocab/n", 2)]) == [rawids[-1] + 1]
+
+    for ix, (o, r, t, a) in list(model):
+        model.add(o, "http://example.org/vocab/seen", t)
+    assert model.size() == 10
+    model.close()
+
+    # Persistent, in WAL mode
+    model = connection(connstr=dbfile)
+    assert model.size() == 10
+    assert model._conn.execute('PRAGMA journal_mode;').fetchone()[0] == 'wal'
+
+
+def test_match_many(rels_1):
+    model = newmodel()
+    model.add_many(rels_1)
+    patterns = [
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net', 'http://purl.org/dc/elements/1.1/title', 'Copia'),
+        ('http://example.org/spam', 'http://purl.org/dc/elements/1.1/title'),
+        (None, 'http://purl.org/dc/elements/1.1/creator', None),
+        ('http://uche.ogbuji.net', 'http://purl.org/dc/elements/1.1/title'),
+        ('http://copia.ogbuji.net',),
+    ]
+    results = model.match_many(patterns)
+    assert results == [ list(model.match(*p)) for p in patterns ]
+    assert [ len(r) for r in results ] == [2, 1, 0, 2, 2, 2]
+    results = model.match_many([('http://copia.ogbuji.net', None, 'Copia'), (None, None, None)], include_ids=True)
+    assert results[0] == [(2, rels_1[1])]
+    assert results[1] == list(model)
+    # Non-text values compare as they do in match()
+    model.add('http://example.org/spam', 'http://example.org/count', 5)
+    results = model.match_many([(None, None, 5), ('http://example.org/spam', 'http://example.org/count', '5')])
+    assert results == [ list(model.match(None, None, 5)), list(model.match('http://example.org/spam', 'http://example.org/count', '5')) ]
+    assert [ len(r) for r in results ] == [1, 0]
+
+
+if __name__ == '__main__':
+    raise SystemExit("use py.test")
@@ -8,6 +8,29 @@ The optional attributes are metadata bound to the statement itself
 
 '''
 
+def _pattern_parts(pattern):
+    '''Return the (origin, rel, target) of a match_many pattern, padding shorter ones with None'''
+    pattern = tuple(pattern)
+    if len(pattern) > 3:
+        raise ValueError('Match patterns are (origin, rel, target)')
+    return pattern + (None,) * (3 - len(pattern))
+
+
+def _patterns_by_shape(patterns):
+    '''
+    Group match_many patterns by shape, i.e. tuple of names of the components they specify,
+    e.g. ('origin', 'rel'), for drivers which match all patterns of a shape together
+
+    returns a mapping from shape to list of (pattern index, value of 1st component in shape, ...) tuples
+    '''
+    by_shape = {}
+    for ix, pattern in enumerate(patterns):
+        parts = _pattern_parts(pattern)
+        shape = tuple(name for name, val in zip(('origin', 'rel', 'target'), parts) if val)
+        by_shape.setdefault(shape, []).append((ix,) + tuple(val for val in parts if val))
+    return by_shape
+
+
 class connection_base(object):
     @classmethod
     def newmodel(cls, baseiri=None):
@@ -32,6 +55,21 @@ class connection_base(object):
         '''
         raise NotImplementedError
 
+    def match_many(self, patterns, include_ids=False):
+        '''
+        Retrieve the relationships matching each of a list of patterns, in one operation
+        (e.g. one DB query or transaction) where the driver supports it
+
+        patterns - list of (origin, rel, target) tuples, any of which may be None to match anything,
+            e.g. [(rid1, VTYPE_REL, None), (rid2, VTYPE_REL, None)]. Shorter tuples, e.g. (origin, rel), are padded with None
+        include_ids - If true include statement IDs with the results
+
+        returns a list with a list of results (as from match) for each pattern, in order
+
+        This fallback just calls match for each pattern
+        '''
+        return [ list(self.match(*_pattern_parts(p), include_ids=include_ids)) for p in patterns ]
+
     def add(self, origin, rel, target, attrs=None, rid=None):
         '''
         Add one relationship to the extent
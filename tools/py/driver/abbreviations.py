@@ -0,0 +1,128 @@
+# versa.driver.abbreviations
+'''
+IRI prefix abbreviation & term encoding for the persistent drivers
+(e.g. versa.driver.lmdb, versa.driver.diskcache & versa.driver.mongo),
+for compact storage of IRIs.
+
+Rels & targets are stored as terms:
+
+* A hierarchical, HTTP-like IRI is stored as a list [prefix ID, tail], e.g.
+  'http://example.org/spam/eggs' as something like [23, 'eggs'], where
+  23 is the index of 'http://example.org/spam/' in the store's prefix list
+* A literal which is itself a list (or tuple) is tagged as [None, list of its items],
+  so a tuple is stored, matched & read back as the equivalent list
+* Anything else is stored as is
+
+so decoding needs no string parsing. Drivers store the prefix list along
+with a generation counter which is bumped on every change to the list.
+The cache holds forward & inverse maps, and only reloads them from the store
+when the stored generation differs from the one it last saw, e.g. because
+another process has since added prefixes.
+
+Older stores used strings such as '{a23}eggs', expanded with str.format
+using a map from names such as 'a23' to prefixes. legacy_expander() reads these,
+for migration to the current encoding.
+'''
+
+from amara3 import iri #for matches_uri_syntax
+
+
+def split_iri(rid):
+    '''
+    Split a hierarchical, HTTP-like IRI into prefix (up to and including the last '/')
+    and tail, e.g. for abbreviation. Returns None for anything else.
+    '''
+    if not isinstance(rid, str) or '/' not in rid or not iri.matches_uri_syntax(rid):
+        return None
+    head, tail = rid.rsplit('/', 1)
+    return head + '/', tail
+
+
+def term_key(term):
+    '''Hashable version of a stored term, e.g. for grouping links by rel'''
+    return tuple(term) if type(term) is list else term
+
+
+def legacy_expander(legacy_map):
+    '''
+    Return a function to read rels & targets as stored in the old '{a23}eggs' form
+
+    legacy_map - the store's old map from abbreviation names to IRI prefixes
+    '''
+    def expand(term):
+        if not isinstance(term, str):
+            return term
+        try:
+            return term.format(**legacy_map)
+        except (KeyError, ValueError, IndexError):
+            return term
+    return expand
+
+
+class abbreviation_cache(object):
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        '''Forget the cached maps, forcing a reload on next use, e.g. after an aborted write'''
+        self.generation = None
+        # Prefix ID (list index) to IRI prefix
+        self.prefixes = []
+        # IRI prefix to ID
+        self.heads = {}
+        return
+
+    def refresh(self, generation, load):
+        '''
+        Make sure the cache is current
+
+        generation - generation counter currently in the store
+        load - function to load the prefix list from the store, only called if the cache is out of date
+
+        returns the list of IRI prefixes
+        '''
+        if generation != self.generation:
+            self.prefixes = list(load())
+            self.heads = {v: k for k, v in enumerate(self.prefixes)}
+            self.generation = generation
+        return self.prefixes
+
+    def abbreviation(self, head):
+        '''Return the ID for an IRI prefix, or None if it's not in the map'''
+        return self.heads.get(head)
+
+    def add(self, head):
+        '''
+        Add an IRI prefix to the map and bump the generation. The caller must
+        persist the updated list (self.prefixes) & generation (self.generation)
+        in the same transaction, after having refreshed within that transaction
+
+        returns the new ID
+        '''
+        prefix_id = len(self.prefixes)
+        self.prefixes.append(head)
+        self.heads[head] = prefix_id
+        self.generation += 1
+        return prefix_id
+
+    def lookup(self, val):
+        '''
+        Return the stored form of a value, using only prefixes already in the map,
+        e.g. for queries. Returns None for IRIs whose prefix isn't in the map,
+        which therefore can't be in the store
+        '''
+        split = split_iri(val)
+        if split is None:
+            # Always a list, as it comes back from e.g. JSON or msgpack, so a tuple
+            # matches the same stored term as the equivalent list
+            return [None, list(val)] if isinstance(val, (list, tuple)) else val
+        head, tail = split
+        prefix_id = self.heads.get(head)
+        return None if prefix_id is None else [prefix_id, tail]
+
+    def expand(self, term):
+        '''Return the original value of a stored term'''
+        if type(term) is list:
+            prefix_id, tail = term
+            return tail if prefix_id is None else self.prefixes[prefix_id] + tail
+        return term
@@ -0,0 +1,157 @@
+#asyncio interface for Versa drivers, a Web semi-structured metadata tool
+'''
+
+[
+    (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
+]
+
+The optional attributes are metadata bound to the statement itself
+
+Asynchronous counterpart of versa.driver.connection_base, for use from asyncio
+code, e.g. services answering many concurrent lookups. Methods are coroutines,
+and match() & iteration are async generators:
+
+async for origin, rel, target, attrs in model.match(origin):
+    ...
+
+Drivers with native async support (versa.driver.postgres_aio & versa.driver.mongo_aio)
+implement this directly. Any other (synchronous) model can be wrapped with
+executor_connection, which runs its blocking calls in a thread pool executor
+'''
+
+import asyncio
+import concurrent.futures
+import functools
+from itertools import islice
+
+__all__ = ['async_connection_base', 'executor_connection']
+
+#Number of results an executor_connection fetches from the wrapped model per executor call
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class async_connection_base(object):
+    async def size(self):
+        '''Return the number of links in the model'''
+        raise NotImplementedError
+
+    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Retrieve an async iterator of relationships that match a pattern of components
+
+        origin - (optional) origin of the relationship (similar to an RDF subject). If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
+        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs with yield values
+        '''
+        raise NotImplementedError
+
+    def __aiter__(self):
+        '''Async iterator over all the links in the model, with their IDs'''
+        return self.match(include_ids=True)
+
+    async def add(self, origin, rel, target, attrs=None):
+        '''
+        Add one relationship to the extent
+
+        origin - origin of the relationship (similar to an RDF subject)
+        rel - type IRI of the relationship (similar to an RDF predicate)
+        target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
+        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+        '''
+        raise NotImplementedError
+
+    async def add_many(self, rels):
+        '''
+        Add a list of relationships to the extent
+
+        rels - a list of 0 or more relationship tuples, e.g.:
+        [
+            (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
+        ]
+        '''
+        raise NotImplementedError
+
+    async def close(self):
+        '''Release the model's resources, e.g. DB connections'''
+        return
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+        return False
+
+
+class executor_connection(async_connection_base):
+    def __init__(self, model, executor=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''
+        Async adapter for a synchronous model, e.g. a memory, SQLite or LMDB one
+
+        model - the synchronous model (connection object) to wrap
+        executor - concurrent.futures executor in which to run the model's blocking calls.
+            By default a private single thread executor, so calls on a model which isn't
+            thread-safe are never run concurrently. Pass e.g. a bigger thread pool for
+            models which are thread safe, such as a pooled postgres.connection
+        chunk_size - number of results fetched from the wrapped model per executor call
+
+        All of the model's calls are run in the executor, so drivers which
+        tie a connection to a thread (e.g. SQLite) should be created there too
+        '''
+        self.model = model
+        self._own_executor = executor is None
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._chunk_size = chunk_size
+        return
+
+    async def _run(self, func, *args, **kwargs):
+        '''Run a blocking call in the executor, returning its result'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _iterate(self, func, *args, **kwargs):
+        '''
+        Async generator over the results of a blocking call returning an iterator,
+        which is advanced in the executor, chunk_size results at a time
+        '''
+        results = await self._run(lambda: iter(func(*args, **kwargs)))
+        try:
+            while True:
+                chunk = await self._run(lambda: list(islice(results, self._chunk_size)))
+                if not chunk:
+                    break
+                for item in chunk:
+                    yield item
+        finally:
+            #e.g. so that drivers streaming from a DB cursor release it
+            if hasattr(results, 'close'):
+                await self._run(results.close)
+        return
+
+    async def size(self):
+        '''Return the number of links in the model'''
+        return await self._run(self.model.size)
+
+    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''As the wrapped model's match(), as an async generator'''
+        return self._iterate(self.model.match, origin, rel, target, attrs, include_ids=include_ids)
+
+    def __aiter__(self):
+        '''Async iterator over the wrapped model, as per its __iter__'''
+        return self._iterate(iter, self.model)
+
+    async def add(self, origin, rel, target, attrs=None):
+        '''As the wrapped model's add()'''
+        return await self._run(self.model.add, origin, rel, target, attrs)
+
+    async def add_many(self, rels):
+        '''As the wrapped model's add_many(). rels is used up before the call, in case it's lazy'''
+        return await self._run(self.model.add_many, list(rels))
+
+    async def close(self):
+        '''Shut down the executor, if private, without closing the wrapped model'''
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+        return
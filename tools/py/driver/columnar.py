@@ -0,0 +1,444 @@
+#Compact, columnar in-memory driver for Versa, a Web semi-structured metadata tool
+'''
+Same contract as versa.driver.memory, but each link takes up a few machine
+words rather than a tuple plus its own attribute dict:
+
+* Origins, rels & targets are interned into a term dictionary, mapping each
+  distinct value to an integer term ID
+* Links are kept as parallel array('q') columns of term IDs, plus a column of
+  IDs for attribute mappings
+* Identical attribute mappings (including the very common empty one) are
+  stored once and shared by all the links which use them
+* Indexes are arrays by term ID of link positions, with separate arrays only
+  for the terms in more than one link
+
+For example 100,000 links, of 20,000 origins, 10 rels & 1,000 distinct targets,
+half of them with an attribute, take about 170 bytes per link, including the values,
+against about 410 as plain link tuples with their own attribute dicts. The saving
+shrinks as values repeat less, e.g. about 300 against 410 if every target is distinct,
+since each distinct value is still stored as the object it is.
+
+Links yielded from match() etc. are freshly built tuples, with a copy of the
+attributes, so callers can't tamper with the shared storage.
+
+As with versa.driver.memory, removed links leave tombstones, so other links keep
+their IDs, until compact() is called. Note: neither reclaims term dictionary space.
+'''
+
+from array import array
+
+from versa.driver import connection_base
+from versa.driver.memory import _hashable, _canonical_repr
+from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
+__all__ = ['connection', 'newmodel']
+
+# Term ID of the shared, empty attribute mapping
+EMPTY_ATTRS_ID = 0
+# Marks removed links in the origin column
+TOMBSTONE = -1
+# Index array markers for terms in no link, or in more than one
+NO_POSITION = -1
+MULTIPLE_POSITIONS = -2
+
+
+def newmodel(name=None, baseiri=None, attr_cls=dict):
+    '''
+    Return new, empty columnar in-memory Versa model
+    '''
+    return connection(baseiri=baseiri, attr_cls=attr_cls)
+
+
+def _new_index():
+    '''
+    Empty index from term IDs to link positions: an array of each term's position,
+    if it's in one link, and a dict of arrays of positions for terms in more than one
+    '''
+    return (array('q'), {})
+
+
+def _index_add(index, tid, pos):
+    '''
+    Add a link position to an index. Single positions are stored in the array,
+    only promoted to an array of their own once a term has more than one link
+    '''
+    single, multiple = index
+    if tid >= len(single):
+        single.extend([NO_POSITION] * (tid + 1 - len(single)))
+    curr = single[tid]
+    if curr == NO_POSITION:
+        single[tid] = pos
+    elif curr == MULTIPLE_POSITIONS:
+        multiple[tid].append(pos)
+    else:
+        single[tid] = MULTIPLE_POSITIONS
+        multiple[tid] = array('q', (curr, pos))
+    return
+
+
+def _index_get(index, tid):
+    '''Sequence of link positions for a term in an index, in ascending order'''
+    single, multiple = index
+    curr = single[tid] if tid < len(single) else NO_POSITION
+    if curr == NO_POSITION:
+        return ()
+    return multiple[tid] if curr == MULTIPLE_POSITIONS else (curr,)
+
+
+class connection(connection_base):
+    def __init__(self, baseiri=None, attr_cls=dict):
+        '''
+        Initialize connection object
+
+        Args:
+            baseiri: IRI used by default to resolve relative IRIs
+            attr_cls: class used to hold relationship attributes. By default use dict
+        '''
+        self._attr_cls = attr_cls
+        self.create_space()
+        self._baseiri = baseiri
+        self.factory = newmodel
+        return
+
+    def copy(self, contents=True):
+        '''Create a copy of this model, optionally without contents (i.e. just configuration)'''
+        cp = connection(self._baseiri, self._attr_cls)
+        if contents: cp.add_many(self)
+        return cp
+
+    def create_space(self):
+        '''Set up a new table space for the first time'''
+        # Term dictionary, with a map from values to term IDs for each class, so that
+        # e.g. I('x') & 'x' come back out of the model as they went in. They're still
+        # equal for matching & duplicate checks, as in the memory driver
+        self._terms = []
+        self._term_ids = {}
+        # Shared attribute mappings, and their IDs by canonical key
+        self._attrsets = [self._attr_cls()]
+        self._attrset_ids = {_hashable(self._attr_cls()): EMPTY_ATTRS_ID}
+        # The links, as columns
+        self._origins = array('q')
+        self._rels = array('q')
+        self._targets = array('q')
+        self._attrs = array('q')
+        self._tombstones = 0
+        # Indexes from term IDs to link positions
+        self._origin_index = _new_index()
+        self._rel_index = _new_index()
+        self._target_index = _new_index()
+        return
+
+    def drop_space(self):
+        '''Dismantle an existing table space'''
+        self.create_space()
+        return
+
+    def _intern(self, term):
+        '''Return the term ID for a value, adding it to the term dictionary if need be'''
+        ids = self._term_ids.setdefault(term.__class__, {})
+        key = _hashable(term)
+        tid = ids.get(key)
+        if tid is None:
+            tid = len(self._terms)
+            self._terms.append(term)
+            ids[key] = tid
+        return tid
+
+    def _lookup(self, term):
+        '''
+        Return the IDs of all terms which compare equal to a value, e.g. I('x') & 'x'.
+        Doesn't add anything to the term dictionary
+        '''
+        val = _hashable(term)
+        tids = []
+        for ids in self._term_ids.values():
+            tid = ids.get(val)
+            if tid is not None:
+                tids.append(tid)
+        return tids
+
+    def _intern_attrs(self, attrs):
+        '''Return the ID of a shared attribute mapping equal to attrs, adding it if need be'''
+        if not attrs:
+            return EMPTY_ATTRS_ID
+        attrs = self._attr_cls(attrs)
+        key = _hashable(attrs)
+        aid = self._attrset_ids.get(key)
+        if aid is None:
+            aid = len(self._attrsets)
+            self._attrsets.append(attrs)
+            self._attrset_ids[key] = aid
+        return aid
+
+    def _lookup_attrs(self, attrs):
+        '''
+        Return the ID of the shared attribute mapping equal to attrs, or None if there's none.
+        Doesn't add anything
+        '''
+        if not attrs:
+            return EMPTY_ATTRS_ID
+        return self._attrset_ids.get(_hashable(self._attr_cls(attrs)))
+
+    def _link(self, pos):
+        '''Materialize the link at a position'''
+        terms = self._terms
+        return (terms[self._origins[pos]], terms[self._rels[pos]],
+                terms[self._targets[pos]], self._attrsets[self._attrs[pos]].copy())
+
+    def _positions(self, index, values):
+        '''
+        Positions of links whose component, per the index, is one of the given values,
+        in ascending order
+        '''
+        plists = [ _index_get(index, tid) for val in values for tid in self._lookup(val) ]
+        if len(plists) == 1:
+            return plists[0]
+        return sorted(pos for plist in plists for pos in plist)
+
+    def _candidates(self, origin=None, rel=None, target=None):
+        '''
+        Iterator over positions of links which might match the given components, each
+        a set of alternative values. Uses the narrowest applicable index, falling back
+        to a full scan if no component is given. Callers must still check each link.
+        '''
+        positions = [ self._positions(index, values) for index, values in (
+                        (self._origin_index, origin),
+                        (self._rel_index, rel),
+                        (self._target_index, target)) if values ]
+        if not positions:
+            return iter(range(len(self._origins)))
+        return iter(min(positions, key=len))
+
+    def query(self, expr):
+        '''Execute a Versa query'''
+        raise NotImplementedError
+
+    def __len__(self):
+        '''Return number of links in the model'''
+        return len(self._origins) - self._tombstones
+
+    def size(self):
+        '''Return the number of links in the model'''
+        return len(self._origins) - self._tombstones
+
+    def __iter__(self):
+        for index in range(len(self._origins)):
+            if self._origins[index] != TOMBSTONE: yield index, self._link(index)
+
+    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Iterator over relationship IDs that match a pattern of components
+
+        origin - (optional) origin of the relationship (similar to an RDF subject). If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
+        attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs with yield values
+        '''
+        return self.multimatch(origin=None if not origin else {origin},
+                                rel=None if not rel else {rel},
+                                target=None if not target else {_hashable(target)},
+                                attrs=attrs, include_ids=include_ids)
+
+    def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Iterator over relationship IDs that match a pattern of components
+
+        origin - (optional) origin of the relationship (similar to an RDF subject), or set of values. If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate), or set of values. If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object, or set of values. If omitted any target will be matched.
+        attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs with yield values
+        '''
+        origin = origin if origin is None or isinstance(origin, set) else set([origin])
+        rel = rel if rel is None or isinstance(rel, set) else set([rel])
+        target = target if target is None or isinstance(target, set) else set([target])
+        # Compare term IDs rather than values
+        origin_ids = { tid for val in origin for tid in self._lookup(val) } if origin else None
+        rel_ids = { tid for val in rel for tid in self._lookup(val) } if rel else None
+        target_ids = { tid for val in target for tid in self._lookup(val) } if target else None
+        for index in self._candidates(origin, rel, target):
+            if self._origins[index] == TOMBSTONE:
+                continue
+            if origin_ids is not None and self._origins[index] not in origin_ids:
+                continue
+            if rel_ids is not None and self._rels[index] not in rel_ids:
+                continue
+            if target_ids is not None and self._targets[index] not in target_ids:
+                continue
+            curr_attrs = self._attrsets[self._attrs[index]]
+            if attrs:
+                if any(k not in curr_attrs or curr_attrs.get(k) != v for k, v in attrs.items()):
+                    continue
+            if include_ids:
+                yield index, self._link(index)
+            else:
+                yield self._link(index)
+        return
+
+    def add(self, origin, rel, target, attrs=None, index=None):
+        '''
+        Add one relationship to the extent
+
+        origin - origin of the relationship (similar to an RDF subject)
+        rel - type IRI of the relationship (similar to an RDF predicate)
+        target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
+        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+        index - optional position for the relationship to be inserted
+        '''
+        if not origin:
+            raise ValueError('Relationship origin cannot be null')
+        if not rel:
+            raise ValueError('Relationship ID cannot be null')
+
+        # Refuse dupes, i.e. equal links, even if e.g. one has I('x') where the other has 'x'.
+        # Nothing is interned until the link is accepted, and there can only be a dupe
+        # if all its terms & attributes are already known
+        origin_ids, rel_ids, target_ids = (set(self._lookup(val)) for val in (origin, rel, target))
+        aid = self._lookup_attrs(attrs)
+        if origin_ids and rel_ids and target_ids and aid is not None:
+            candidates = min((self._positions(self._origin_index, (origin,)),
+                                self._positions(self._rel_index, (rel,)),
+                                self._positions(self._target_index, (target,))), key=len)
+            for pos in candidates:
+                if (self._origins[pos] in origin_ids and self._rels[pos] in rel_ids
+                        and self._targets[pos] in target_ids and self._attrs[pos] == aid):
+                    return
+
+        oid, rid_, tid = self._intern(origin), self._intern(rel), self._intern(target)
+        aid = self._intern_attrs(attrs)
+
+        if index is not None:
+            for column, val in ((self._origins, oid), (self._rels, rid_),
+                                (self._targets, tid), (self._attrs, aid)):
+                column.insert(index, val)
+            # Positions after the insertion point have all shifted
+            self._reindex()
+            return index
+
+        pos = len(self._origins)
+        self._origins.append(oid)
+        self._rels.append(rid_)
+        self._targets.append(tid)
+        self._attrs.append(aid)
+        _index_add(self._origin_index, oid, pos)
+        _index_add(self._rel_index, rid_, pos)
+        _index_add(self._target_index, tid, pos)
+        return pos
+
+    def add_many(self, rels):
+        '''
+        Add a list of relationships to the extent
+
+        rels - a list of 0 or more relationship tuples, e.g.:
+        [
+            (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
+        ]
+
+        origin - origin of the relationship (similar to an RDF subject)
+        rel - type IRI of the relationship (similar to an RDF predicate)
+        target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
+        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+
+        you can omit the dictionary of attributes if there are none, as long as you are not specifying a statement ID
+        '''
+        for curr_rel in rels:
+            attrs = None
+            if len(curr_rel) == 2: # handle __iter__ output for copy()
+                origin, rel, target, attrs = curr_rel[1]
+            elif len(curr_rel) == 3:
+                origin, rel, target = curr_rel
+            elif len(curr_rel) == 4:
+                origin, rel, target, attrs = curr_rel
+            else:
+                raise ValueError
+            assert rel
+            self.add(origin, rel, target, attrs)
+        return
+
+    def update(self, other):
+        '''
+        Add the links in another model to self
+
+        other - other Versa model to have all links added to self
+        '''
+        for rid, link in other:
+            self.add(*link)
+        return
+
+    def _reindex(self):
+        '''Rebuild the indexes, e.g. after link positions have shifted'''
+        self._origin_index = _new_index()
+        self._rel_index = _new_index()
+        self._target_index = _new_index()
+        for pos in range(len(self._origins)):
+            if self._origins[pos] == TOMBSTONE: continue
+            _index_add(self._origin_index, self._origins[pos], pos)
+            _index_add(self._rel_index, self._rels[pos], pos)
+            _index_add(self._target_index, self._targets[pos], pos)
+        return
+
+    def remove(self, index):
+        '''
+        Delete one or more relationship, by index, from the extent. The IDs of
+        other links are not affected, until compact() is called
+
+        index - either a single index or a list of indices
+        '''
+        if hasattr(index, '__iter__'):
+            ind = set(index)
+        else:
+            ind = [index]
+
+        for i in ind:
+            # Silently ignore IDs which don't exist, or have already been removed
+            if not 0 <= i < len(self._origins) or self._origins[i] == TOMBSTONE: continue
+            # Leave a tombstone. Index entries for it are skipped until compact()
+            self._origins[i] = TOMBSTONE
+            self._tombstones += 1
+        return
+
+    def compact(self):
+        '''
+        Reclaim the space taken up by removed links. Note: this changes the IDs of links
+        added after the earliest removed one
+        '''
+        if self._tombstones:
+            keep = [ i for i in range(len(self._origins)) if self._origins[i] != TOMBSTONE ]
+            self._origins = array('q', (self._origins[i] for i in keep))
+            self._rels = array('q', (self._rels[i] for i in keep))
+            self._targets = array('q', (self._targets[i] for i in keep))
+            self._attrs = array('q', (self._attrs[i] for i in keep))
+            self._tombstones = 0
+            self._reindex()
+        return
+
+    def add_iri_prefix(self, prefix):
+        '''
+        Add an IRI prefix, for efficiency of table scan searches
+
+        XXX We might or might not need such a method, based on perf testing
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''Set up a new table space for the first time'''
+        self.create_space()
+        return
+
+    def __getitem__(self, i):
+        if i < 0: i += len(self._origins)
+        if not 0 <= i < len(self._origins):
+            raise IndexError(i)
+        if self._origins[i] == TOMBSTONE:
+            raise IndexError(f'Link {i} has been removed')
+        return self._link(i)
+
+    def __repr__(self):
+        '''
+        Canonical representation used for equivalence testing in test cases.
+        Same as for the plain in-memory driver, so the two can be compared
+        '''
+        return _canonical_repr([ link for ix, link in self ])
+
+    def __eq__(self, other):
+        return repr(other) == repr(self)
@@ -7,16 +7,18 @@ Key is origin
 Value is list:
 
 [
-    {rel1: [
-        (target11, {attrname1: attrval1, attrname2: attrval2})
-        (target12, {attrname1: attrval1, attrname2: attrval2})
-    ]}
-    {rel2: [
-        (target21, {attrname1: attrval1, attrname2: attrval2})
-        (target22, {attrname1: attrval1, attrname2: attrval2})
-    ]}
+    [rel1, [
+        [target11, {attrname1: attrval1, attrname2: attrval2}],
+        [target12, {attrname1: attrval1, attrname2: attrval2}],
+    ]],
+    [rel2, [
+        [target21, {attrname1: attrval1, attrname2: attrval2}],
+        [target22, {attrname1: attrval1, attrname2: attrval2}],
+    ]],
 ]
 
+Rels & targets are encoded terms, e.g. with IRI prefixes abbreviated (see versa.driver.abbreviations)
+
 
 '''
 
@@ -29,8 +31,15 @@ from diskcache import Index #pip install diskcache
 from amara3 import iri #for absolutize & matches_uri_syntax
 
 from versa.driver import connection_base
+from versa.driver.abbreviations import abbreviation_cache, split_iri, term_key, legacy_expander
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
+ABBREVIATIONS_KEY = '@_abbreviations'
+#Bumped whenever the abbreviations map changes, so connections know when to reload it
+ABBREVIATIONS_GEN_KEY = '@_abbreviations_gen'
+#Counts of links, origins & links per rel, maintained on every write
+#so they needn't be worked out by scanning the DB
+COUNTS_KEY = '@_counts'
 
 def newmodel(dbdir, baseiri=None):
     '''
@@ -49,10 +58,13 @@ class connection(connection_base):
         self._dbdir = dbdir
         self._db = Index(dbdir)
         if clear: self._db.clear()
+        self._abbr_cache = abbreviation_cache()
         self._ensure_abbreviations()
+        self._migrate()
+        if COUNTS_KEY not in self._db:
+            self._recount()
         #self.create_model()
         self._baseiri = baseiri
-        self._abbr_index = 0
         return
 
     def copy(self, contents=True):
@@ -68,35 +80,39 @@ class connection(connection_base):
 
     def size(self):
         '''Return the number of links in the model'''
-        count = 0
-        for origin in self._db:
-            if origin.startswith('@'):
-                continue
-            for rel, targetplus in self._db[origin].items():
-                count += len(targetplus)
-        return count
-        #return  self._db_coll.count() - connection.META_ITEM_COUNT
+        return self._db[COUNTS_KEY]['links']
+
+    def __len__(self):
+        '''Return the number of links in the model'''
+        return self.size()
+
+    def origin_count(self):
+        '''Return the number of distinct origins in the model'''
+        return self._db[COUNTS_KEY]['origins']
+
+    def rel_counts(self):
+        '''Return a mapping from each rel in the model to its number of links'''
+        return self._db[COUNTS_KEY]['rels']
+
+    def _recount(self):
+        '''Work out the counts by scanning the whole DB, e.g. for one from before they were kept'''
+        with self._db.transact():
+            self._abbreviations()
+            expand = self._abbr_cache.expand
+            counts = {'links': 0, 'origins': 0, 'rels': {}}
+            for origin in self._db:
+                if origin.startswith('@'):
+                    continue
+                counts['origins'] += 1
+                for rel, targetplus in self._db[origin]:
+                    rel = expand(rel)
+                    counts['links'] += len(targetplus)
+                    counts['rels'][rel] = counts['rels'].get(rel, 0) + len(targetplus)
+            self._db[COUNTS_KEY] = counts
+        return
 
     def __iter__(self):
-        abbrevs = self._abbreviations()
-        cursor = self._db_coll.find()
-        index = 0
-        for origin in self._db:
-            if origin.startswith('@'):
-                continue
-            for rel, targetplus in self._db[origin].items():
-                try:
-                    rel = rel.format(**abbrevs)
-                except (KeyError, ValueError):
-                    pass
-                count += len(targetplus)
-                for target, attribs in targetplus:
-                    try:
-                        target = target.format(**abbrevs)
-                    except (KeyError, ValueError):
-                        pass
-                    yield index, (origin, rel, target, attribs)
-                    index += 1
+        yield from enumerate(self.match())
 
     # FIXME: Statement indices don't work sensibly without some inefficient additions. Use e.g. match for delete instead
     def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
@@ -109,7 +125,13 @@ class connection(connection_base):
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
         include_ids - If true include statement IDs with yield values
         '''
-        abbrevs = self._abbreviations()
+        self._abbreviations()
+        expand = self._abbr_cache.expand
+        # Compare stored forms, so only matching links need be decoded
+        rel_term = self._abbr_cache.lookup(rel) if rel else None
+        target_term = self._abbr_cache.lookup(target) if target else None
+        if (rel and rel_term is None) or (target and target_term is None):
+            return
         index = 0
         if origin is None:
             extent = self._db
@@ -119,22 +141,15 @@ class connection(connection_base):
         for origin in extent:
             if origin.startswith('@'):
                 continue
-            for xrel, xtargetplus in self._db.get(origin, {}).items():
-                try:
-                    xrel = xrel.format(**abbrevs)
-                except (KeyError, ValueError):
-                    pass
-                if rel and rel != xrel:
+            for xrel, xtargetplus in self._db.get(origin, []):
+                if rel and rel_term != xrel:
                     continue
+                xrel = expand(xrel)
                 for xtarget, xattrs in xtargetplus:
                     index += 1
-                    # FIXME: only expand target abbrevs if of resource type?
-                    try:
-                        xtarget = xtarget.format(**abbrevs)
-                    except (KeyError, ValueError):
-                        pass
-                    if target and target != xtarget:
+                    if target and target_term != xtarget:
                         continue
+                    xtarget = expand(xtarget)
                     matches = True
                     if attrs:
                         for k, v in attrs.items():
@@ -197,15 +212,33 @@ class connection(connection_base):
 
         attrs = attrs or {}
 
-        origin_obj = self._db.get(origin)
-        rel = self._abbreviate(rel)
-        target = self._abbreviate(target)
-        
-        if origin_obj is None:
-            self._db[origin] = {rel: [(target, attrs)]}
-        else:
-            origin_obj.setdefault(rel, []).append((target, attrs))
-            self._db[origin] = origin_obj
+        try:
+            with self._db.transact():
+                self._abbreviations()
+                origin_obj = self._db.get(origin)
+                counts = self._db[COUNTS_KEY]
+                counts['links'] += 1
+                counts['origins'] += origin_obj is None
+                counts['rels'][rel] = counts['rels'].get(rel, 0) + 1
+                self._db[COUNTS_KEY] = counts
+                rel = self._abbreviate(rel)
+                target = self._abbreviate(target)
+
+                if origin_obj is None:
+                    self._db[origin] = [[rel, [[target, attrs]]]]
+                else:
+                    key = term_key(rel)
+                    for xrel, targetplus in origin_obj:
+                        if term_key(xrel) == key:
+                            targetplus.append([target, attrs])
+                            break
+                    else:
+                        origin_obj.append([rel, [[target, attrs]]])
+                    self._db[origin] = origin_obj
+        except Exception:
+            # Any abbreviations added in the aborted transaction are gone
+            self._abbr_cache.invalidate()
+            raise
         return
 
     def add_many(self, rels):
@@ -256,37 +289,61 @@ class connection(connection_base):
         return repr(other) == repr(self)
 
     def _abbreviations(self):
-        abbrev_obj = self._db['@_abbreviations']
-        return abbrev_obj
-        
-    def _abbreviate(self, rid):
         '''
-        Abbreviate a relationship or resource ID target for efficient storage
-        in the DB. Works only with a prefix/suffix split of hierarchical HTTP-like IRIs,
-        e.g. 'http://example.org/spam/eggs' becomes something like '{a23}eggs'
-        and afterward there will be an entry in the prefix map from 'a23' to 'http://example.org/spam/'
-        The map can then easily be used with str.format
+        Return the list of IRI prefixes.
+        Only loaded from the DB if it has changed since last used
         '''
-        if not isinstance(rid, str) or '/' not in rid or not iri.matches_uri_syntax(rid):
-            return rid
-        head, tail = rid.rsplit('/', 1)
-        head += '/'
-        pmap = self._db['@_abbreviations']
-        assert pmap is not None
-        #FIXME: probably called too often to do this every time
-        inv_pmap = {v: k for k, v in pmap.items()}
-        if head in inv_pmap:
-            prefix = inv_pmap[head]
-        else:
-            prefix = f'a{self._abbr_index}'
-            pmap[prefix] = head
-            self._abbr_index += 1
-            self._db['@_abbreviations'] = pmap
-        post_rid = '{' + prefix + '}' + tail.replace('{', '{{').replace('}', '}}')
-        return post_rid
+        gen = self._db.get(ABBREVIATIONS_GEN_KEY, 0)
+        return self._abbr_cache.refresh(gen, lambda: self._db[ABBREVIATIONS_KEY])
         
+    def _abbreviate(self, val):
+        '''
+        Encode a relationship or target for efficient storage in the DB.
+        Hierarchical HTTP-like IRIs are split into prefix & tail,
+        e.g. 'http://example.org/spam/eggs' becomes something like [23, 'eggs']
+        and afterward there will be an entry 23 in the prefix list for 'http://example.org/spam/'
+
+        Assumes the abbreviations cache has been refreshed within the current transaction
+        '''
+        term = self._abbr_cache.lookup(val)
+        if term is None:
+            head, tail = split_iri(val)
+            term = [self._abbr_cache.add(head), tail]
+            self._save_abbreviations()
+        return term
+
+    def _save_abbreviations(self):
+        self._db[ABBREVIATIONS_KEY] = self._abbr_cache.prefixes.copy()
+        self._db[ABBREVIATIONS_GEN_KEY] = self._abbr_cache.generation
+        return
+
     def _ensure_abbreviations(self):
-        if '@_abbreviations' not in self._db:
-            self._db['@_abbreviations'] = {}
+        if ABBREVIATIONS_KEY not in self._db:
+            self._db[ABBREVIATIONS_KEY] = []
         return
-        
+
+    def _migrate(self):
+        '''
+        Convert a DB from the old storage format, with rels & targets such as '{a23}eggs'
+        expanded through str.format, to the current one. Done in place, in one transaction
+
+        returns True if there was anything to convert
+        '''
+        with self._db.transact():
+            legacy_map = self._db[ABBREVIATIONS_KEY]
+            if not isinstance(legacy_map, dict):
+                return False
+            expand = legacy_expander(legacy_map)
+            self._abbr_cache.invalidate()
+            self._abbr_cache.refresh(self._db.get(ABBREVIATIONS_GEN_KEY, 0), list)
+            origins = [ origin for origin in self._db if not origin.startswith('@') ]
+            for origin in origins:
+                self._db[origin] = [
+                    [self._abbreviate(expand(rel)), [
+                        [self._abbreviate(expand(target)), attrs] for target, attrs in targetplus
+                    ]] for rel, targetplus in self._db[origin].items()
+                ]
+            # Bump the generation even if there were no prefixes, so other connections reload
+            self._abbr_cache.generation += 1
+            self._save_abbreviations()
+        return True
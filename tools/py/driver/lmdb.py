@@ -7,16 +7,21 @@ Key is origin
 Value is list:
 
 [
-    {rel1: [
-        (target11, {attrname1: attrval1, attrname2: attrval2})
-        (target12, {attrname1: attrval1, attrname2: attrval2})
-    ]}
-    {rel2: [
-        (target21, {attrname1: attrval1, attrname2: attrval2})
-        (target22, {attrname1: attrval1, attrname2: attrval2})
-    ]}
+    [rel1, [
+        [target11, {attrname1: attrval1, attrname2: attrval2}, link ID],
+        [target12, {attrname1: attrval1, attrname2: attrval2}, link ID],
+    ]],
+    [rel2, [
+        [target21, {attrname1: attrval1, attrname2: attrval2}, link ID],
+        [target22, {attrname1: attrval1, attrname2: attrval2}, link ID],
+    ]],
 ]
 
+Rels & targets are encoded terms, e.g. with IRI prefixes abbreviated (see versa.driver.abbreviations)
+
+Link IDs are integers assigned in sequence as links are added, and stored with them,
+so they're known however a link is found, and don't change as other links are added
+
 Re use of use_bin_type=True & raw=False it's as given in the msgpack docs:
 
 >>> import msgpack
@@ -28,6 +33,8 @@ Re use of use_bin_type=True & raw=False it's as given in the msgpack docs:
 '''
 
 import functools
+import hashlib
+from itertools import islice
 #from itertools import groupby
 #from operator import itemgetter
 
@@ -36,38 +43,164 @@ import msgpack
 
 from amara3 import iri #for absolutize & matches_uri_syntax
 
-from versa.driver import connection_base
+from versa.driver import connection_base, _pattern_parts
+from versa.driver.abbreviations import abbreviation_cache, split_iri, term_key, legacy_expander
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
 #1GB
 DEFAULT_MAP_SIZE = 1024 * 1024 * 1024
 
+#Max number of links add_many writes per transaction
+DEFAULT_BATCH_SIZE = 50000
+
+ABBREVIATIONS_KEY = b'@_abbreviations'
+#Bumped whenever the abbreviations map changes, so connections know when to reload it
+ABBREVIATIONS_GEN_KEY = b'@_abbreviations_gen'
+
+#Next link ID to be assigned. Present once the links in the DB have their IDs stored
+LINK_IDS_KEY = b'@_link_ids'
+
+#Counts of links, origins & links per rel, maintained on every write
+#so they needn't be worked out by scanning the DB
+COUNTS_KEY = b'@_counts'
+
+#Optional secondary indexes, as named sub-databases (which LMDB records as keys
+#in the main DB, hence the '@' prefix, so they're skipped like other meta items)
+#Rel to origins, and target to origins
+REL_INDEX_DB = b'@_rel_index'
+TARGET_INDEX_DB = b'@_target_index'
+#Present if the DB has secondary indexes, which must then always be maintained
+INDEXED_KEY = b'@_indexed'
 
-def newmodel(dbname, baseiri=None, map_size=DEFAULT_MAP_SIZE):
+#LMDB's default limit on the size of keys, and of values in sorted-duplicate DBs
+MAX_KEY_SIZE = 511
+
+
+def _index_key(term):
+    '''
+    Key for a (stored form) rel or target in a secondary index. Hashed if too long
+    for LMDB, so there might be false positives, but lookups always check full values.
+    0xc1 is never used in msgpack, so hashed keys can't clash with others
+    '''
+    key = msgpack.dumps(term, use_bin_type=True)
+    if len(key) > MAX_KEY_SIZE:
+        key = b'\xc1' + hashlib.sha256(key).digest()
+    return key
+
+
+def newmodel(dbname, baseiri=None, map_size=DEFAULT_MAP_SIZE, indexed=False):
     '''
     Return a new, empty Versa model with lmdb back end
     Warning: if there is data already in this file, it will be erased.
     '''
     # XXX Mandate mapsize?
-    model = connection(dbname=dbname, baseiri=baseiri, clear=True, map_size=map_size)
+    model = connection(dbname=dbname, baseiri=baseiri, clear=True, map_size=map_size, indexed=indexed)
     return model
 
 
 class connection(connection_base):
-    def __init__(self, dbname=None, baseiri=None, map_size=DEFAULT_MAP_SIZE, clear=False):
+    def __init__(self, dbname=None, baseiri=None, map_size=DEFAULT_MAP_SIZE, clear=False, indexed=False):
         '''
-        Versa connection object built from DiskCache collection object
+        Versa connection object built from LMDB environment
+
+        indexed - if True maintain secondary indexes from rels & from targets to origins,
+            so that match() without an origin needn't scan the whole DB. Indexes are built
+            for any existing data. Once a DB has been indexed they're always maintained,
+            regardless of this flag
         '''
         self._dbname = dbname
-        self._db_env = lmdb.open(dbname, map_size=map_size)
-        #if clear: self._db.clear()
+        self._db_env = lmdb.open(dbname, map_size=map_size, max_dbs=2)
+        self._abbr_cache = abbreviation_cache()
+        self._rel_index = self._target_index = None
         with self._db_env.begin(write=True) as txn:
+            if clear: self._clear(txn)
             self._ensure_abbreviations(txn)
+            migrated = self._migrate(txn)
+            if txn.get(LINK_IDS_KEY) is None:
+                self._assign_link_ids(txn)
+            if txn.get(COUNTS_KEY) is None:
+                self._recount(txn)
+            if indexed or txn.get(INDEXED_KEY) is not None:
+                self._rel_index = self._db_env.open_db(REL_INDEX_DB, txn=txn, dupsort=True)
+                self._target_index = self._db_env.open_db(TARGET_INDEX_DB, txn=txn, dupsort=True)
+                if txn.get(INDEXED_KEY) is None or migrated:
+                    txn.drop(self._rel_index, delete=False)
+                    txn.drop(self._target_index, delete=False)
+                    self._build_indexes(txn)
+                    txn.put(INDEXED_KEY, b'1')
         #self.create_model()
         self._baseiri = baseiri
-        self._abbr_index = 0
         return
 
+    def _clear(self, txn):
+        '''Remove all data, including any secondary indexes'''
+        for name in (REL_INDEX_DB, TARGET_INDEX_DB):
+            try:
+                txn.drop(self._db_env.open_db(name, txn=txn, create=False, dupsort=True), delete=False)
+            except lmdb.NotFoundError:
+                pass
+        # Records of the named sub-databases themselves have to stay in place
+        with txn.cursor() as cursor:
+            keys = [ k for k in cursor.iternext(values=False) if k not in (REL_INDEX_DB, TARGET_INDEX_DB) ]
+        for k in keys:
+            txn.delete(k)
+        return
+
+    def _index_links(self, txn, origin_b, nodedata):
+        '''Add links, in stored form, to the secondary indexes'''
+        for rel, targetplus in nodedata:
+            txn.put(_index_key(rel), origin_b, db=self._rel_index)
+            for target, attrs, link_id in targetplus:
+                txn.put(_index_key(target), origin_b, db=self._target_index)
+        return
+
+    def _assign_link_ids(self, txn):
+        '''
+        Give any links stored without IDs, e.g. in a DB from before they were stored,
+        IDs by their position in the DB (origins in key order), which is what their
+        IDs used to be. Done in place, in one transaction
+        '''
+        next_id = 0
+        with txn.cursor() as cursor:
+            origins = [ k for k in cursor.iternext(values=False) if not k.startswith(b'@') ]
+        for origin_b in origins:
+            nodedata = msgpack.loads(txn.get(origin_b), raw=False)
+            for rel, targetplus in nodedata:
+                for entry in targetplus:
+                    entry[2:] = [next_id]
+                    next_id += 1
+            txn.put(origin_b, msgpack.dumps(nodedata, use_bin_type=True))
+        txn.put(LINK_IDS_KEY, msgpack.dumps(next_id))
+        return
+
+    def _build_indexes(self, txn):
+        '''Build secondary indexes over all data in the DB'''
+        for origin_b, nodedata in txn.cursor():
+            if origin_b.startswith(b'@'):
+                continue
+            self._index_links(txn, origin_b, msgpack.loads(nodedata, raw=False))
+        return
+
+    def _index_extent(self, txn, rel, target):
+        '''
+        List of (origin key, node data) for just the origins which, according to the
+        secondary indexes, have links with the given target, or if none given, rel.
+        Returns None if the indexes can't help
+        '''
+        if self._rel_index is None or not (rel or target):
+            return None
+        if target:
+            term, db = self._abbr_cache.lookup(target), self._target_index
+        else:
+            term, db = self._abbr_cache.lookup(rel), self._rel_index
+        if term is None:
+            return []
+        with txn.cursor(db=db) as cursor:
+            if not cursor.set_key(_index_key(term)):
+                return []
+            origins = list(cursor.iternext_dup())
+        return [ (origin_b, txn.get(origin_b)) for origin_b in origins ]
+
     def copy(self, contents=True):
         '''Create a copy of this model, optionally without contents (i.e. just configuration)'''
         cp = connection(dbname=self._dbname, baseiri=self._baseiri)
@@ -81,39 +214,55 @@ class connection(connection_base):
 
     def size(self):
         '''Return the number of links in the model'''
-        count = 0
         with self._db_env.begin() as txn:
-            for origin_b, nodedata in txn.cursor():
-                if origin_b.startswith(b'@'):
-                    continue
-                nodedata = msgpack.loads(nodedata, raw=False)
-                for rel, targetplus in nodedata.items():
-                    count += len(targetplus)
-        return count
-        #return  self._db_coll.count() - connection.META_ITEM_COUNT
+            return self._counts(txn)['links']
 
-    def __iter__(self):
-        abbrevs = self._abbreviations()
-        cursor = self._db_coll.find()
-        index = 0
-        for origin in self._db:
-            if origin.startswith('@'):
+    def __len__(self):
+        '''Return the number of links in the model'''
+        return self.size()
+
+    def origin_count(self):
+        '''Return the number of distinct origins in the model'''
+        with self._db_env.begin() as txn:
+            return self._counts(txn)['origins']
+
+    def rel_counts(self):
+        '''Return a mapping from each rel in the model to its number of links'''
+        with self._db_env.begin() as txn:
+            return self._counts(txn)['rels']
+
+    def _counts(self, txn):
+        return msgpack.loads(txn.get(COUNTS_KEY), raw=False)
+
+    def _update_counts(self, txn, links, origins, rels):
+        '''Add to the stored counts, within a write transaction'''
+        counts = self._counts(txn)
+        counts['links'] += links
+        counts['origins'] += origins
+        for rel, count in rels.items():
+            counts['rels'][rel] = counts['rels'].get(rel, 0) + count
+        txn.put(COUNTS_KEY, msgpack.dumps(counts, use_bin_type=True))
+        return
+
+    def _recount(self, txn):
+        '''Work out the counts by scanning the whole DB, e.g. for one from before they were kept'''
+        self._abbreviations(txn)
+        expand = self._abbr_cache.expand
+        counts = {'links': 0, 'origins': 0, 'rels': {}}
+        for origin_b, nodedata in txn.cursor():
+            if origin_b.startswith(b'@'):
                 continue
-            for rel, targetplus in self._db[origin].items():
-                try:
-                    rel = rel.format(**abbrevs)
-                except (KeyError, ValueError):
-                    pass
-                count += len(targetplus)
-                for target, attribs in targetplus:
-                    try:
-                        target = target.format(**abbrevs)
-                    except (KeyError, ValueError):
-                        pass
-                    yield index, (origin, rel, target, attribs)
-                    index += 1
-
-    # FIXME: Statement indices don't work sensibly without some inefficient additions. Use e.g. match for delete instead
+            counts['origins'] += 1
+            for rel, targetplus in msgpack.loads(nodedata, raw=False):
+                rel = expand(rel)
+                counts['links'] += len(targetplus)
+                counts['rels'][rel] = counts['rels'].get(rel, 0) + len(targetplus)
+        txn.put(COUNTS_KEY, msgpack.dumps(counts, use_bin_type=True))
+        return
+
+    def __iter__(self):
+        yield from self.match(include_ids=True)
+
     def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
         Iterator over relationship IDs that match a pattern of components
@@ -122,49 +271,66 @@ class connection(connection_base):
         rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
         target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
-        include_ids - If true include statement IDs with yield values
+        include_ids - If true include statement IDs with yield values. These are the link IDs
+            stored with each link, so they're the same whichever way the links are found
         '''
-        index = 0
         with self._db_env.begin() as txn:
-            abbrevs = self._abbreviations(txn)
-            if origin is None:
+            self._abbreviations(txn)
+            yield from self._match(txn, origin, rel, target, attrs, include_ids)
+        return
+
+    def match_many(self, patterns, include_ids=False):
+        '''
+        Retrieve the relationships matching each of a list of patterns (see connection_base.match_many)
+
+        All in one read transaction, so the results are from a single, consistent snapshot
+        '''
+        with self._db_env.begin() as txn:
+            self._abbreviations(txn)
+            return [ list(self._match(txn, *_pattern_parts(p), include_ids=include_ids)) for p in patterns ]
+
+    def _match(self, txn, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Iterator over the relationships that match a pattern, within a read transaction.
+        Assumes the abbreviations cache has been refreshed within it
+        '''
+        expand = self._abbr_cache.expand
+        # Compare stored forms, so only matching links need be decoded
+        rel_term = self._abbr_cache.lookup(rel) if rel else None
+        target_term = self._abbr_cache.lookup(target) if target else None
+        if (rel and rel_term is None) or (target and target_term is None):
+            return
+        if origin is None:
+            extent = self._index_extent(txn, rel, target)
+            if extent is None:
                 extent = txn.cursor()
-            else:
-                origin_b = origin.encode('utf-8')
-                extent = [(origin_b, txn.get(origin_b))]
+        else:
+            origin_b = origin.encode('utf-8')
+            extent = [(origin_b, txn.get(origin_b))]
 
-            for origin_b, nodedata in extent:
-                if origin_b.startswith(b'@') or nodedata is None:
+        for origin_b, nodedata in extent:
+            if origin_b.startswith(b'@') or nodedata is None:
+                continue
+            xorigin = origin_b.decode('utf-8')
+            nodedata = msgpack.loads(nodedata, raw=False)
+            for xrel, xtargetplus in nodedata:
+                if rel and rel_term != xrel:
                     continue
-                xorigin = origin_b.decode('utf-8')
-                nodedata = msgpack.loads(nodedata, raw=False)
-                for xrel, xtargetplus in nodedata.items():
-                    try:
-                        xrel = xrel.format(**abbrevs)
-                    except (KeyError, ValueError):
-                        pass
-                    if rel and rel != xrel:
+                xrel = expand(xrel)
+                for xtarget, xattrs, link_id in xtargetplus:
+                    if target and target_term != xtarget:
                         continue
-                    for xtarget, xattrs in xtargetplus:
-                        index += 1
-                        # FIXME: only expand target abbrevs if of resource type?
-                        try:
-                            xtarget = xtarget.format(**abbrevs)
-                        except (KeyError, ValueError, IndexError):
-                            pass
-                        if target and target != xtarget:
-                            continue
-                        matches = True
-                        if attrs:
-                            for k, v in attrs.items():
-                                if k not in xattrs or xattrs.get(k) != v:
-                                    matches = False
-                        if matches:
-                            if include_ids:
-                                yield index, (xorigin, xrel, xtarget, xattrs)
-                            else:
-                                yield xorigin, xrel, xtarget, xattrs
-
+                    xtarget = expand(xtarget)
+                    matches = True
+                    if attrs:
+                        for k, v in attrs.items():
+                            if k not in xattrs or xattrs.get(k) != v:
+                                matches = False
+                    if matches:
+                        if include_ids:
+                            yield link_id, (xorigin, xrel, xtarget, xattrs)
+                        else:
+                            yield xorigin, xrel, xtarget, xattrs
         return
 
     def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
@@ -209,26 +375,16 @@ class connection(connection_base):
         target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
         '''
-        if not origin: 
-            raise ValueError('Relationship origin cannot be null')
-        if not rel: 
-            raise ValueError('Relationship ID cannot be null')
-
-        attrs = attrs or {}
-
-        with self._db_env.begin(write=True) as txn:
-            rel = self._abbreviate(rel, txn)
-            target = self._abbreviate(target, txn)
-            nodedata = txn.get(origin.encode('utf-8'))
-            if nodedata is None:
-                nodedata = {rel: [[target, attrs]]}
-            else:
-                nodedata = msgpack.loads(nodedata, raw=False)
-                nodedata.setdefault(rel, []).append([target, attrs])
-            txn.put(origin.encode('utf-8'), msgpack.dumps(nodedata, use_bin_type=True))
+        try:
+            with self._db_env.begin(write=True) as txn:
+                self._add_links(txn, [(origin, rel, target, attrs)])
+        except Exception:
+            # Any abbreviations added in the aborted transaction are gone
+            self._abbr_cache.invalidate()
+            raise
         return
 
-    def add_many(self, rels):
+    def add_many(self, rels, batch_size=DEFAULT_BATCH_SIZE):
         '''
         Add a list of relationships to the extent
 
@@ -241,7 +397,37 @@ class connection(connection_base):
         rel - type IRI of the relationship (similar to an RDF predicate)
         target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+        batch_size - max number of relationships to write in each transaction
+
+        Relationships are grouped by origin, so each origin's stored data is
+        decoded & re-encoded just once per batch. Input sorted by origin is
+        loaded fastest.
         '''
+        rels = iter(rels)
+        while True:
+            batch = list(islice(rels, batch_size))
+            if not batch:
+                break
+            try:
+                with self._db_env.begin(write=True) as txn:
+                    self._add_links(txn, batch)
+            except Exception:
+                # Any abbreviations added in the aborted transaction are gone
+                self._abbr_cache.invalidate()
+                raise
+        return
+
+    def _add_links(self, txn, rels):
+        '''
+        Add relationships to the model within a write transaction,
+        merging each origin's stored data only once
+        '''
+        # No other writer can change the abbreviations during this transaction
+        self._abbreviations(txn)
+        # Origin key to its new links, in the same structure as stored
+        grouped = {}
+        rel_counts = {}
+        next_id = msgpack.loads(txn.get(LINK_IDS_KEY))
         for curr_rel in rels:
             attrs = {}
             if len(curr_rel) == 3:
@@ -250,7 +436,47 @@ class connection(connection_base):
                 origin, rel, target, attrs = curr_rel
             else:
                 raise ValueError
-            self.add(origin, rel, target, attrs)
+            if not origin:
+                raise ValueError('Relationship origin cannot be null')
+            if not rel:
+                raise ValueError('Relationship ID cannot be null')
+            attrs = attrs or {}
+            rel_counts[rel] = rel_counts.get(rel, 0) + 1
+            rel = self._abbreviate(rel, txn)
+            target = self._abbreviate(target, txn)
+            newdata = grouped.setdefault(origin.encode('utf-8'), {})
+            newdata.setdefault(term_key(rel), [rel, []])[1].append([target, attrs, next_id])
+            next_id += 1
+        txn.put(LINK_IDS_KEY, msgpack.dumps(next_id))
+
+        if self._rel_index is not None:
+            for origin_b, newdata in grouped.items():
+                self._index_links(txn, origin_b, newdata.values())
+
+        new_items = []
+        for origin_b, newdata in grouped.items():
+            nodedata = txn.get(origin_b)
+            if nodedata is None:
+                new_items.append((origin_b, msgpack.dumps(list(newdata.values()), use_bin_type=True)))
+                continue
+            nodedata = msgpack.loads(nodedata, raw=False)
+            existing = { term_key(rel): targetplus for rel, targetplus in nodedata }
+            for key, (rel, targetplus) in newdata.items():
+                if key in existing:
+                    existing[key].extend(targetplus)
+                else:
+                    nodedata.append([rel, targetplus])
+            txn.put(origin_b, msgpack.dumps(nodedata, use_bin_type=True))
+
+        # Origins not yet in the DB can go in all at once, and if they all sort
+        # after the existing keys LMDB can simply append them
+        if new_items:
+            new_items.sort()
+            with txn.cursor() as cursor:
+                append = not cursor.last() or cursor.key() < new_items[0][0]
+                cursor.putmulti(new_items, append=append)
+
+        self._update_counts(txn, len(rels), len(new_items), rel_counts)
         return
 
     #FIXME: Replace with a match_to_remove method
@@ -276,39 +502,72 @@ class connection(connection_base):
         return repr(other) == repr(self)
 
     def _abbreviations(self, txn):
-        prefix_map = txn.get(b'@_abbreviations')
-        prefix_map = msgpack.loads(prefix_map, raw=False)
-        return prefix_map
-        
-    def _abbreviate(self, rid, txn):
         '''
-        Abbreviate a relationship or resource ID target for efficient storage
-        in the DB. Works only with a prefix/suffix split of hierarchical HTTP-like IRIs,
-        e.g. 'http://example.org/spam/eggs' becomes something like '{a23}eggs'
-        and afterward there will be an entry in the prefix map from 'a23' to 'http://example.org/spam/'
-        The map can then easily be used with str.format
+        Return the list of IRI prefixes, as of the given transaction.
+        Only decoded from the DB if it has changed since last used
         '''
-        if not isinstance(rid, str) or '/' not in rid or not iri.matches_uri_syntax(rid):
-            return rid
-        head, tail = rid.rsplit('/', 1)
-        head += '/'
-        prefix_map = txn.get(b'@_abbreviations')
-        assert prefix_map is not None
-        prefix_map = msgpack.loads(prefix_map, raw=False)
-        #FIXME: probably called too often to do this every time
-        inv_prefix_map = {v: k for k, v in prefix_map.items()}
-        if head in inv_prefix_map:
-            prefix = inv_prefix_map[head]
-        else:
-            prefix = f'a{self._abbr_index}'
-            prefix_map[prefix] = head
-            self._abbr_index += 1
-            txn.put(b'@_abbreviations', msgpack.dumps(prefix_map, use_bin_type=True))
-        post_rid = '{' + prefix + '}' + tail.replace('{', '{{').replace('}', '}}')
-        return post_rid
-        
+        gen = txn.get(ABBREVIATIONS_GEN_KEY)
+        gen = 0 if gen is None else msgpack.loads(gen)
+        return self._abbr_cache.refresh(gen, lambda: msgpack.loads(txn.get(ABBREVIATIONS_KEY), raw=False))
+
+    def _abbreviate(self, val, txn):
+        '''
+        Encode a relationship or target for efficient storage in the DB.
+        Hierarchical HTTP-like IRIs are split into prefix & tail,
+        e.g. 'http://example.org/spam/eggs' becomes something like [23, 'eggs']
+        and afterward there will be an entry 23 in the prefix list for 'http://example.org/spam/'
+
+        Assumes the abbreviations cache has been refreshed within txn, a write transaction
+        '''
+        term = self._abbr_cache.lookup(val)
+        if term is None:
+            head, tail = split_iri(val)
+            term = [self._abbr_cache.add(head), tail]
+            self._save_abbreviations(txn)
+        return term
+
+    def _save_abbreviations(self, txn):
+        txn.put(ABBREVIATIONS_KEY, msgpack.dumps(self._abbr_cache.prefixes, use_bin_type=True))
+        txn.put(ABBREVIATIONS_GEN_KEY, msgpack.dumps(self._abbr_cache.generation))
+        return
+
     def _ensure_abbreviations(self, txn):
-        txn.put(b'@_abbreviations', msgpack.dumps({}))
+        if txn.get(ABBREVIATIONS_KEY) is None:
+            txn.put(ABBREVIATIONS_KEY, msgpack.dumps([]))
+        return
+
+    def _migrate(self, txn):
+        '''
+        Convert a DB from the old storage format, with rels & targets such as '{a23}eggs'
+        expanded through str.format, to the current one. Done in place, in one transaction
+
+        returns True if there was anything to convert
+        '''
+        legacy_map = msgpack.loads(txn.get(ABBREVIATIONS_KEY), raw=False)
+        if not isinstance(legacy_map, dict):
+            return False
+        expand = legacy_expander(legacy_map)
+        gen = txn.get(ABBREVIATIONS_GEN_KEY)
+        gen = 0 if gen is None else msgpack.loads(gen)
+        self._abbr_cache.invalidate()
+        self._abbr_cache.refresh(gen, list)
+        with txn.cursor() as cursor:
+            origins = [ k for k in cursor.iternext(values=False) if not k.startswith(b'@') ]
+        for origin_b in origins:
+            nodedata = msgpack.loads(txn.get(origin_b), raw=False)
+            nodedata = [
+                [self._abbreviate(expand(rel), txn), [
+                    [self._abbreviate(expand(target), txn), attrs] for target, attrs in targetplus
+                ]] for rel, targetplus in nodedata.items()
+            ]
+            txn.put(origin_b, msgpack.dumps(nodedata, use_bin_type=True))
+        # Bump the generation even if there were no prefixes, so other connections reload
+        self._abbr_cache.generation += 1
+        self._save_abbreviations(txn)
+        return True
+
+    def close(self):
+        self._db_env.close()
         return
 
     def __del__(self):
@@ -7,6 +7,12 @@
 
 The optional attributes are metadata bound to the statement itself
 
+Links are indexed by origin, rel, target & (origin, rel), and have hashed keys for
+duplicate checks, so lookups & adds take about constant time, but these take memory
+of their own. For example 100,000 links, of 20,000 origins & 10 rels, take about
+930-960 bytes per link, including the values, against about 410 for the bare link
+tuples & attribute dicts. Where memory matters more, see versa.driver.columnar
+
 '''
 
 #Note: for PyPy support port to pg8000 <http://pybrary.net/pg8000/>
@@ -14,32 +20,172 @@ The optional attributes are metadata bound to the statement itself
 
 import logging
 import functools
+import heapq
+from array import array
+from operator import methodcaller
+from types import MappingProxyType
+from collections import OrderedDict
 #from itertools import groupby
 #from operator import itemgetter
 from amara3 import iri #for absolutize & matches_uri_syntax
 
 from versa.driver import connection_base
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
+from versa.util import make_immutable
+
+__all__ = ['connection', 'frozen', 'newmodel']
+
+# Tags which keep canonicalized containers apart, as equality (==) does, e.g. [1, 2] != (1, 2)
+_LIST_TAG = object()
+_TUPLE_TAG = object()
+_DICT_TAG = object()
+_ORDERED_DICT_TAG = object()
+
+# Key of the (very common) empty attributes, shared rather than built for each link
+_NO_ATTRS_KEY = (_DICT_TAG, frozenset())
+
+# Index key shared by all targets which can't be hashed, even canonicalized, e.g. custom
+# objects, so that lookups fall back to checking each of them for equality
+_UNHASHABLE = object()
+
+
+def _hashable(val):
+    '''
+    Return a value usable as an index key, canonicalizing unhashable
+    link targets such as lists or dicts. Unequal values always have different keys.
+    Equal ones have the same key, except e.g. for an OrderedDict & a dict with the
+    same items: dicts compare regardless of order, but OrderedDicts in order.
+    Raises TypeError if the value can't be made hashable, e.g. a custom object
+    '''
+    try:
+        hash(val)
+    except TypeError:
+        pass
+    else:
+        return val
+    if isinstance(val, OrderedDict):
+        return (_ORDERED_DICT_TAG, tuple((k, _hashable(v)) for k, v in val.items()))
+    if isinstance(val, dict):
+        return (_DICT_TAG, frozenset((k, _hashable(v)) for k, v in val.items()))
+    if isinstance(val, set):
+        # Compares equal to a frozenset with the same items, as the set does
+        return frozenset(val)
+    if isinstance(val, list):
+        return (_LIST_TAG, tuple(map(_hashable, val)))
+    if isinstance(val, tuple):
+        return (_TUPLE_TAG, tuple(map(_hashable, val)))
+    val = make_immutable(val)
+    hash(val)
+    return val
+
+
+def _index_key(val):
+    '''Target index key for a value, as _hashable, or _UNHASHABLE if there's none'''
+    try:
+        return _hashable(val)
+    except TypeError:
+        return _UNHASHABLE
+
+
+def _link_key(item):
+    '''
+    Hashable stand-in for a link, for constant time duplicate checks, or None if
+    it has no such key, e.g. with a custom object target. Links with the same key
+    are equal (==). Attributes keep their order if they're ordered, e.g. attr_cls=OrderedDict
+    '''
+    origin, rel, target, attrs = item
+    try:
+        return (origin, rel, _hashable(target), _hashable(attrs) if attrs else _NO_ATTRS_KEY)
+    except TypeError:
+        return None
+
+
+def _index_add(index, key, pos):
+    '''
+    Add a link position to a hash index. A key with one link has its position
+    as a plain int, only promoted to an array of positions once it has more,
+    which takes far less memory than a list of int objects per key
+    '''
+    curr = index.get(key)
+    if curr is None:
+        index[key] = pos
+    elif type(curr) is int:
+        index[key] = array('l', (curr, pos))
+    else:
+        curr.append(pos)
+    return
 
-__all__ = ['connection', 'newmodel']
 
-def newmodel(name=None, baseiri=None, attr_cls=dict):
+def _index_get(index, key):
+    '''Sequence of link positions for a key in a hash index, in ascending order'''
+    curr = index.get(key, ())
+    return (curr,) if type(curr) is int else curr
+
+
+def _index_copy(index):
+    '''Copy of a hash index, sharing none of its arrays'''
+    return { k: v if type(v) is int else array('l', v) for k, v in index.items() }
+
+
+def _canonical_repr(links):
+    '''
+    Canonical representation of a sequence of links, used for equivalence testing in test cases
+    '''
+    import json
+    from versa.util import OrderedJsonEncoder
+
+    # Simple canonicalization of attributes for model sorting purposes
+    # when model constructed with OrderedDict instances for attributes
+    # (via attr_cls). Not canonical if only dict is used.
+    # FIXME this doesn'yet handle the case of irirefs as keys or values
+    # in the attributes
+    rel_repr = functools.partial(json.dumps, cls=OrderedJsonEncoder)
+
+    # rebuilding _relationships with sorted attributes
+    rels = []
+    for v in sorted(links, key=rel_repr):
+
+        # Mark type of target as a pseudo attribute. Doesn't mutate
+        # original Versa statement
+        if isinstance(v[2], I):
+            v = (v[0], v[1], v[2], v[3].copy())
+            v[3]['@target-type'] = '@iri-ref'
+
+        rels.append(v)
+
+    return json.dumps(rels, indent=4, cls=OrderedJsonEncoder)
+
+
+# Attributes holding a connection's links & indexes, which copies share until changed
+_STORAGE = ('_relationships', '_tombstones', '_link_keys', '_origin_index', '_rel_index',
+            '_target_index', '_origin_rel_index', '_id_counter')
+
+# How result attributes are handed out: private copies, or zero-copy, read-only views
+_copy_attrs = methodcaller('copy')
+_view_attrs = MappingProxyType
+
+
+def newmodel(name=None, baseiri=None, attr_cls=dict, copy_attrs=True):
     '''
     Return new, empty in-memory Versa model
     '''
-    return connection(baseiri=baseiri, attr_cls=attr_cls)
+    return connection(baseiri=baseiri, attr_cls=attr_cls, copy_attrs=copy_attrs)
 
 
 class connection(connection_base):
-    def __init__(self, baseiri=None, attr_cls=dict):
+    def __init__(self, baseiri=None, attr_cls=dict, copy_attrs=True):
         '''
         Initialize connection object
             
         Args:
             baseiri: IRI used by default to resolve relative IRIs
             attr_cls: class used to hold relationship attributes. By default use dict
+            copy_attrs: if True (the default) links from match(), iteration, etc. come with
+                a copy of their attributes, which the caller is free to modify. If False they
+                come with a read-only view of the stored attributes, saving a copy per link
         '''
         self._attr_cls = attr_cls
+        self._copy_attrs = copy_attrs
         self.create_space()
         self._baseiri = baseiri
         self._id_counter = 1
@@ -47,21 +193,166 @@ class connection(connection_base):
         return
 
     def copy(self, contents=True):
-        '''Create a copy of this model, optionally without contents (i.e. just configuration)'''
-        cp = connection(self._baseiri, self._attr_cls)
-        if contents: cp.add_many(self._relationships)
+        '''
+        Create a copy of this model, optionally without contents (i.e. just configuration)
 
+        The copy shares the links & indexes with this model (copy-on-write) until
+        either of them is changed, so making it is cheap regardless of size
+        '''
+        cp = connection(self._baseiri, self._attr_cls, self._copy_attrs)
+        if contents: self._share_into(cp)
         return cp
 
+    def snapshot(self):
+        '''
+        Return a read-only view of the model as it is now, unaffected by any later changes
+        to the model. Like copy() it shares storage, so it's cheap, and as it never changes
+        it's safe to hand to readers in parallel threads
+        '''
+        snap = frozen(self._baseiri, self._attr_cls, self._copy_attrs)
+        self._share_into(snap)
+        return snap
+
+    def _share_into(self, other):
+        '''Give another connection the same contents, sharing this one's storage until either changes'''
+        other._sharers[0] -= 1
+        for name in _STORAGE:
+            setattr(other, name, getattr(self, name))
+        self._sharers[0] += 1
+        other._sharers = self._sharers
+        return
+
+    def _unshare(self):
+        '''
+        Before any change to the storage, take a private copy of it if it's shared
+        with other connections (copies or snapshots)
+        '''
+        if self._sharers[0] > 1:
+            self._sharers[0] -= 1
+            self._sharers = [1]
+            self._relationships = list(self._relationships)
+            self._link_keys = set(self._link_keys)
+            self._origin_index = _index_copy(self._origin_index)
+            self._rel_index = _index_copy(self._rel_index)
+            self._target_index = _index_copy(self._target_index)
+            self._origin_rel_index = _index_copy(self._origin_rel_index)
+        return
+
+    def __del__(self):
+        # No longer sharing storage, so the others needn't copy it before changes
+        sharers = getattr(self, '_sharers', None)
+        if sharers: sharers[0] -= 1
+
     def create_space(self):
         '''Set up a new table space for the first time'''
+        if hasattr(self, '_sharers'): self._sharers[0] -= 1
+        # Number of connections sharing this storage (see copy())
+        self._sharers = [1]
+        # Removed links are left in place as None (tombstones) until compact(),
+        # so that link positions, which serve as IDs, remain stable
         self._relationships = []
+        self._tombstones = 0
+        # Keys of all links in _relationships, for fast rejection of dupes
+        self._link_keys = set()
+        # Hash indexes from link components to positions in _relationships (see _index_add),
+        # always kept in ascending order so index lookups preserve insertion order
+        self._origin_index = {}
+        self._rel_index = {}
+        self._target_index = {}
+        self._origin_rel_index = {}
         self._id_counter = 1
         return
 
     def drop_space(self):
         '''Dismantle an existing table space'''
-        create_space(self)
+        self.create_space()
+        return
+
+    def _index_link(self, pos, item):
+        '''Record a link at the given position in the hash indexes'''
+        origin, rel, target = item[ORIGIN], item[RELATIONSHIP], _index_key(item[TARGET])
+        _index_add(self._origin_index, origin, pos)
+        _index_add(self._rel_index, rel, pos)
+        _index_add(self._target_index, target, pos)
+        _index_add(self._origin_rel_index, (origin, rel), pos)
+        return
+
+    def _reindex(self):
+        '''Rebuild the hash indexes, e.g. after link positions have shifted'''
+        self._origin_index = {}
+        self._rel_index = {}
+        self._target_index = {}
+        self._origin_rel_index = {}
+        for pos, item in enumerate(self._relationships):
+            if item is not None:
+                self._index_link(pos, item)
+        return
+
+    def compact(self):
+        '''
+        Reclaim the space taken up by removed links. Note: this changes the IDs of links
+        added after the earliest removed one
+        '''
+        if self._tombstones:
+            self._unshare()
+            self._relationships = [ r for r in self._relationships if r is not None ]
+            self._tombstones = 0
+            self._reindex()
+        return
+
+    def _candidates(self, origin=None, rel=None, target=None):
+        '''
+        Iterator over (position, link) pairs which might match the given components,
+        in insertion order. Uses the narrowest applicable index, falling back to a full
+        scan if no component is given. Callers must still check each link for a match.
+        '''
+        rels = self._relationships
+        positions = []
+        if origin and rel:
+            positions.append(_index_get(self._origin_rel_index, (origin, rel)))
+        elif origin:
+            positions.append(_index_get(self._origin_index, origin))
+        elif rel:
+            positions.append(_index_get(self._rel_index, rel))
+        if target:
+            positions.append(_index_get(self._target_index, _index_key(target)))
+
+        if not positions:
+            for pos, link in enumerate(rels):
+                if link is not None:
+                    yield pos, link
+            return
+        for pos in min(positions, key=len):
+            link = rels[pos]
+            if link is not None:
+                yield pos, link
+        return
+
+    def _multi_candidates(self, origin=None, rel=None, target=None):
+        '''
+        Like _candidates, but each component is a set of alternative values
+        '''
+        rels = self._relationships
+        positions = []
+        for values, index, key in ((origin, self._origin_index, None),
+                                    (rel, self._rel_index, None),
+                                    (target, self._target_index, _index_key)):
+            if values:
+                keys = values if key is None else map(key, values)
+                positions.append([ _index_get(index, k) for k in keys if k in index ])
+
+        if not positions:
+            for pos, link in enumerate(rels):
+                if link is not None:
+                    yield pos, link
+            return
+        # The position lists for different values of a component never overlap,
+        # so merging them keeps insertion order without any dupes
+        plists = min(positions, key=lambda pl: sum(map(len, pl)))
+        for pos in heapq.merge(*plists):
+            link = rels[pos]
+            if link is not None:
+                yield pos, link
         return
 
     def query(self, expr):
@@ -70,19 +361,26 @@ class connection(connection_base):
 
     def __len__(self):
         '''Return number of links in the model'''
-        return len(self._relationships)
+        return len(self._relationships) - self._tombstones
 
     # XXX Obsolete?
     def size(self):
         '''Return the number of links in the model'''
-        return len(self._relationships)
+        return len(self._relationships) - self._tombstones
+
+    def _attrs_out(self, copy_attrs):
+        '''Function to prepare stored attributes for handing out, per the copy_attrs setting'''
+        if copy_attrs is None: copy_attrs = self._copy_attrs
+        return _copy_attrs if copy_attrs else _view_attrs
 
     def __iter__(self):
-        for index, rel in enumerate(self._relationships): yield index, (rel[0], rel[1], rel[2], rel[3].copy())
+        attrs_out = self._attrs_out(None)
+        for index, rel in enumerate(self._relationships):
+            if rel is not None: yield index, (rel[0], rel[1], rel[2], attrs_out(rel[3]))
 
     #FIXME: For performance make each link an iterator, so that slice/copy isn't necessary?
 
-    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False, copy_attrs=None):
         '''
         Iterator over relationship IDs that match a pattern of components
 
@@ -91,9 +389,11 @@ class connection(connection_base):
         target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
         include_ids - If true include statement IDs with yield values
+        copy_attrs - (optional) overrides the connection's copy_attrs setting for this call
         '''
+        attrs_out = self._attrs_out(copy_attrs)
         #Can't use items or we risk client side RuntimeError: dictionary changed size during iteration
-        for index, curr_rel in enumerate(self._relationships):
+        for index, curr_rel in self._candidates(origin, rel, target):
             matches = True
             if origin and origin != curr_rel[ORIGIN]:
                 matches = False
@@ -110,13 +410,13 @@ class connection(connection_base):
                         matches = False
             if matches:
                 if include_ids:
-                    yield index, (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+                    yield index, (curr_rel[0], curr_rel[1], curr_rel[2], attrs_out(curr_rel[3]))
                 else:
-                    yield (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+                    yield (curr_rel[0], curr_rel[1], curr_rel[2], attrs_out(curr_rel[3]))
         return
 
 
-    def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+    def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False, copy_attrs=None):
         '''
         Iterator over relationship IDs that match a pattern of components
 
@@ -125,12 +425,14 @@ class connection(connection_base):
         target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object, or set of values. If omitted any target will be matched.
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
         include_ids - If true include statement IDs with yield values
+        copy_attrs - (optional) overrides the connection's copy_attrs setting for this call
         '''
+        attrs_out = self._attrs_out(copy_attrs)
         origin = origin if origin is None or isinstance(origin, set) else set([origin])
         rel = rel if rel is None or isinstance(rel, set) else set([rel])
         target = target if target is None or isinstance(target, set) else set([target])
         #Can't use items or we risk client side RuntimeError: dictionary changed size during iteration
-        for index, curr_rel in enumerate(self._relationships):
+        for index, curr_rel in self._multi_candidates(origin, rel, target):
             matches = True
             if origin and curr_rel[ORIGIN] not in origin:
                 matches = False
@@ -144,9 +446,9 @@ class connection(connection_base):
                         matches = False
             if matches:
                 if include_ids:
-                    yield index, (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+                    yield index, (curr_rel[0], curr_rel[1], curr_rel[2], attrs_out(curr_rel[3]))
                 else:
-                    yield (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
+                    yield (curr_rel[0], curr_rel[1], curr_rel[2], attrs_out(curr_rel[3]))
         return
 
 
@@ -175,17 +477,29 @@ class connection(connection_base):
         #assert isinstance(origin, str) and isinstance(origin, str) and isinstance(origin, str) and isinstance(origin, dict), (origin, rel, target, attrs)
 
         item = (origin, rel, target, attrs)
+        item_key = _link_key(item)
 
         # Refuse dupes
-        if item in self._relationships:
+        if item_key is None:
+            # No key, so compare with the links it could be equal to
+            if any( link == item for pos, link in self._candidates(origin, rel) ):
+                return
+            self._unshare()
+        elif item_key in self._link_keys:
             return
+        else:
+            self._unshare()
+            self._link_keys.add(item_key)
 
         if index is not None:
             rid = index
             self._relationships.insert(index, item)
+            # Positions after the insertion point have all shifted
+            self._reindex()
         else:
-            rid = self.size()
+            rid = len(self._relationships)
             self._relationships.append(item)
+            self._index_link(rid, item)
         return rid
 
     def add_many(self, rels):
@@ -230,7 +544,8 @@ class connection(connection_base):
 
     def remove(self, index):
         '''
-        Delete one or more relationship, by index, from the extent
+        Delete one or more relationship, by index, from the extent. The IDs of
+        other links are not affected, until compact() is called
 
         index - either a single index or a list of indices
         '''
@@ -239,9 +554,29 @@ class connection(connection_base):
         else:
             ind = [index]
 
-        # Rebuild relationships, excluding the provided indices
-        self._relationships = [r for i, r in enumerate(self._relationships) if i not in ind]
+        self._unshare()
+        rels = self._relationships
+        for i in ind:
+            # Silently ignore IDs which don't exist, or have already been removed
+            r = rels[i] if 0 <= i < len(rels) else None
+            if r is None: continue
+            # Leave a tombstone. Index entries for it are skipped until compact()
+            rels[i] = None
+            self._tombstones += 1
+            key = _link_key(r)
+            if key is not None: self._link_keys.discard(key)
+        return
+
+    def remove_matching(self, origin=None, rel=None, target=None, attrs=None):
+        '''
+        Delete all relationships that match a pattern of components, with the same
+        semantics as match()
 
+        returns the number of relationships deleted
+        '''
+        ind = [ ix for ix, link in self.match(origin, rel, target, attrs, include_ids=True, copy_attrs=False) ]
+        self.remove(ind)
+        return len(ind)
 
     def add_iri_prefix(self, prefix):
         '''
@@ -253,39 +588,41 @@ class connection(connection_base):
 
     def close(self):
         '''Set up a new table space for the first time'''
-        self._relationships = []
+        self.create_space()
         return
 
     def __getitem__(self, i):
          r = self._relationships[i]
-         return (r[0], r[1], r[2], r[3].copy())
+         if r is None:
+             raise IndexError(f'Link {i} has been removed')
+         return (r[0], r[1], r[2], self._attrs_out(None)(r[3]))
 
     def __repr__(self):
         '''
         Canonical representation used for equivalence testing in test cases
         '''
-        import json
-        from versa.util import OrderedJsonEncoder
+        return _canonical_repr([ r for r in self._relationships if r is not None ])
 
-        # Simple canonicalization of attributes for model sorting purposes
-        # when model constructed with OrderedDict instances for attributes
-        # (via attr_cls). Not canonical if only dict is used.
-        # FIXME this doesn'yet handle the case of irirefs as keys or values
-        # in the attributes
-        rel_repr = functools.partial(json.dumps, cls=OrderedJsonEncoder)
+    def __eq__(self, other):
+        return repr(other) == repr(self)
 
-        # rebuilding _relationships with sorted attributes
-        rels = []
-        for v in sorted(self._relationships, key=rel_repr):
 
-            # Mark type of target as a pseudo attribute. Doesn't mutate
-            # original Versa statement
-            if isinstance(v[2], I):
-                v[3]['@target-type'] = '@iri-ref'
+class frozen(connection):
+    '''
+    Read-only view of a memory model, from connection.snapshot(). Any change raises TypeError.
+    copy() returns an ordinary, modifiable connection, again sharing the storage
+    '''
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('Read-only snapshot of a Versa model')
 
-            rels.append(v)
+    add = add_many = update = remove = remove_matching = compact = _read_only
 
-        return json.dumps(rels, indent=4, cls=OrderedJsonEncoder)
+    def create_space(self):
+        '''Only allowed on creation, for the initial, empty contents'''
+        if hasattr(self, '_sharers'):
+            self._read_only()
+        super().create_space()
 
-    def __eq__(self, other):
-        return repr(other) == repr(self)
+    def close(self):
+        '''Nothing to do, since the contents can't be dismantled'''
+        return
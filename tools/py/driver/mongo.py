@@ -7,6 +7,18 @@
 
 The optional attributes are metadata bound to the statement itself
 
+Each origin is a document:
+
+{
+    'origin': origin,
+    'rels': [
+        {'rid': rel1, 'instances': [[target11, {attrname1: attrval1}], [target12, {attrname1: attrval1}]]},
+        {'rid': rel2, 'instances': [[target21, {attrname1: attrval1}]]},
+    ]
+}
+
+Rels & targets are encoded terms, e.g. with IRI prefixes abbreviated (see versa.driver.abbreviations)
+
 
 Example of use, assuming a DB named 'versademo' already exists with an empty collection named model1
 
@@ -39,19 +51,161 @@ import functools
 #from operator import itemgetter
 
 from amara3 import iri #for absolutize & matches_uri_syntax
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError
 
-from versa.driver import connection_base
+from versa.driver import connection_base, _pattern_parts
+from versa.driver.abbreviations import abbreviation_cache, split_iri, term_key, legacy_expander
 from versa import I, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES
 
+#Origin of the document with the list of IRI prefixes & its generation counter
+ABBREVIATIONS_ORIGIN = '@_abbreviations'
+#Origin of the document with counts of links & origins, maintained on every write
+#so they needn't be worked out by scanning the collection
+COUNTS_ORIGIN = '@_counts'
+#Origin of the documents with counts of links per rel, one per rel
+#(rels can't be field names, since they generally contain '.')
+REL_COUNT_ORIGIN = '@_rel_count'
+#Documents with origins starting thus are meta items, not nodes
+META_ORIGIN_PREFIX = '@_'
+
+#Unique index which makes sure there's one document per origin, which the upserts
+#in add_many rely on. Node documents have no rel field, so it's null for them all;
+#only the rel count documents share an origin
+ORIGIN_INDEX = [('origin', ASCENDING), ('rel', ASCENDING)]
+
+#MongoDB's error code for a write which would break a unique index
+DUPLICATE_KEY_ERROR = 11000
+
+DEFAULT_BATCH_SIZE = 10000
+
+
+def _match_pipeline(origin, rel_term, target_term, attrs):
+    '''
+    Aggregation pipeline for a match: select documents having a link which meets
+    all the constraints, then project away the non-matching rels & targets
+
+    rel_term, target_term - stored forms of the rel & target, or None for any
+    '''
+    rel_match = {}
+    if rel_term is not None:
+        rel_match['rid'] = rel_term
+    instance_match = {}
+    if target_term is not None:
+        instance_match['0'] = target_term
+    for k, v in (attrs or {}).items():
+        # Such attribute names can't be used in a query path, so are only checked client side
+        if '.' not in k and not k.startswith('$'):
+            instance_match['1.' + k] = v
+    if instance_match:
+        rel_match['instances'] = {'$elemMatch': instance_match}
+
+    query = {} if origin is None else {'origin': origin}
+    if rel_match:
+        query['rels'] = {'$elemMatch': rel_match}
+    pipeline = [{'$match': query}]
+
+    # Unlike queries, aggregation $eq compares arrays (e.g. abbreviated IRIs) exactly
+    rels_expr = '$rels'
+    if rel_term is not None:
+        rels_expr = {'$filter': {'input': rels_expr, 'as': 'r',
+            'cond': {'$eq': ['$$r.rid', {'$literal': rel_term}]}}}
+    if target_term is not None:
+        rels_expr = {'$map': {'input': rels_expr, 'as': 'r', 'in': {
+            'rid': '$$r.rid',
+            'instances': {'$filter': {'input': '$$r.instances', 'as': 'i',
+                'cond': {'$eq': [{'$arrayElemAt': ['$$i', 0]}, {'$literal': target_term}]}}},
+        }}}
+    if rels_expr != '$rels':
+        pipeline.append({'$project': {'_id': 0, 'origin': 1, 'rels': rels_expr}})
+    return pipeline
+
+
+def _item_links(item, rel_term, target_term, attrs, expand):
+    '''
+    Yield the links from a document (as returned from a match pipeline)
+    which match the stored rel & target terms & attributes
+    '''
+    if item['origin'].startswith(META_ORIGIN_PREFIX):
+        return
+    xorigin = item['origin']
+    for xrel_obj in item['rels']:
+        # The server has already done the filtering, but its array matching is looser
+        # (e.g. a target of 'eggs' would match a stored [23, 'eggs']), so double check
+        if rel_term is not None and rel_term != xrel_obj['rid']:
+            continue
+        xrelid = expand(xrel_obj['rid'])
+        for xtarget, xattrs in xrel_obj['instances']:
+            if target_term is not None and target_term != xtarget:
+                continue
+            if attrs and any(k not in xattrs or xattrs[k] != v for k, v in attrs.items()):
+                continue
+            yield xorigin, xrelid, expand(xtarget), xattrs
+    return
+
+
+def _batch_requests(encoded):
+    '''
+    Bulk write requests for a batch of links, as (origin, rel, rel term, target term, attrs):
+    one upserted $push per origin, of its links grouped by rel, and one $inc per rel count
+
+    returns the list of link requests, whose upserts are the new origins, & the list of count requests
+    '''
+    #origin -> {rel term key: {'rid': rel term, 'instances': [...]}}, in order of first appearance
+    grouped = {}
+    rel_counts = {}
+    for origin, rel, rel_term, target_term, attrs in encoded:
+        rel_objs = grouped.setdefault(origin, {})
+        rel_obj = rel_objs.setdefault(term_key(rel_term), {'rid': rel_term, 'instances': []})
+        rel_obj['instances'].append([target_term, attrs])
+        rel_counts[rel] = rel_counts.get(rel, 0) + 1
+
+    link_requests = [
+        UpdateOne({'origin': origin}, {'$push': {'rels': {'$each': list(rel_objs.values())}}}, upsert=True)
+        for origin, rel_objs in grouped.items()
+    ]
+    count_requests = [
+        UpdateOne({'origin': REL_COUNT_ORIGIN, 'rel': rel}, {'$inc': {'count': count}}, upsert=True)
+        for rel, count in rel_counts.items()
+    ]
+    return link_requests, count_requests
+
+
+def _lost_upserts(requests, error):
+    '''
+    Sort out a BulkWriteError from an unordered bulk write of upserts. Those which lost
+    a race with another writer inserting the same document failed on the unique index,
+    but would now simply update it, so can be retried. Reraises the error if anything
+    else failed
+
+    returns the number of documents the bulk write inserted & the list of requests to retry
+    '''
+    errors = error.details['writeErrors']
+    if any(err['code'] != DUPLICATE_KEY_ERROR for err in errors):
+        raise error
+    return error.details['nUpserted'], [ requests[err['index']] for err in errors ]
+
+
+def _check_link(curr_rel):
+    '''Unpack a link tuple for add_many, with attributes defaulting to empty'''
+    attrs = {}
+    if len(curr_rel) == 3:
+        origin, rel, target = curr_rel
+    elif len(curr_rel) == 4:
+        origin, rel, target, attrs = curr_rel
+    else:
+        raise ValueError
+    if not origin:
+        raise ValueError('Relationship origin cannot be null')
+    if not rel:
+        raise ValueError('Relationship ID cannot be null')
+    return origin, rel, target, attrs or {}
+
 
 def newmodel(collection=None, baseiri=None):
     return connection(collection=collection, baseiri=baseiri)
 
 class connection(connection_base):
-    #Meta items, e.g. the abbreviations map, so as not to be included in size()
-    META_ITEM_COUNT = 1
-
     def __init__(self, collection=None, baseiri=None):
         '''
         Versa connection object built from MongoDB collection object
@@ -65,10 +219,14 @@ class connection(connection_base):
         #author_wd = lllists.author_wikidata  #Collection
         #item_authors = lllists.item_authors  #Collection
         
+        self._abbr_cache = abbreviation_cache()
+        self._ensure_indexes()
         self._ensure_abbreviations()
+        self._migrate()
+        if self._db_coll.find_one({'origin': COUNTS_ORIGIN}) is None:
+            self._recount()
         #self.create_model()
         self._baseiri = baseiri
-        self._abbr_index = 0
         return
 
     def copy(self, contents=True):
@@ -95,27 +253,57 @@ class connection(connection_base):
 
     def size(self):
         '''Return the number of links in the model'''
-        count = 0
-        cursor = self._db_coll.find()
-        for item in cursor:
-            if item['origin'] == '@_abbreviations':
+        return self._db_coll.find_one({'origin': COUNTS_ORIGIN})['links']
+
+    def __len__(self):
+        '''Return the number of links in the model'''
+        return self.size()
+
+    def origin_count(self):
+        '''Return the number of distinct origins in the model'''
+        return self._db_coll.find_one({'origin': COUNTS_ORIGIN})['origins']
+
+    def rel_counts(self):
+        '''Return a mapping from each rel in the model to its number of links'''
+        return { item['rel']: item['count'] for item in self._db_coll.find({'origin': REL_COUNT_ORIGIN}) }
+
+    def _recount(self):
+        '''Work out the counts by scanning the whole collection, e.g. for one from before they were kept'''
+        self._abbreviations()
+        expand = self._abbr_cache.expand
+        links = origins = 0
+        rels = {}
+        for item in self._db_coll.find():
+            if item['origin'].startswith(META_ORIGIN_PREFIX):
                 continue
-            count += len(item['rels'])
-        return count
-        #return  self._db_coll.count() - connection.META_ITEM_COUNT
+            origins += 1
+            for rel_obj in item['rels']:
+                rel = expand(rel_obj['rid'])
+                links += len(rel_obj['instances'])
+                rels[rel] = rels.get(rel, 0) + len(rel_obj['instances'])
+        self._db_coll.delete_many({'origin': REL_COUNT_ORIGIN})
+        if rels:
+            self._db_coll.insert_many([ {'origin': REL_COUNT_ORIGIN, 'rel': rel, 'count': count} for rel, count in rels.items() ])
+        self._db_coll.replace_one(
+            {'origin': COUNTS_ORIGIN},
+            {'origin': COUNTS_ORIGIN, 'links': links, 'origins': origins},
+            upsert=True
+        )
+        return
 
     def __iter__(self):
-        abbrevs = self._abbreviations()
+        self._abbreviations()
+        expand = self._abbr_cache.expand
         cursor = self._db_coll.find()
         index = 0
         for item in cursor:
-            if item['origin'] == '@_abbreviations':
+            if item['origin'].startswith(META_ORIGIN_PREFIX):
                 continue
             origin = item['origin']
             for rel in item['rels']:
-                relid = rel['rid']
+                relid = expand(rel['rid'])
                 for target, attribs in rel['instances']:
-                    yield index, (origin, relid.format(**abbrevs), target.format(**abbrevs), attribs)
+                    yield index, (origin, relid, expand(target), attribs)
                     index += 1
 
     def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
@@ -126,46 +314,55 @@ class connection(connection_base):
         rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
         target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
-        include_ids - If true include statement IDs with yield values
+        include_ids - If true include statement IDs with yield values. These are
+            just the order of each result within this match, not positions in the model
+
+        The constraints are sent to the server, so only documents with matching
+        links are read, and only the matching rels & targets within those
         '''
-        abbrevs = self._abbreviations()
+        self._abbreviations()
+        expand = self._abbr_cache.expand
+        # Compare stored forms, so only matching links need be decoded
+        rel_term = self._abbr_cache.lookup(rel) if rel else None
+        target_term = self._abbr_cache.lookup(target) if target else None
+        if (rel and rel_term is None) or (target and target_term is None):
+            return
+        cursor = self._db_coll.aggregate(_match_pipeline(origin, rel_term, target_term, attrs))
         index = 0
-        if origin is None:
-            cursor = self._db_coll.find()
-        else:
-            cursor = self._db_coll.find({'origin': origin})
-            
         for item in cursor:
-            if item['origin'] == '@_abbreviations':
+            for link in _item_links(item, rel_term, target_term, attrs, expand):
+                yield (index, link) if include_ids else link
+                index += 1
+        return
+
+    def match_many(self, patterns, include_ids=False):
+        '''
+        Retrieve the relationships matching each of a list of patterns (see connection_base.match_many)
+
+        The documents for all the patterns' origins are fetched in one $in query, then
+        matched against the rel & target of each pattern. Any patterns with no origin
+        are matched separately, as with match
+        '''
+        self._abbreviations()
+        expand = self._abbr_cache.expand
+        results = [ [] for p in patterns ]
+        by_origin = {}
+        for ix, pattern in enumerate(patterns):
+            origin, rel, target = _pattern_parts(pattern)
+            if not origin:
+                results[ix] = list(self.match(None, rel, target, include_ids=include_ids))
                 continue
-            if origin != item['origin']:
+            rel_term = self._abbr_cache.lookup(rel) if rel else None
+            target_term = self._abbr_cache.lookup(target) if target else None
+            if (rel and rel_term is None) or (target and target_term is None):
                 continue
-            for xrel_obj in item['rels']:
-                xrelid = xrel_obj['rid'].format(**abbrevs)
-                if rel and rel != xrelid:
-                    continue
-                for xtarget, xattrs in xrel_obj['instances']:
-                    index += 1
-                    xtarget = xtarget.format(**abbrevs)
-                    if target and target != xtarget:
-                        continue
-                    matches = True
-                    if attrs:
-                        for k, v in attrs.items():
-                            if k not in xattrs or xattrs.get(k) != v:
-                                matches = False
-                    if matches:
-                        if include_ids:
-                            yield index, (origin, xrelid, xtarget, xattrs)
-                        else:
-                            yield origin, xrelid, xtarget, xattrs
-
-                    #if matches:
-                    #    if include_ids:
-                    #        yield index, (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
-                    #    else:
-                    #        yield (curr_rel[0], curr_rel[1], curr_rel[2], curr_rel[3].copy())
-        return
+            by_origin.setdefault(origin, []).append((ix, rel_term, target_term))
+        if by_origin:
+            for item in self._db_coll.find({'origin': {'$in': list(by_origin)}}):
+                for ix, rel_term, target_term in by_origin.get(item['origin'], ()):
+                    links = _item_links(item, rel_term, target_term, None, expand)
+                    results[ix].extend(enumerate(links) if include_ids else links)
+        return results
 
     def multimatch(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
@@ -209,56 +406,67 @@ class connection(connection_base):
         target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
         '''
-        if not origin: 
-            raise ValueError('Relationship origin cannot be null')
-        if not rel: 
-            raise ValueError('Relationship ID cannot be null')
-
-        attrs = attrs or {}
-
-        origin_item = self._db_coll.find_one({'origin': origin})
-        rel = self._abbreviate(rel)
-        target = self._abbreviate(target)
-        rel_info = {'rid': rel, 'instances': [[target, attrs]]}
-        if origin_item is None:
-            self._db_coll.insert_one(
-                {
-                    'origin': origin,
-                    'rels': [rel_info],
-                }
-            )
-        else:
-            origin_item['rels'].append(rel_info)
-            self._db_coll.replace_one(
-                {'origin': origin}, origin_item
-            )
+        self.add_many([(origin, rel, target, attrs)])
         return
 
-    def add_many(self, rels):
+    def add_many(self, rels, batch_size=DEFAULT_BATCH_SIZE):
         '''
         Add a list of relationships to the extent
 
-        rels - a list of 0 or more relationship tuples, e.g.:
+        rels - a list or iterator of 0 or more relationship tuples, e.g.:
         [
             (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
         ]
+        batch_size - maximum number of links sent to the server in each bulk write
 
         origin - origin of the relationship (similar to an RDF subject)
         rel - type IRI of the relationship (similar to an RDF predicate)
         target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+
+        Rather than reading & rewriting each origin's document, links are grouped by
+        origin & rel, and each origin's links are appended with one upserted $push.
+        Each batch goes to the server as a single unordered bulk write, followed by
+        one for the increments to the counts. If a batch fails part way through, some
+        of its links might still have been added, in which case _recount() can be
+        used to correct the counts.
         '''
+        batch = []
         for curr_rel in rels:
-            attrs = {}
-            if len(curr_rel) == 3:
-                origin, rel, target = curr_rel
-            elif len(curr_rel) == 4:
-                origin, rel, target, attrs = curr_rel
-            else:
-                raise ValueError
-            self.add(origin, rel, target, attrs)
+            batch.append(_check_link(curr_rel))
+            if len(batch) >= batch_size:
+                self._add_batch(batch)
+                batch = []
+        if batch:
+            self._add_batch(batch)
+        return
+
+    def _add_batch(self, batch):
+        '''Write a batch of links, with one bulk write for the links & one for the counts'''
+        self._abbreviations()
+        encoded = [ (origin, rel, self._abbreviate(rel), self._abbreviate(target), attrs)
+                    for origin, rel, target, attrs in batch ]
+        link_requests, count_requests = _batch_requests(encoded)
+        upserted = self._bulk_upsert(link_requests)
+        count_requests.append(UpdateOne({'origin': COUNTS_ORIGIN},
+            {'$inc': {'links': len(batch), 'origins': upserted}}))
+        self._bulk_upsert(count_requests)
         return
 
+    def _bulk_upsert(self, requests):
+        '''
+        Unordered bulk write of upserts, retrying any which lost a race with another
+        writer (see _lost_upserts). Returns the number of documents inserted
+        '''
+        upserted = 0
+        while requests:
+            try:
+                return upserted + self._db_coll.bulk_write(requests, ordered=False).upserted_count
+            except BulkWriteError as e:
+                count, requests = _lost_upserts(requests, e)
+                upserted += count
+        return upserted
+
     #FIXME: Replace with a match_to_remove method
     def remove(self, index):
         '''
@@ -293,41 +501,92 @@ class connection(connection_base):
         return repr(other) == repr(self)
 
     def _abbreviations(self):
-        abbrev_obj = self._db_coll.find_one({'origin': '@_abbreviations'})
-        return abbrev_obj['map']
-        
-    def _abbreviate(self, rid):
         '''
-        Abbreviate a relationship or resource ID target for efficient storage
-        in the DB. Works only with a prefix/suffix split of hierarchical HTTP-like IRIs,
-        e.g. 'http://example.org/spam/eggs' becomes something like '{a23}eggs'
-        and afterward there will be an entry in the prefix map from 'a23' to 'http://example.org/spam/'
-        The map can then easily be used with str.format
+        Return the list of IRI prefixes.
+        Only loaded from the DB if it has changed since last used
         '''
-        if not isinstance(rid, str) or not iri.matches_uri_syntax(rid): return rid
-        head, tail = rid.rsplit('/', 1)
-        head += '/'
-        abbrev_obj = self._db_coll.find_one({'origin': '@_abbreviations'})
-        assert abbrev_obj is not None
-        pmap = abbrev_obj['map']
-        #FIXME: probably called too often to do this every time
-        inv_pmap = {v: k for k, v in pmap.items()}
-        if head in inv_pmap:
-            prefix = inv_pmap[head]
-        else:
-            prefix = f'a{self._abbr_index}'
-            pmap[prefix] = head
-            self._abbr_index += 1
-            self._db_coll.replace_one(
-                {'origin': '@_abbreviations'},
-                {'origin': '@_abbreviations', 'map': pmap}
+        abbrev_obj = self._db_coll.find_one({'origin': ABBREVIATIONS_ORIGIN}, {'gen': 1})
+        return self._abbr_cache.refresh(abbrev_obj['gen'],
+            lambda: self._db_coll.find_one({'origin': ABBREVIATIONS_ORIGIN})['prefixes'])
+
+    def _abbreviate(self, val):
+        '''
+        Encode a relationship or target for efficient storage in the DB.
+        Hierarchical HTTP-like IRIs are split into prefix & tail,
+        e.g. 'http://example.org/spam/eggs' becomes something like [23, 'eggs']
+        and afterward there will be an entry 23 in the prefix list for 'http://example.org/spam/'
+
+        Assumes the abbreviations cache has been refreshed
+        '''
+        term = self._abbr_cache.lookup(val)
+        while term is None:
+            head, tail = split_iri(val)
+            gen = self._abbr_cache.generation
+            prefix_id = self._abbr_cache.add(head)
+            # Only applies if no other connection has changed the list since it was loaded
+            result = self._db_coll.update_one(
+                {'origin': ABBREVIATIONS_ORIGIN, 'gen': gen},
+                {'$push': {'prefixes': head}, '$set': {'gen': self._abbr_cache.generation}}
             )
-        post_rid = '{' + prefix + '}' + tail
-        return post_rid
-        
+            if result.modified_count:
+                term = [prefix_id, tail]
+            else:
+                self._abbr_cache.invalidate()
+                self._abbreviations()
+                term = self._abbr_cache.lookup(val)
+        return term
+
+    def _ensure_indexes(self):
+        '''
+        Create the indexes used by match, if not already there. ORIGIN_INDEX is
+        unique, so it fails on a collection which already has more than one document
+        for an origin. rels.rid is a multikey index. Targets are the first items of
+        the [target, attrs] instance arrays, which can't be indexed as such, so
+        target-only matches still scan the collection, though only matching links
+        come back from the server
+        '''
+        self._db_coll.create_index(ORIGIN_INDEX, unique=True)
+        self._db_coll.create_index('rels.rid')
+        return
+
     def _ensure_abbreviations(self):
-        abbrev_obj = self._db_coll.find_one({'origin': '@_abbreviations'})
+        abbrev_obj = self._db_coll.find_one({'origin': ABBREVIATIONS_ORIGIN})
         if abbrev_obj is None:
-            self._db_coll.insert_one({'origin': '@_abbreviations', 'map': {}})
+            self._db_coll.insert_one({'origin': ABBREVIATIONS_ORIGIN, 'prefixes': [], 'gen': 0})
         return
-        
+
+    def _migrate(self):
+        '''
+        Convert a collection from the old storage format, with rels & targets such as '{a23}eggs'
+        expanded through str.format, to the current one. Done in place, and not atomic,
+        so make sure nothing else is using the collection the first time it's opened after upgrade
+
+        returns True if there was anything to convert
+        '''
+        abbrev_obj = self._db_coll.find_one({'origin': ABBREVIATIONS_ORIGIN})
+        if 'map' not in abbrev_obj:
+            return False
+        expand = legacy_expander(abbrev_obj['map'])
+        cache = abbreviation_cache()
+        cache.refresh(0, list)
+
+        def encode(val):
+            val = expand(val)
+            term = cache.lookup(val)
+            if term is None:
+                head, tail = split_iri(val)
+                term = [cache.add(head), tail]
+            return term
+
+        for item in self._db_coll.find({'origin': {'$ne': ABBREVIATIONS_ORIGIN}}):
+            rels = [
+                {'rid': encode(rel_obj['rid']), 'instances': [
+                    [encode(target), attrs] for target, attrs in rel_obj['instances']
+                ]} for rel_obj in item['rels']
+            ]
+            self._db_coll.update_one({'_id': item['_id']}, {'$set': {'rels': rels}})
+        self._db_coll.replace_one(
+            {'origin': ABBREVIATIONS_ORIGIN},
+            {'origin': ABBREVIATIONS_ORIGIN, 'prefixes': cache.prefixes, 'gen': cache.generation + 1}
+        )
+        return True
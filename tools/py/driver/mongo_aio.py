@@ -0,0 +1,213 @@
+#asyncio MongoDB driver for Versa, a Web semi-structured metadata tool
+'''
+
+[
+    (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
+]
+
+The optional attributes are metadata bound to the statement itself
+
+Async counterpart of versa.driver.mongo (see versa.driver.aio), with the same
+document layout, so the two can be used on the same collection. Built from an
+async collection object, from PyMongo's async API (pymongo.AsyncMongoClient,
+PyMongo 4.9 or later) or from Motor:
+
+client = pymongo.AsyncMongoClient(connstr)
+model = await mongo_aio.connect(client.versademo.model1)
+async for link in model.match(origin):
+    ...
+'''
+
+import inspect
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from versa.driver.aio import async_connection_base
+from versa.driver.abbreviations import abbreviation_cache, split_iri
+from versa.driver.mongo import (_match_pipeline, _item_links, _batch_requests, _check_link, _lost_upserts,
+    ABBREVIATIONS_ORIGIN, COUNTS_ORIGIN, REL_COUNT_ORIGIN, ORIGIN_INDEX, DEFAULT_BATCH_SIZE)
+
+__all__ = ['connection', 'connect']
+
+
+async def connect(collection, baseiri=None):
+    '''
+    Return a connection, with the collection set up & ready for use.
+    Arguments as for connection()
+    '''
+    model = connection(collection, baseiri=baseiri)
+    await model.open()
+    return model
+
+
+class connection(async_connection_base):
+    def __init__(self, collection, baseiri=None):
+        '''
+        Versa async connection object built from an async MongoDB collection object.
+        Must be opened (see open(), or use connect()) before use
+        '''
+        self._db_coll = collection
+        self._baseiri = baseiri
+        self._abbr_cache = abbreviation_cache()
+        return
+
+    async def open(self):
+        '''
+        Make sure the collection has its indexes, prefix list & counts.
+        Collections from before these were kept need to be opened once with
+        versa.driver.mongo first, which converts them
+        '''
+        await self._db_coll.create_index(ORIGIN_INDEX, unique=True)
+        await self._db_coll.create_index('rels.rid')
+        abbrev_obj = await self._db_coll.find_one({'origin': ABBREVIATIONS_ORIGIN})
+        if abbrev_obj is None:
+            await self._db_coll.insert_one({'origin': ABBREVIATIONS_ORIGIN, 'prefixes': [], 'gen': 0})
+        elif 'map' in abbrev_obj:
+            raise ValueError('Collection is in an old storage format. Open it with versa.driver.mongo to convert it')
+        if await self._db_coll.find_one({'origin': COUNTS_ORIGIN}) is None:
+            if await self._db_coll.find_one({'rels': {'$exists': True}}) is not None:
+                raise ValueError('Collection has no link counts. Open it with versa.driver.mongo to count them')
+            await self._db_coll.update_one({'origin': COUNTS_ORIGIN},
+                {'$setOnInsert': {'links': 0, 'origins': 0}}, upsert=True)
+        return
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def size(self):
+        '''Return the number of links in the model'''
+        return (await self._db_coll.find_one({'origin': COUNTS_ORIGIN}))['links']
+
+    async def origin_count(self):
+        '''Return the number of distinct origins in the model'''
+        return (await self._db_coll.find_one({'origin': COUNTS_ORIGIN}))['origins']
+
+    async def rel_counts(self):
+        '''Return a mapping from each rel in the model to its number of links'''
+        return { item['rel']: item['count'] async for item in self._db_coll.find({'origin': REL_COUNT_ORIGIN}) }
+
+    async def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Retrieve an async iterator of relationships that match a pattern of components
+
+        origin - (optional) origin of the relationship (similar to an RDF subject). If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
+        attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs with yield values. These are
+            just the order of each result within this match, not positions in the model
+
+        As with versa.driver.mongo, the constraints are sent to the server
+        '''
+        await self._abbreviations()
+        expand = self._abbr_cache.expand
+        rel_term = self._abbr_cache.lookup(rel) if rel else None
+        target_term = self._abbr_cache.lookup(target) if target else None
+        if (rel and rel_term is None) or (target and target_term is None):
+            return
+        cursor = self._db_coll.aggregate(_match_pipeline(origin, rel_term, target_term, attrs))
+        #PyMongo's async API returns the cursor from a coroutine, Motor's directly
+        if inspect.isawaitable(cursor):
+            cursor = await cursor
+        index = 0
+        async for item in cursor:
+            for link in _item_links(item, rel_term, target_term, attrs, expand):
+                yield (index, link) if include_ids else link
+                index += 1
+        return
+
+    async def add(self, origin, rel, target, attrs=None):
+        '''
+        Add one relationship to the model
+
+        origin - origin of the relationship (similar to an RDF subject)
+        rel - type IRI of the relationship (similar to an RDF predicate)
+        target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
+        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+        '''
+        await self.add_many([(origin, rel, target, attrs)])
+        return
+
+    async def add_many(self, rels, batch_size=DEFAULT_BATCH_SIZE):
+        '''
+        Add a list of relationships to the extent
+
+        rels - a list or iterator of 0 or more relationship tuples, e.g.:
+        [
+            (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
+        ]
+        batch_size - maximum number of links sent to the server in each bulk write
+
+        As with versa.driver.mongo, each batch is an unordered bulk write of grouped $push upserts,
+        then one of the count increments
+        '''
+        batch = []
+        for curr_rel in rels:
+            batch.append(_check_link(curr_rel))
+            if len(batch) >= batch_size:
+                await self._add_batch(batch)
+                batch = []
+        if batch:
+            await self._add_batch(batch)
+        return
+
+    async def _add_batch(self, batch):
+        '''Write a batch of links, with one bulk write for the links & one for the counts'''
+        await self._abbreviations()
+        encoded = [ (origin, rel, await self._abbreviate(rel), await self._abbreviate(target), attrs)
+                    for origin, rel, target, attrs in batch ]
+        link_requests, count_requests = _batch_requests(encoded)
+        upserted = await self._bulk_upsert(link_requests)
+        count_requests.append(UpdateOne({'origin': COUNTS_ORIGIN},
+            {'$inc': {'links': len(batch), 'origins': upserted}}))
+        await self._bulk_upsert(count_requests)
+        return
+
+    async def _bulk_upsert(self, requests):
+        '''As versa.driver.mongo.connection._bulk_upsert'''
+        upserted = 0
+        while requests:
+            try:
+                return upserted + (await self._db_coll.bulk_write(requests, ordered=False)).upserted_count
+            except BulkWriteError as e:
+                count, requests = _lost_upserts(requests, e)
+                upserted += count
+        return upserted
+
+    async def _abbreviations(self):
+        '''
+        Return the list of IRI prefixes.
+        Only loaded from the DB if it has changed since last used
+        '''
+        abbrev_obj = await self._db_coll.find_one({'origin': ABBREVIATIONS_ORIGIN}, {'gen': 1})
+        if abbrev_obj['gen'] != self._abbr_cache.generation:
+            abbrev_obj = await self._db_coll.find_one({'origin': ABBREVIATIONS_ORIGIN})
+            self._abbr_cache.refresh(abbrev_obj['gen'], lambda: abbrev_obj['prefixes'])
+        return self._abbr_cache.prefixes
+
+    async def _abbreviate(self, val):
+        '''
+        Encode a relationship or target for efficient storage in the DB,
+        as versa.driver.mongo.connection._abbreviate
+
+        Assumes the abbreviations cache has been refreshed
+        '''
+        term = self._abbr_cache.lookup(val)
+        while term is None:
+            head, tail = split_iri(val)
+            gen = self._abbr_cache.generation
+            prefix_id = self._abbr_cache.add(head)
+            # Only applies if no other connection has changed the list since it was loaded
+            result = await self._db_coll.update_one(
+                {'origin': ABBREVIATIONS_ORIGIN, 'gen': gen},
+                {'$push': {'prefixes': head}, '$set': {'gen': self._abbr_cache.generation}}
+            )
+            if result.modified_count:
+                term = [prefix_id, tail]
+            else:
+                self._abbr_cache.invalidate()
+                await self._abbreviations()
+                term = self._abbr_cache.lookup(val)
+        return term
@@ -12,37 +12,276 @@ The optional attributes are metadata bound to the statement itself
 #Note: for PyPy support port to pg8000 <http://pybrary.net/pg8000/>
 #Reportedly PyPy/pg8000 is faster than CPython/psycopg2
 
+import io
+import json
 import logging
-from itertools import groupby
+from contextlib import contextmanager
+from itertools import groupby, islice, count
 from operator import itemgetter
 
 import psycopg2 #http://initd.org/psycopg/
+import psycopg2.pool
+from psycopg2.extras import Json
+
+from versa.driver import connection_base, _patterns_by_shape
+
+#Max number of links add_many loads per transaction
+DEFAULT_BATCH_SIZE = 10000
+
+#Number of rows fetched from the server at a time when streaming results
+DEFAULT_ITERSIZE = 2000
+
+#Max number of patterns in each match_many query
+MAX_PATTERNS = 1000
+
+
+def _copy_text(val):
+    '''Format a value for a PostgreSQL COPY in the default text format'''
+    if val is None:
+        return '\\N'
+    if isinstance(val, bool):
+        # As the INSERT path stores them, via psycopg2 adaptation (not 'True'/'False')
+        return 'true' if val else 'false'
+    return str(val).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _match_query(origin=None, rel=None, target=None, attrs=None, jsonb=False):
+    '''
+    Return the SQL & parameters of the standard query join for a match pattern,
+    or if jsonb, of the query on the relationship table alone
+    '''
+    conditions = ""
+    and_placeholder = ""
+    params = []
+    if origin:
+        conditions += "relationship.origin = %s"
+        params.append(origin)
+        and_placeholder = " AND "
+    if target:
+        #Targets are stored as text, so compare e.g. numbers as such
+        conditions += and_placeholder + "relationship.target = %s::text"
+        params.append(target)
+        and_placeholder = " AND "
+    if rel:
+        conditions += and_placeholder + "relationship.rel = %s"
+        params.append(rel)
+        and_placeholder = " AND "
+    if attrs and jsonb:
+        #Containment, which can use the GIN index
+        conditions += and_placeholder + "relationship.attrs @> %s::jsonb"
+        params.append(json.dumps(attrs))
+    elif attrs:
+        #Attribute values are stored as text too
+        for a_name, a_val in attrs.items():
+            conditions += and_placeholder + "EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = %s AND subattr.value = %s::text)"
+            params.extend((a_name, a_val))
+            and_placeholder = " AND "
+    if conditions:
+        conditions = "WHERE " + conditions
+    if jsonb:
+        querystr = "SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, relationship.attrs FROM relationship {0} ORDER BY relationship.rawid;".format(conditions)
+        return querystr, params
+    #SELECT relationship.rawid, attribute.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE relationship.origin = 'http://uche.ogbuji.net' AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@context' AND subattr.value = 'http://uche.ogbuji.net#_metadata') AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@lang' AND subattr.value = 'ig') ORDER BY relationship.rawid;
+    querystr = "SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM relationship LEFT JOIN attribute ON relationship.rawid = attribute.rawid {0} ORDER BY relationship.rawid;".format(conditions)
+    return querystr, params
+
+
+def _match_many_query(shape, rows, jsonb=False):
+    '''
+    Return the SQL & parameters to match a list of patterns, all with the given shape,
+    i.e. tuple of names of the relationship columns they specify
+
+    rows - list of (pattern index, value of 1st column in shape, ...) tuples
+    '''
+    #VALUES columns would otherwise be typed from the parameters, e.g. integer for a
+    #numeric target, which can't be compared with the text columns
+    placeholders = '(' + ', '.join(['%s::integer'] + ['%s::text'] * len(shape)) + ')'
+    conditions = ' AND '.join('relationship.{0} = pattern.{0}'.format(col) for col in shape)
+    values = ', '.join([placeholders] * len(rows))
+    if jsonb:
+        querystr = "SELECT pattern.ix, relationship.rawid, relationship.origin, relationship.rel, relationship.target, relationship.attrs FROM (VALUES {1}) AS pattern (ix, {0}) JOIN relationship ON {2} ORDER BY pattern.ix, relationship.rawid;"
+    else:
+        querystr = "SELECT pattern.ix, relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM (VALUES {1}) AS pattern (ix, {0}) JOIN relationship ON {2} LEFT JOIN attribute ON relationship.rawid = attribute.rawid ORDER BY pattern.ix, relationship.rawid;"
+    return querystr.format(', '.join(shape), values, conditions), [ val for row in rows for val in row ]
+
+
+def _insert_link(cur, origin, rel, target, attrs=None, rid=None, jsonb=False):
+    '''Insert one relationship, without committing. Returns its raw ID'''
+    attrs = attrs or {}
+    if jsonb:
+        querystr = "INSERT INTO relationship (origin, rel, target, id, attrs) VALUES (%s, %s, %s, %s, %s) RETURNING rawid;"
+        cur.execute(querystr, (origin, rel, target, rid or None, Json(attrs)))
+        return cur.fetchone()[0]
+    if rid:
+        querystr = "INSERT INTO relationship (origin, rel, target, id) VALUES (%s, %s, %s, %s) RETURNING rawid;"
+        cur.execute(querystr, (origin, rel, target, rid))
+    else:
+        querystr = "INSERT INTO relationship (origin, rel, target) VALUES (%s, %s, %s) RETURNING rawid;"
+        cur.execute(querystr, (origin, rel, target))
+    rawid = cur.fetchone()[0]
+    for a_name, a_val in attrs.items():
+        querystr = "INSERT INTO attribute (rawid, name, value) VALUES (%s, %s, %s);"
+        cur.execute(querystr, (rawid, a_name, a_val))
+    return rawid
+
+
+def _link_rows(batch_ids, batch, jsonb=False):
+    '''
+    Rows of column values for bulk loading a list of relationships with the given raw IDs
+
+    returns a list of relationship rows & one of attribute rows (empty if jsonb)
+    '''
+    rel_rows = []
+    attr_rows = []
+    for rawid, curr_rel in zip(batch_ids, batch):
+        attrs, rid = None, None
+        if len(curr_rel) == 3:
+            origin, rel, target = curr_rel
+        elif len(curr_rel) == 4:
+            origin, rel, target, attrs = curr_rel
+        elif len(curr_rel) == 5:
+            origin, rel, target, attrs, rid = curr_rel
+        else:
+            raise ValueError
+        if jsonb:
+            rel_rows.append((rawid, rid, origin, rel, target, json.dumps(attrs or {})))
+            continue
+        rel_rows.append((rawid, rid, origin, rel, target))
+        attr_rows.extend((rawid, a_name, a_val) for a_name, a_val in (attrs or {}).items())
+    return rel_rows, attr_rows
+
+
+def _copy_links(cur, batch, jsonb=False):
+    '''
+    Bulk load a list of relationships, without committing. Returns their raw IDs, in order
+
+    Raw IDs are reserved from the sequence up front, so that
+    relationships & attributes can then be bulk loaded with COPY
+    '''
+    cur.execute(RESERVE_IDS_SQL, (len(batch),))
+    batch_ids = [ row[0] for row in cur ]
+    rel_rows, attr_rows = _link_rows(batch_ids, batch, jsonb)
+    rel_buf = io.StringIO()
+    attr_buf = io.StringIO()
+    for row in rel_rows:
+        rel_buf.write('\t'.join(map(_copy_text, row)) + '\n')
+    for row in attr_rows:
+        attr_buf.write('\t'.join(map(_copy_text, row)) + '\n')
+    rel_buf.seek(0)
+    attr_buf.seek(0)
+    if jsonb:
+        cur.copy_expert(COPY_RELATIONSHIP_JSONB_SQL, rel_buf)
+        return batch_ids
+    cur.copy_expert(COPY_RELATIONSHIP_SQL, rel_buf)
+    cur.copy_expert(COPY_ATTRIBUTE_SQL, attr_buf)
+    return batch_ids
 
-from versa.driver import connection_base
 
 class connection(connection_base):
-    def __init__(self, connstr, logger=None):
+    def __init__(self, connstr, logger=None, itersize=DEFAULT_ITERSIZE, maxconn=None, minconn=1, jsonb=False):
         '''
         connstr - the Postgres connection string
+        itersize - number of rows at a time to fetch from the server while iterating over results
+        maxconn - if given, use pooled mode, with a thread-safe pool of up to this many DB connections
+        minconn - number of DB connections the pool opens up front, in pooled mode
+        jsonb - if True use the schema variant with attributes stored as a JSONB column of
+            the relationship table, with a GIN index, rather than in a separate attribute table.
+            Each link is then one row, and attribute matches are containment (@>) checks.
+            Must match the schema the DB was set up with (see create_space)
+
+        By default all operations go through a single DB connection, apart from streamed
+        match() results, which are read on a second one, opened when first needed, so that
+        writes meanwhile, including failed ones, can't disturb them. The connection object
+        isn't safe to share across threads. In pooled mode each operation checks out its own DB
+        connection, for as long as it runs (for match() that's while its results are streaming),
+        so concurrent operations, e.g. from worker threads, run in parallel, each in its own
+        transaction. Checking out more than maxconn at once raises psycopg2.pool.PoolError
         '''
-        self._conn = psycopg2.connect(connstr)
+        if maxconn:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, connstr)
+            self._conn = None
+        else:
+            self._pool = None
+            self._conn = psycopg2.connect(connstr)
+        self._connstr = connstr
+        self._stream_conn = None
         self._logger = logger or logging
+        self._itersize = itersize
+        self._jsonb = jsonb
+        self._cursor_names = count()
+        #Number of result streams in progress on the stream connection, whose read transaction has to be left open
+        self._streams = 0
         return
 
+    @contextmanager
+    def _checkout(self):
+        '''
+        Borrow a DB connection for an operation: one from the pool if pooled,
+        otherwise the one shared connection. Any transaction left open at the end,
+        e.g. by reads, is finished
+        '''
+        conn = self._conn if self._pool is None else self._pool.getconn()
+        try:
+            yield conn
+        finally:
+            if conn is self._conn:
+                if not conn.closed:
+                    conn.rollback()
+            else:
+                if not conn.closed:
+                    conn.rollback()
+                self._pool.putconn(conn)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Explicit transaction scope, e.g.
+
+        with model.transaction() as sess:
+            sess.add(origin, rel, target)
+            links = list(sess.match(origin))
+
+        Everything done through the session runs in one transaction on one DB connection,
+        committed at the end of the block, or rolled back if there's an exception.
+        The connection is from the pool if pooled, otherwise one opened for the session,
+        so operations on the model itself within the block don't finish the session's
+        transaction early. A session is for use by one thread or task at a time
+        '''
+        if self._pool is None:
+            conn = psycopg2.connect(self._connstr)
+            try:
+                yield from self._session(conn)
+            finally:
+                conn.close()
+        else:
+            with self._checkout() as conn:
+                yield from self._session(conn)
+
+    def _session(self, conn):
+        '''Run a session on the given DB connection, as for transaction()'''
+        try:
+            yield session(self, conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
     def create_space(self):
         '''Set up a new table space for the first time'''
-        cur = self._conn.cursor()
-        cur.execute(SQL_MODEL)
-        self._conn.commit()
-        cur.close()
+        with self._checkout() as conn:
+            cur = conn.cursor()
+            cur.execute(SQL_MODEL_JSONB if self._jsonb else SQL_MODEL)
+            conn.commit()
+            cur.close()
         return
 
     def drop_space(self):
         '''Dismantle an existing table space'''
-        cur = self._conn.cursor()
-        cur.execute(DROP_SQL_MODEL)
-        self._conn.commit()
-        cur.close()
+        with self._checkout() as conn:
+            cur = conn.cursor()
+            cur.execute(DROP_SQL_MODEL_JSONB if self._jsonb else DROP_SQL_MODEL)
+            conn.commit()
+            cur.close()
         return
 
     def query(self, expr):
@@ -51,18 +290,12 @@ class connection(connection_base):
 
     def size(self):
         '''Return the number of links in the model'''
-        cur = self._conn.cursor()
-        querystr = "SELECT COUNT(*) FROM relationship;"
-        cur.execute(querystr)
-        result = cur.fetchone()
-        return result[0]
+        with self._checkout() as conn:
+            return session(self, conn).size()
 
     def __iter__(self):
-        cur = self._conn.cursor()
-        tables = "relationship"
-        querystr = "SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid;".format(tables)
-        cur.execute(querystr)
-        return self._process_db_rows_iter(cur)
+        querystr, params = _match_query(jsonb=self._jsonb)
+        return self._stream(querystr, params)
 
     def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
@@ -72,52 +305,98 @@ class connection(connection_base):
         rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
         target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
         attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
-        include_ids - If true include statement IDs with yield values
+        include_ids - If true include statement IDs (raw IDs) with yield values
+
+        Results are streamed from a server-side cursor, itersize rows at a time.
+        The read transaction is finished once the iterator is exhausted or closed,
+        e.g. via contextlib.closing, if it's abandoned part way
         '''
-        #FIXME: Implement include_ids
-        cur = self._conn.cursor()
-        conditions = ""
-        and_placeholder = ""
-        tables = "relationship"
-        params = []
-        if origin:
-            conditions += "relationship.origin = %s"
-            params.append(origin)
-            and_placeholder = " AND "
-        if target:
-            conditions += and_placeholder + "relationship.target = %s"
-            params.append(target)
-            and_placeholder = " AND "
-        if rel:
-            conditions += and_placeholder + "relationship.rel = %s"
-            params.append(rel)
-            and_placeholder = " AND "
-        if attrs:
-            tables = "relationship, attribute"
-            for a_name, a_val in attrs.items():
-                conditions += and_placeholder + "EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = %s AND subattr.value = %s)"
-                params.extend((a_name, a_val))
-                and_placeholder = " AND "
-        #querystr = "SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM {0} WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
-        #SELECT relationship.rawid, attribute.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE relationship.origin = 'http://uche.ogbuji.net' AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@context' AND subattr.value = 'http://uche.ogbuji.net#_metadata') AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@lang' AND subattr.value = 'ig') ORDER BY relationship.rawid;
-        querystr = "SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
-        #self._logger.debug(x.format(url))
-        self._logger.debug(cur.mogrify(querystr, params))
-        cur.execute(querystr, params)
-        #Use groupby to batch up the returning statements acording to rawid then rol up the attributes
-        #return ( (s, p, o, dict([(n,v) for n,v in xxx])) for s, p, o in yyy)
-        #cur.fetchone()
-        #cur.close()
-        return self._process_db_rows_iter(cur)
-
-    def _process_db_rows_iter(self, cursor):
+        querystr, params = _match_query(origin, rel, target, attrs, self._jsonb)
+        return self._stream(querystr, params, include_ids)
+
+    def match_many(self, patterns, include_ids=False):
         '''
-        Turn the low-level rows from the result of a standard query join
-        into higher-level statements, yielded iteratively. Note this might lead to
-        idle transaction errors?
+        Retrieve the relationships matching each of a list of patterns (see connection_base.match_many)
 
+        Patterns specifying the same components, e.g. all (origin, rel, None), are
+        matched together in one query, by joining a VALUES list of them with the
+        relationship table, so the indexes are still used. All in one read transaction
         '''
+        results = [ [] for p in patterns ]
+        by_shape = _patterns_by_shape(patterns)
+        with self._checkout() as conn:
+            for shape, rows in by_shape.items():
+                if not shape:
+                    #Nothing to join on
+                    querystr, params = _match_query(jsonb=self._jsonb)
+                    links = list(self._run_query(conn, querystr, params, include_ids))
+                    for (ix,) in rows:
+                        results[ix] = list(links)
+                    continue
+                process = self._process_jsonb_rows_iter if self._jsonb else self._process_db_rows_iter
+                for start in range(0, len(rows), MAX_PATTERNS):
+                    querystr, params = _match_many_query(shape, rows[start:start + MAX_PATTERNS], self._jsonb)
+                    cur = conn.cursor()
+                    try:
+                        self._logger.debug(cur.mogrify(querystr, params))
+                        cur.execute(querystr, params)
+                        for ix, ixrows in groupby(cur, itemgetter(0)):
+                            results[ix] = list(process((row[1:] for row in ixrows), include_ids))
+                    finally:
+                        cur.close()
+        return results
+
+    def _stream(self, querystr, params, include_ids=False):
+        '''
+        Run a standard query join on a named (server-side) cursor, yielding the
+        resulting statements as rows arrive. The cursor is closed, and the read
+        transaction finished, as soon as the generator is exhausted or closed.
+
+        If not pooled the cursor is on the separate stream connection, so commits or
+        rollbacks on the shared one, e.g. by add() within a loop over results, leave it be
+        '''
+        if self._pool is not None:
+            with self._checkout() as conn:
+                yield from self._run_query(conn, querystr, params, include_ids)
+            return
+        if self._stream_conn is None or self._stream_conn.closed:
+            self._stream_conn = psycopg2.connect(self._connstr)
+        conn = self._stream_conn
+        self._streams += 1
+        try:
+            yield from self._run_query(conn, querystr, params, include_ids)
+        finally:
+            self._streams -= 1
+            self._end_read()
+        return
+
+    def _run_query(self, conn, querystr, params, include_ids=False):
+        '''Yield the statements from a standard query join, run on a named cursor on the given DB connection'''
+        cur = conn.cursor(name='versa_stream_{0}'.format(next(self._cursor_names)))
+        cur.itersize = self._itersize
+        try:
+            self._logger.debug(cur.mogrify(querystr, params))
+            cur.execute(querystr, params)
+            if self._jsonb:
+                yield from self._process_jsonb_rows_iter(cur, include_ids)
+            else:
+                yield from self._process_db_rows_iter(cur, include_ids)
+        finally:
+            cur.close()
+        return
+
+    def _end_read(self):
+        '''Finish the stream connection's read transaction, unless there are still results streaming'''
         #Be aware of: http://packages.python.org/psycopg2/faq.html#problems-with-transactions-handling
+        if not self._streams and not self._stream_conn.closed:
+            self._stream_conn.rollback()
+        return
+
+    def _process_db_rows_iter(self, cursor, include_ids=False):
+        '''
+        Turn the low-level rows from the result of a standard query join
+        into higher-level statements, yielded iteratively
+        '''
         #The results will come back grouped by the raw relationship IDs, in order
         for relid, relgroup in groupby(cursor, itemgetter(0)):
             curr_rel = None
@@ -133,9 +412,18 @@ class connection(connection_base):
                         attrs = {}
                         curr_rel = (origin, rel, target, attrs)
                     attrs[a_name] = a_val
-            yield curr_rel
-        cursor.close()
-        self._conn.rollback() #Finish with the transaction
+            yield (relid, curr_rel) if include_ids else curr_rel
+        return
+
+    def _process_jsonb_rows_iter(self, cursor, include_ids=False):
+        '''
+        Turn the rows from a query in the JSONB schema variant,
+        one per relationship, into statements, yielded iteratively
+        '''
+        for (rawid, origin, rel, target, attrs) in cursor:
+            #As from the standard query join, no attributes dict if there are none
+            curr_rel = (origin, rel, target, attrs) if attrs else (origin, rel, target)
+            yield (rawid, curr_rel) if include_ids else curr_rel
         return
 
     def add(self, origin, rel, target, attrs=None, rid=None):
@@ -148,27 +436,22 @@ class connection(connection_base):
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
         rid - optional ID for the relationship in IRI form. If not specified one will be generated.
 
+        returns the raw (integer) ID of the resulting relationship
         '''
-        #FIXME no it doesn't re:
-        #returns an ID (IRI) for the resulting relationship
-        cur = self._conn.cursor()
-        #relationship.
-        if rid:
-            querystr = "INSERT INTO relationship (origin, rel, target, rid) VALUES (%s, %s, %s, %s) RETURNING rawid;"
-            cur.execute(querystr, (origin, rel, target, rid))
-        else:
-            querystr = "INSERT INTO relationship (origin, rel, target) VALUES (%s, %s, %s) RETURNING rawid;"
-            cur.execute(querystr, (origin, rel, target))
-        rawid = cur.fetchone()[0]
-        for a_name, a_val in attrs.items():
-            querystr = "INSERT INTO attribute (rawid, name, value) VALUES (%s, %s, %s);"
-            cur.execute(querystr, (rawid, a_name, a_val))
-        self._conn.commit()
-        cur.close()
-        return
-
-
-    def add_many(self, rels):
+        with self._checkout() as conn:
+            cur = conn.cursor()
+            try:
+                rawid = _insert_link(cur, origin, rel, target, attrs, rid, self._jsonb)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+        return rawid
+
+
+    def add_many(self, rels, batch_size=DEFAULT_BATCH_SIZE):
         '''
         Add a list of relationships to the extent
 
@@ -185,9 +468,29 @@ class connection(connection_base):
 
         you can omit the dictionary of attributes if there are none, as long as you are not specifying a statement ID
 
-        returns a list of IDs (IRI), one for each resulting relationship, in order
+        batch_size - max number of relationships to load in each transaction
+
+        returns a list of raw (integer) IDs, one for each resulting relationship, in order
+
+        Each batch is bulk loaded with COPY, and committed once
         '''
-        raise NotImplementedError
+        rawids = []
+        rels = iter(rels)
+        while True:
+            batch = list(islice(rels, batch_size))
+            if not batch:
+                break
+            with self._checkout() as conn:
+                cur = conn.cursor()
+                try:
+                    rawids.extend(_copy_links(cur, batch, self._jsonb))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    cur.close()
+        return rawids
 
     def remove(self, rids):
         '''
@@ -206,11 +509,68 @@ class connection(connection_base):
         raise NotImplementedError
 
     def close(self):
-        '''Set up a new table space for the first time'''
-        self._conn.close()
+        '''Close the DB connections, or all pooled connections'''
+        if self._pool is None:
+            self._conn.close()
+            if self._stream_conn is not None:
+                self._stream_conn.close()
+        else:
+            self._pool.closeall()
         return
 
 
+class session(object):
+    '''
+    Operations on a model within one transaction, on one DB connection.
+    Get one from connection.transaction()
+    '''
+    def __init__(self, model, conn):
+        self._model = model
+        self._conn = conn
+        return
+
+    def size(self):
+        '''Return the number of links in the model'''
+        cur = self._conn.cursor()
+        try:
+            cur.execute("SELECT COUNT(*) FROM relationship;")
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        As connection.match, but within the session's transaction,
+        so the results must be used up before the end of the transaction
+        '''
+        querystr, params = _match_query(origin, rel, target, attrs, self._model._jsonb)
+        return self._model._run_query(self._conn, querystr, params, include_ids)
+
+    def add(self, origin, rel, target, attrs=None, rid=None):
+        '''As connection.add, but committed only at the end of the session's transaction'''
+        cur = self._conn.cursor()
+        try:
+            return _insert_link(cur, origin, rel, target, attrs, rid, self._model._jsonb)
+        finally:
+            cur.close()
+
+    def add_many(self, rels):
+        '''As connection.add_many, but committed only at the end of the session's transaction'''
+        cur = self._conn.cursor()
+        try:
+            return _copy_links(cur, list(rels), self._model._jsonb)
+        finally:
+            cur.close()
+
+
+RESERVE_IDS_SQL = "SELECT nextval(pg_get_serial_sequence('relationship', 'rawid')) FROM generate_series(1, %s);"
+
+COPY_RELATIONSHIP_SQL = "COPY relationship (rawid, id, origin, rel, target) FROM STDIN;"
+
+COPY_RELATIONSHIP_JSONB_SQL = "COPY relationship (rawid, id, origin, rel, target, attrs) FROM STDIN;"
+
+COPY_ATTRIBUTE_SQL = "COPY attribute (rawid, name, value) FROM STDIN;"
+
 SQL_MODEL = '''
 CREATE TABLE relationship (
     rawid    SERIAL PRIMARY KEY,  -- a low level, internal ID purely for effieicnt referential integrity
@@ -241,6 +601,30 @@ DROP TABLE attribute;
 DROP TABLE relationship;
 '''
 
+#Variant with attributes as JSONB, e.g. {"@lang": "en"}, with a GIN index for containment (@>) queries
+SQL_MODEL_JSONB = '''
+CREATE TABLE relationship (
+    rawid    SERIAL PRIMARY KEY,  -- a low level, internal ID purely for effieicnt referential integrity
+    id       TEXT UNIQUE,         --The higher level relationship ID
+    origin   TEXT NOT NULL,
+    rel      TEXT NOT NULL,
+    target   TEXT NOT NULL,
+    attrs    JSONB NOT NULL DEFAULT '{}'
+);
+
+CREATE INDEX main_relationship_index ON relationship (origin, rel);
+
+CREATE INDEX main_attrs_index ON relationship USING GIN (attrs jsonb_path_ops);
+'''
+
+DROP_SQL_MODEL_JSONB = '''
+DROP INDEX main_relationship_index;
+
+DROP INDEX main_attrs_index;
+
+DROP TABLE relationship;
+'''
+
 #Some notes on arrays:
 # * http://fossplanet.com/f15/%5Bgeneral%5D-general-postgres-performance-tips-when-using-array-169307/
 
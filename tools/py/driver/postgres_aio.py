@@ -0,0 +1,193 @@
+#asyncio PostgreSQL driver for Versa, a Web semi-structured metadata tool
+'''
+
+[
+    (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
+]
+
+The optional attributes are metadata bound to the statement itself
+
+Async counterpart of versa.driver.postgres (see versa.driver.aio), on the same
+schema, so the two can be used on the same DB. Built on psycopg 3 & psycopg_pool:
+
+pip install "psycopg[binary]" psycopg_pool
+
+model = await postgres_aio.connect(connstr)
+async for link in model.match(origin):
+    ...
+await model.close()
+'''
+
+import logging
+from itertools import count
+
+from psycopg_pool import AsyncConnectionPool #https://www.psycopg.org/psycopg3/
+
+from versa.driver.aio import async_connection_base
+from versa.driver.postgres import (_match_query, _link_rows, DEFAULT_BATCH_SIZE, DEFAULT_ITERSIZE,
+    RESERVE_IDS_SQL, COPY_RELATIONSHIP_SQL, COPY_RELATIONSHIP_JSONB_SQL, COPY_ATTRIBUTE_SQL,
+    SQL_MODEL, DROP_SQL_MODEL, SQL_MODEL_JSONB, DROP_SQL_MODEL_JSONB)
+
+__all__ = ['connection', 'connect']
+
+#Default max number of DB connections in the pool
+DEFAULT_MAXCONN = 10
+
+
+async def connect(connstr, **kwargs):
+    '''
+    Return a connection with its pool open & ready for use.
+    Arguments as for connection()
+    '''
+    model = connection(connstr, **kwargs)
+    await model.open()
+    return model
+
+
+class connection(async_connection_base):
+    def __init__(self, connstr, logger=None, itersize=DEFAULT_ITERSIZE, maxconn=DEFAULT_MAXCONN, minconn=1, jsonb=False):
+        '''
+        connstr - the Postgres connection string
+        itersize - number of rows at a time to fetch from the server while iterating over results
+        maxconn - max number of DB connections in the pool
+        minconn - number of DB connections the pool opens up front
+        jsonb - if True use the schema variant with attributes stored as a JSONB column
+            (see versa.driver.postgres). Must match the schema the DB was set up with
+
+        Each operation checks out its own DB connection from the pool, for as long as it
+        runs (for match() that's while its results are streaming), and runs in its own
+        transaction, so concurrent tasks' operations run in parallel, up to maxconn at once.
+        Beyond that, tasks wait for a connection to be returned to the pool
+
+        The pool must be opened (see open(), or use connect()) before use
+        '''
+        self._pool = AsyncConnectionPool(connstr, min_size=minconn, max_size=maxconn, open=False)
+        self._logger = logger or logging
+        self._itersize = itersize
+        self._jsonb = jsonb
+        self._cursor_names = count()
+        return
+
+    async def open(self):
+        '''Open the connection pool'''
+        await self._pool.open()
+        return
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def create_space(self):
+        '''Set up a new table space for the first time'''
+        async with self._pool.connection() as conn:
+            await conn.execute(SQL_MODEL_JSONB if self._jsonb else SQL_MODEL)
+        return
+
+    async def drop_space(self):
+        '''Dismantle an existing table space'''
+        async with self._pool.connection() as conn:
+            await conn.execute(DROP_SQL_MODEL_JSONB if self._jsonb else DROP_SQL_MODEL)
+        return
+
+    async def size(self):
+        '''Return the number of links in the model'''
+        async with self._pool.connection() as conn:
+            cur = await conn.execute("SELECT COUNT(*) FROM relationship;")
+            return (await cur.fetchone())[0]
+
+    async def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
+        '''
+        Retrieve an async iterator of relationships that match a pattern of components
+
+        origin - (optional) origin of the relationship (similar to an RDF subject). If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
+        attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs (raw IDs) with yield values
+
+        Results are streamed from a server-side cursor, itersize rows at a time, and
+        as with versa.driver.postgres, links without attributes come as 3-tuples.
+        The DB connection goes back to the pool once the iterator is exhausted,
+        or closed (aclose()) if it's abandoned part way
+        '''
+        querystr, params = _match_query(origin, rel, target, attrs, self._jsonb)
+        self._logger.debug(repr((querystr, params)))
+        async with self._pool.connection() as conn:
+            async with conn.cursor(name='versa_stream_{0}'.format(next(self._cursor_names))) as cur:
+                cur.itersize = self._itersize
+                await cur.execute(querystr, params)
+                if self._jsonb:
+                    async for (rawid, xorigin, xrel, xtarget, xattrs) in cur:
+                        curr_rel = (xorigin, xrel, xtarget, xattrs) if xattrs else (xorigin, xrel, xtarget)
+                        yield (rawid, curr_rel) if include_ids else curr_rel
+                    return
+                #The results will come back grouped by the raw relationship IDs, in order,
+                #with redundant origin/rel/target but the sequence of attributes
+                curr_id, curr_rel = None, None
+                async for (rawid, xorigin, xrel, xtarget, a_name, a_val) in cur:
+                    if rawid != curr_id:
+                        if curr_rel:
+                            yield (curr_id, curr_rel) if include_ids else curr_rel
+                        curr_id, curr_rel = rawid, (xorigin, xrel, xtarget)
+                    if a_name:
+                        if len(curr_rel) == 3:
+                            curr_rel = curr_rel + ({},)
+                        curr_rel[3][a_name] = a_val
+                if curr_rel:
+                    yield (curr_id, curr_rel) if include_ids else curr_rel
+        return
+
+    async def add(self, origin, rel, target, attrs=None, rid=None):
+        '''
+        Add one relationship to the extent
+
+        origin - origin of the relationship (similar to an RDF subject)
+        rel - type IRI of the relationship (similar to an RDF predicate)
+        target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
+        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
+        rid - optional ID for the relationship in IRI form
+
+        returns the raw (integer) ID of the resulting relationship
+        '''
+        rawids = await self.add_many([(origin, rel, target, attrs, rid)])
+        return rawids[0]
+
+    async def add_many(self, rels, batch_size=DEFAULT_BATCH_SIZE):
+        '''
+        Add a list of relationships to the extent
+
+        rels - a list of 0 or more relationship tuples, e.g.:
+        [
+            (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}, rid),
+        ]
+        batch_size - max number of relationships to load in each transaction
+
+        returns a list of raw (integer) IDs, one for each resulting relationship, in order
+
+        As with versa.driver.postgres, each batch is bulk loaded with COPY, and committed once
+        '''
+        rels = list(rels)
+        rawids = []
+        for start in range(0, len(rels), batch_size):
+            batch = rels[start:start + batch_size]
+            #Committed at the end of the block, or rolled back on error
+            async with self._pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(RESERVE_IDS_SQL, (len(batch),))
+                    batch_ids = [ row[0] for row in await cur.fetchall() ]
+                    rel_rows, attr_rows = _link_rows(batch_ids, batch, self._jsonb)
+                    copy_sql = COPY_RELATIONSHIP_JSONB_SQL if self._jsonb else COPY_RELATIONSHIP_SQL
+                    async with cur.copy(copy_sql) as copy:
+                        for row in rel_rows:
+                            await copy.write_row(row)
+                    if attr_rows:
+                        async with cur.copy(COPY_ATTRIBUTE_SQL) as copy:
+                            for row in attr_rows:
+                                await copy.write_row(row)
+            rawids.extend(batch_ids)
+        return rawids
+
+    async def close(self):
+        '''Close all pooled DB connections'''
+        await self._pool.close()
+        return
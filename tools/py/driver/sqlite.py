@@ -2,173 +2,243 @@
 '''
 
 [
-    (subj, pred, obj, {attrname1: attrval1, attrname2: attrval2}),
+    (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}),
 ]
 
 The optional attributes are metadata bound to the statement itself
 
-'''
+Needs nothing beyond the Python standard library. Links are rows of a
+relationship table, keyed by raw (integer) IDs, with attributes as rows of
+a separate attribute table. The relationship table has covering indexes
+for lookups from origin, rel & target. File DBs use WAL journaling,
+so readers don't block the writer.
 
-#Note: for PyPy support port to pg8000 <http://pybrary.net/pg8000/>
-#Reportedly PyPy/pg8000 is faster than CPython/psycopg2
+'''
 
 import logging
 import sqlite3
+from contextlib import contextmanager
 from itertools import groupby
 from operator import itemgetter
 
-from versa.driver import connection_base
+from versa.driver import connection_base, _patterns_by_shape
+
+#Max number of patterns in each match_many query, well within SQLite's limit on query parameters
+MAX_PATTERNS = 200
+
+
+def newmodel(connstr=':memory:', baseiri=None):
+    '''
+    Return a new, empty Versa model with SQLite back end
+    Warning: if there is data already in this DB, it will be erased.
+    '''
+    model = connection(baseiri=baseiri, connstr=connstr)
+    model.drop_space()
+    model.create_space()
+    return model
+
+
+def _match_many_query(shape, rows):
+    '''
+    Return the SQL & parameters to match a list of patterns, all with the given shape,
+    i.e. tuple of names of the relationship columns they specify
+
+    rows - list of (pattern index, value of 1st column in shape, ...) tuples
+    '''
+    #No casts: as in match(), values compare with their own storage classes, e.g. 5 but not '5' matches 5
+    placeholders = '(' + ', '.join(['?'] * (len(shape) + 1)) + ')'
+    conditions = ' AND '.join('relationship.{0} = pattern.{0}'.format(col) for col in shape)
+    querystr = '''\
+WITH pattern (ix, {0}) AS (VALUES {1})
+SELECT pattern.ix, relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value
+FROM pattern JOIN relationship ON {2} LEFT JOIN attribute ON relationship.rawid = attribute.rawid
+ORDER BY pattern.ix, relationship.rawid;'''.format(', '.join(shape), ', '.join([placeholders] * len(rows)), conditions)
+    return querystr, [ val for row in rows for val in row ]
+
 
 class connection(connection_base):
     def __init__(self, baseiri=None, connstr=':memory:', logger=None):
         '''
+        baseiri - optional base IRI for the model
+        connstr - SQLite DB file name, or ':memory:' for a private, in-memory DB
+        logger - optional logger for the generated SQL
+
+        The tables are set up if not already in the DB
         '''
-        self._conn = sqlite3.connect(connstr)
+        #Autocommit mode, so that write transactions can be managed explicitly
+        self._conn = sqlite3.connect(connstr, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL;')
+        #Safe with WAL, and avoids a sync on every commit
+        self._conn.execute('PRAGMA synchronous=NORMAL;')
+        self._conn.execute('PRAGMA foreign_keys=ON;')
         self._baseiri = baseiri
         self._logger = logger or logging
+        self.create_space()
         return
 
     def create_space(self):
         '''Set up a new table space for the first time'''
-        cur = self._conn.cursor()
-        cur.executescript(SQL_MODEL)
-        self._conn.commit()
-        cur.close()
+        self._conn.executescript(SQL_MODEL)
         return
 
     def drop_space(self):
         '''Dismantle an existing table space'''
-        cur = self._conn.cursor()
-        cur.executescript(DROP_SQL_MODEL)
-        self._conn.commit()
-        cur.close()
+        self._conn.executescript(DROP_SQL_MODEL)
         return
 
+    @contextmanager
+    def _write_transaction(self):
+        '''Run a block of writes in one transaction, committed at the end or rolled back on error'''
+        #IMMEDIATE takes the write lock up front, so raw IDs can safely be worked out in advance
+        self._conn.execute('BEGIN IMMEDIATE;')
+        try:
+            yield self._conn.cursor()
+            self._conn.execute('COMMIT;')
+        except BaseException:
+            self._conn.execute('ROLLBACK;')
+            raise
+
     def query(self, expr):
         '''Execute a Versa query'''
         raise NotImplementedError
 
+    def size(self):
+        '''Return the number of links in the model'''
+        return self._conn.execute('SELECT COUNT(*) FROM relationship;').fetchone()[0]
+
+    def __len__(self):
+        '''Return the number of links in the model'''
+        return self.size()
+
     def __iter__(self):
-        cur = self._conn.cursor()
-        querystr = u"""\
-SELECT relationship.rawid, relationship.subj, relationship.pred, relationship.obj, attribute.name, attribute.value
-FROM relationship LEFT JOIN attribute ON relationship.rawid = attribute.rawid
-WHERE {1}
-ORDER BY relationship.rawid;""".format(tables, conditions)
-        self._logger.debug(repr((querystr, params)))
-        cur.execute(querystr, params)
-        return self._process_db_rows_iter(cur)
+        return self.match(include_ids=True)
 
-    def match(self, subj=None, pred=None, obj=None, attrs=None):
+    def __getitem__(self, rawid):
+        '''Return the link with the given raw ID'''
+        for link in self._query('WHERE relationship.rawid = ?', [rawid]):
+            return link
+        raise IndexError(rawid)
+
+    def match(self, origin=None, rel=None, target=None, attrs=None, include_ids=False):
         '''
-        Retrieve an iterator of relationship IDs that match a pattern of components
+        Iterator over relationship IDs that match a pattern of components
 
-        subj - optional subject or origin of the relationship, an IRI coded as a unicode object. If omitted any subject will be matched.
-        pred - optional predicate or type of the relationship, an IRI coded as a unicode object. If omitted any predicate will be matched.
-        obj - optional object of the relationship, a boolean, floating point or unicode object. If omitted any object will be matched.
-        attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        origin - (optional) origin of the relationship (similar to an RDF subject). If omitted any origin will be matched.
+        rel - (optional) type IRI of the relationship (similar to an RDF predicate). If omitted any relationship will be matched.
+        target - (optional) target of the relationship (similar to an RDF object), a boolean, floating point or unicode object. If omitted any target will be matched.
+        attrs - (optional) attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}. If any attribute is specified, an exact match is made (i.e. the attribute name and value must match).
+        include_ids - If true include statement IDs (raw IDs) with yield values
 
+        Results are read from the DB lazily, so changes to the model while iterating
+        over them can show up in the results. Use e.g. list() first if making such changes
         '''
-        cur = self._conn.cursor()
-        conditions = u""
-        and_placeholder = u""
-        tables = u"relationship"
+        conditions = []
         params = []
-        if subj:
-            conditions += u"relationship.subj = ?"
-            params.append(subj)
-            and_placeholder = u" AND "
-        if obj:
-            conditions += and_placeholder + u"relationship.obj = ?"
-            params.append(obj)
-            and_placeholder = u" AND "
-        if pred:
-            conditions += and_placeholder + u"relationship.pred = ?"
-            params.append(pred)
-            and_placeholder = u" AND "
+        if origin:
+            conditions.append('relationship.origin = ?')
+            params.append(origin)
+        if rel:
+            conditions.append('relationship.rel = ?')
+            params.append(rel)
+        if target:
+            conditions.append('relationship.target = ?')
+            params.append(target)
         if attrs:
-            tables = u"relationship, attribute"
-            for a_name, a_val in attrs.iteritems():
-                conditions += and_placeholder + u"EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = ? AND subattr.value = ?)"
+            for a_name, a_val in attrs.items():
+                conditions.append('EXISTS (SELECT 1 FROM attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = ? AND subattr.value = ?)')
                 params.extend((a_name, a_val))
-                and_placeholder = u" AND "
-        #querystr = u"SELECT relationship.rawid, relationship.subj, relationship.pred, relationship.obj, attribute.name, attribute.value FROM {0} WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
-        #SELECT relationship.rawid, attribute.rawid, relationship.subj, relationship.pred, relationship.obj, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE relationship.subj = 'http://uche.ogbuji.net' AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@context' AND subattr.value = 'http://uche.ogbuji.net#_metadata') AND EXISTS (SELECT 1 from attribute AS subattr WHERE subattr.rawid = relationship.rawid AND subattr.name = '@lang' AND subattr.value = 'ig') ORDER BY relationship.rawid;
-        #querystr = u"SELECT relationship.rawid, relationship.subj, relationship.pred, relationship.obj, attribute.name, attribute.value FROM relationship FULL JOIN attribute ON relationship.rawid = attribute.rawid WHERE {1} ORDER BY relationship.rawid;".format(tables, conditions)
-        #Need to simulate a FULL OUTER JOIN
-        querystr = u"""\
-SELECT relationship.rawid, relationship.subj, relationship.pred, relationship.obj, attribute.name, attribute.value
-FROM relationship LEFT JOIN attribute ON relationship.rawid = attribute.rawid
-UNION ALL
-SELECT relationship.rawid, relationship.subj, relationship.pred, relationship.obj, attribute.name, attribute.value
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+        return self._query(where, params, include_ids)
+
+    def match_many(self, patterns, include_ids=False):
+        '''
+        Retrieve the relationships matching each of a list of patterns (see connection_base.match_many)
+
+        Patterns specifying the same components, e.g. all (origin, rel, None), are
+        matched together, by joining a VALUES table of them with the relationship table,
+        so the indexes are still used. All in one read transaction
+        '''
+        results = [ [] for p in patterns ]
+        by_shape = _patterns_by_shape(patterns)
+        self._conn.execute('BEGIN;')
+        try:
+            for shape, rows in by_shape.items():
+                if not shape:
+                    #Nothing to join on
+                    for (ix,) in rows:
+                        results[ix] = list(self.match(include_ids=include_ids))
+                    continue
+                for start in range(0, len(rows), MAX_PATTERNS):
+                    chunk = rows[start:start + MAX_PATTERNS]
+                    querystr, params = _match_many_query(shape, chunk)
+                    self._logger.debug(repr((querystr, params)))
+                    cur = self._conn.execute(querystr, params)
+                    for ix, ixrows in groupby(cur, itemgetter(0)):
+                        results[ix] = list(self._process_db_rows_iter((row[1:] for row in ixrows), include_ids))
+                    cur.close()
+        finally:
+            self._conn.execute('COMMIT;')
+        return results
+
+    def _query(self, where, params, include_ids=False):
+        '''
+        Run the standard query join, with the given WHERE clause, yielding the
+        resulting statements iteratively
+        '''
+        querystr = '''\
+SELECT relationship.rawid, relationship.origin, relationship.rel, relationship.target, attribute.name, attribute.value
 FROM relationship LEFT JOIN attribute ON relationship.rawid = attribute.rawid
-WHERE {1}
-ORDER BY relationship.rawid;""".format(tables, conditions)
-        #self._logger.debug(x.format(url))
+{0}
+ORDER BY relationship.rawid;'''.format(where)
         self._logger.debug(repr((querystr, params)))
-        cur.execute(querystr, params)
-        #Use groupby to batch up the returning statements acording to rawid then rol up the attributes
-        #return ( (s, p, o, dict([(n,v) for n,v in xxx])) for s, p, o in yyy)
-        #cur.fetchone()
-        #cur.close()
-        return self._process_db_rows_iter(cur)
+        cur = self._conn.execute(querystr, params)
+        try:
+            #Use groupby to batch up the returning rows acording to rawid then roll up the attributes
+            yield from self._process_db_rows_iter(cur, include_ids)
+        finally:
+            cur.close()
+        return
 
-    def _process_db_rows_iter(self, cursor):
+    def _process_db_rows_iter(self, cursor, include_ids=False):
         '''
         Turn the low-level rows from the result of a standard query join
-        into higher-level statements, yielded iteratively. Note this might lead to
-        idle transaction errors?
-
+        into higher-level statements, yielded iteratively
         '''
-        #Be aware of: http://packages.python.org/psycopg2/faq.html#problems-with-transactions-handling
         #The results will come back grouped by the raw relationship IDs, in order
         for relid, relgroup in groupby(cursor, itemgetter(0)):
-            rel = None
-            attrs = None
+            attrs = {}
             #Each relgroup are the DB rows corresponding to a single relationship,
-            #With redundant subject/predicate/object but the sequence of attributes
-            for row in relgroup:
-                (rawid, subj, pred, obj, a_name, a_val) = row
-                #self._logger.debug('Row: {0}'.format(repr(row)))
-                if not rel: rel = (subj, pred, obj)
-                if a_name:
-                    if not attrs:
-                        attrs = {}
-                        rel = (subj, pred, obj, attrs)
+            #With redundant origin/rel/target but the sequence of attributes
+            for (rawid, origin, rel, target, a_name, a_val) in relgroup:
+                if a_name is not None:
                     attrs[a_name] = a_val
-            yield rel
-        cursor.close()
-        self._conn.rollback() #Finish with the transaction
+            curr_rel = (origin, rel, target, attrs)
+            yield (relid, curr_rel) if include_ids else curr_rel
         return
 
-    def add(self, subj, pred, obj, attrs=None, rid=None):
+    def add(self, origin, rel, target, attrs=None, rid=None):
         '''
         Add one relationship to the extent
 
-        subj - subject or origin of the relationship, an IRI coded as a unicode object
-        pred - predicate or type of the relationship, an IRI coded as a unicode object
-        obj - object of the relationship, a boolean, floating point or unicode object
+        origin - origin of the relationship (similar to an RDF subject)
+        rel - type IRI of the relationship (similar to an RDF predicate)
+        target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
-        rid - optional ID for the relationship in IRI form. If not specified one will be generated.
-
-        returns an ID (IRI) for the resulting relationship
-        '''
-        cur = self._conn.cursor()
-        #relationship.
-        if rid:
-            querystr = u"INSERT INTO relationship (subj, pred, obj, rid) VALUES (?, ?, ?, ?);"
-            cur.execute(querystr, (subj, pred, obj, rid))
-        else:
-            querystr = u"INSERT INTO relationship (subj, pred, obj) VALUES (?, ?, ?);"
-            cur.execute(querystr, (subj, pred, obj))
-        rawid = cur.lastrowid
-        for a_name, a_val in attrs.iteritems():
-            querystr = u"INSERT INTO attribute (rawid, name, value) VALUES (?, ?, ?);"
-            cur.execute(querystr, (rawid, a_name, a_val))
-        self._conn.commit()
-        cur.close()
-        return
+        rid - optional ID for the relationship in IRI form
 
+        returns the raw (integer) ID of the resulting relationship
+        '''
+        if not origin:
+            raise ValueError('Relationship origin cannot be null')
+        if not rel:
+            raise ValueError('Relationship ID cannot be null')
+        attrs = attrs or {}
+        with self._write_transaction() as cur:
+            cur.execute('INSERT INTO relationship (id, origin, rel, target) VALUES (?, ?, ?, ?);', (rid, origin, rel, target))
+            rawid = cur.lastrowid
+            cur.executemany('INSERT INTO attribute (rawid, name, value) VALUES (?, ?, ?);',
+                ((rawid, a_name, a_val) for a_name, a_val in attrs.items()))
+        return rawid
 
     def add_many(self, rels):
         '''
@@ -176,30 +246,65 @@ ORDER BY relationship.rawid;""".format(tables, conditions)
 
         rels - a list of 0 or more relationship tuples, e.g.:
         [
-            (subj, pred, obj, {attrname1: attrval1, attrname2: attrval2}, rid),
+            (origin, rel, target, {attrname1: attrval1, attrname2: attrval2}, rid),
         ]
 
-        subj - subject or origin of the relationship, an an IRI coded as a unicode object
-        pred - predicate or type of the relationship, an an IRI coded as a unicode object
-        obj - object of the relationship, a boolean, floating point or unicode object
+        origin - origin of the relationship (similar to an RDF subject)
+        rel - type IRI of the relationship (similar to an RDF predicate)
+        target - target of the relationship (similar to an RDF object), a boolean, floating point or unicode object
         attrs - optional attribute mapping of relationship metadata, i.e. {attrname1: attrval1, attrname2: attrval2}
-        rid - optional ID for the relationship in IRI form.  If not specified for any relationship, one will be generated.
+        rid - optional ID for the relationship in IRI form
 
         you can omit the dictionary of attributes if there are none, as long as you are not specifying a statement ID
 
-        returns a list of IDs (IRI), one for each resulting relationship, in order
-        '''
-        raise NotImplementedError
+        returns a list of raw (integer) IDs, one for each resulting relationship, in order
 
-    def delete(rids):
+        All in one transaction, with relationships & attributes each inserted with
+        executemany. Raw IDs are assigned up front so attributes can refer to them.
+        '''
+        rawids = []
+        attr_rows = []
+        with self._write_transaction() as cur:
+            #Respect AUTOINCREMENT, i.e. never reuse IDs of removed relationships
+            cur.execute("SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'relationship'), 0), COALESCE((SELECT MAX(rawid) FROM relationship), 0));")
+            next_id = cur.fetchone()[0] + 1
+
+            def rel_rows():
+                for rawid, curr_rel in enumerate(rels, start=next_id):
+                    attrs, rid = None, None
+                    if len(curr_rel) == 3:
+                        origin, rel, target = curr_rel
+                    elif len(curr_rel) == 4:
+                        origin, rel, target, attrs = curr_rel
+                    elif len(curr_rel) == 5:
+                        origin, rel, target, attrs, rid = curr_rel
+                    else:
+                        raise ValueError
+                    if not origin:
+                        raise ValueError('Relationship origin cannot be null')
+                    if not rel:
+                        raise ValueError('Relationship ID cannot be null')
+                    rawids.append(rawid)
+                    attr_rows.extend((rawid, a_name, a_val) for a_name, a_val in (attrs or {}).items())
+                    yield (rawid, rid, origin, rel, target)
+
+            cur.executemany('INSERT INTO relationship (rawid, id, origin, rel, target) VALUES (?, ?, ?, ?, ?);', rel_rows())
+            cur.executemany('INSERT INTO attribute (rawid, name, value) VALUES (?, ?, ?);', attr_rows)
+        return rawids
+
+    def remove(self, rids):
         '''
-        Delete one or more relationship, by ID, from the extent
+        Delete one or more relationship, by raw ID, from the extent
 
         rids - either a single ID or an sequence or iterator of IDs
         '''
-        raise NotImplementedError
+        rids = [rids] if isinstance(rids, int) else list(rids)
+        with self._write_transaction() as cur:
+            cur.executemany('DELETE FROM attribute WHERE rawid = ?;', ((rawid,) for rawid in rids))
+            cur.executemany('DELETE FROM relationship WHERE rawid = ?;', ((rawid,) for rawid in rids))
+        return
 
-    def add_iri_prefix(prefix):
+    def add_iri_prefix(self, prefix):
         '''
         Add an IRI prefix, for efficiency of table scan searches
 
@@ -208,48 +313,51 @@ ORDER BY relationship.rawid;""".format(tables, conditions)
         raise NotImplementedError
 
     def close(self):
-        '''Set up a new table space for the first time'''
+        '''Close the DB connection'''
         self._conn.close()
         return
 
 
+#target & value have no declared type, so they keep the type they were given
 SQL_MODEL = '''
-CREATE TABLE relationship (
+CREATE TABLE IF NOT EXISTS relationship (
     rawid    INTEGER PRIMARY KEY AUTOINCREMENT,  -- a low level, internal ID purely for effieicnt referential integrity
     id       TEXT UNIQUE,         --The higher level relationship ID
-    subj     TEXT NOT NULL,
-    pred     TEXT NOT NULL,
-    obj      TEXT NOT NULL
+    origin   TEXT NOT NULL,
+    rel      TEXT NOT NULL,
+    target   NOT NULL
 );
 
-CREATE TABLE attribute (
-    rawid    INTEGER REFERENCES relationship (rawid),
-    name     TEXT,
-    value    TEXT
+CREATE TABLE IF NOT EXISTS attribute (
+    rawid    INTEGER NOT NULL REFERENCES relationship (rawid),
+    name     TEXT NOT NULL,
+    value
 );
 
-CREATE INDEX main_relationship_index ON relationship (subj, pred);
+-- Covering indexes, so lookups from any component needn't visit the table itself
+CREATE INDEX IF NOT EXISTS origin_rel_index ON relationship (origin, rel, target);
+
+CREATE INDEX IF NOT EXISTS rel_target_index ON relationship (rel, target, origin);
+
+CREATE INDEX IF NOT EXISTS target_index ON relationship (target, origin, rel);
 
-CREATE INDEX main_attribute_index ON attribute (name, value);
+CREATE INDEX IF NOT EXISTS attribute_rawid_index ON attribute (rawid, name, value);
+
+CREATE INDEX IF NOT EXISTS attribute_index ON attribute (name, value);
 '''
 
 DROP_SQL_MODEL = '''
-DROP INDEX main_relationship_index;
-
-DROP INDEX main_attribute_index;
+DROP INDEX IF EXISTS origin_rel_index;
 
-DROP TABLE attribute;
+DROP INDEX IF EXISTS rel_target_index;
 
-DROP TABLE relationship;
-'''
+DROP INDEX IF EXISTS target_index;
 
-#Some notes on arrays:
-# * http://fossplanet.com/f15/%5Bgeneral%5D-general-postgres-performance-tips-when-using-array-169307/
+DROP INDEX IF EXISTS attribute_rawid_index;
 
-"""
->>> import psycopg2
->>> conn = psycopg2.connect("dbname=test user=postgres password=PeeeGeee")
-"""
+DROP INDEX IF EXISTS attribute_index;
 
-#cur.execute("CREATE TABLE test (id serial PRIMARY KEY, num integer, data varchar);")
+DROP TABLE IF EXISTS attribute;
 
+DROP TABLE IF EXISTS relationship;
+'''
@@ -18,10 +18,13 @@ using patterns and declared rules.
 
 import json
 import itertools
+import multiprocessing
+import concurrent.futures
 # import functools
 from operator import itemgetter
 # from enum import Enum #https://docs.python.org/3.4/library/enum.html
 from collections import defaultdict, OrderedDict
+from collections.abc import Mapping
 from types import GeneratorType
 
 from amara3 import iri
@@ -30,6 +33,7 @@ from versa import I, VERSA_BASEIRI, ORIGIN, RELATIONSHIP, TARGET, ATTRIBUTES, VT
 from versa.terms import VFPRINT_REL
 from versa import util
 from versa.util import simple_lookup, OrderedJsonEncoder
+from versa.driver import memory
 from versa.driver.memory import newmodel
 
 from versa.contrib.datachefids import idgen as default_idgen, FROM_EMPTY_64BIT_HASH
@@ -39,7 +43,7 @@ from versa.contrib.datachefids import idgen as default_idgen, FROM_EMPTY_64BIT_H
 __all__ = [
     'context', 'DUMMY_CONTEXT', 'resource_id', 'materialize_entity',
     'is_pipeline_action', 'create_resource', 'stage',
-    'definition', 'generic_pipeline',
+    'definition', 'generic_pipeline', 'compile_rel_rules',
     # Upstream objects included to reduce imports needed by users
     'I', 'VERSA_BASEIRI', 'ORIGIN', 'RELATIONSHIP', 'TARGET', 'ATTRIBUTES',
     'VTYPE_REL', 'VLABEL_REL'
@@ -229,6 +233,102 @@ def make_list(lvalue, *items):
     return new_lvalue
 
 
+def compile_rel_rules(rules):
+    '''
+    Compile a transform rules mapping, as for transform_by_rel_helper, into a dispatch
+    table keyed by relationship, so each input link needs just one lookup
+
+    rules - mapping from rule spec to rule, where the spec is either a relationship,
+        applied for main output resources, or a tuple (rel, T1, T2...), applied for any
+        output resource (main or other) with one of the types T1, T2...
+
+    returns mapping from relationship to a tuple of the rule for the scalar spec
+    (or None) & a list of (frozenset of types, rule) for the tuple specs
+    '''
+    dispatch = {}
+    for rspec, rule in rules.items():
+        if isinstance(rspec, tuple):
+            rel, *typs = rspec
+            scalar_rule, typed_rules = dispatch.setdefault(rel, (None, []))
+            typed_rules.append((frozenset(typs), rule))
+        else:
+            scalar_rule, typed_rules = dispatch.get(rspec, (None, []))
+            dispatch[rspec] = (rule, typed_rules)
+    return dispatch
+
+
+class resource_map(Mapping):
+    '''
+    Read-only mapping from each fingerprinted input resource to a list of its main output
+    resources, as rules see it in ctx.extras['@resource']. A live view of the pipeline's
+    fingerprints, so it's created once, rather than copying them for each rule run.
+    Each lookup returns a new list, so rules are free to modify it
+    '''
+    def __init__(self, fingerprints):
+        self._fingerprints = fingerprints
+
+    def __getitem__(self, rid):
+        mains, others = self._fingerprints[rid]
+        return list(mains)
+
+    def __iter__(self):
+        return iter(self._fingerprints)
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+
+# The parallel transform job, in a worker process only. Set up by _init_shard_worker
+_shard_job = None
+
+
+def _init_shard_worker(job):
+    '''
+    Process pool initializer for definition.parallel_transform_by_rel. Workers are forked,
+    so the job (pipeline, rules, shards, root context...) is inherited rather than pickled,
+    which rules generally can't be
+    '''
+    global _shard_job
+    _shard_job = job
+
+
+def _transform_shard(index):
+    '''
+    Process pool worker for definition.transform_by_rel_helper. Runs the transform for one
+    shard of the fingerprints into a local output model, seeded with the types of
+    the shard's output resources, so that (rel, T1, T2...) rules can match
+
+    returns applied rules count, list of added links (all links in the local model
+    at the end, other than the seeded type links), list of misses, new existing IDs
+    & new '@added-links' hashes (the latter if the root context tracks them)
+    '''
+    ppl, rules, shards, root_context, collect_misses, output_snapshot, existing_ids, added_links = _shard_job
+    shard = shards[index]
+    local_model = newmodel()
+    seeded = set()
+    for mains, others in shard.values():
+        for out_rid in itertools.chain(mains, others):
+            for typ in util.resourcetypes(output_snapshot, out_rid):
+                local_model.add(out_rid, VTYPE_REL, typ)
+                seeded.add((out_rid, VTYPE_REL, typ))
+    ppl.output_model = local_model
+    # Start from the state as of the fork, whatever shards this worker already ran
+    root_context.existing_ids.clear()
+    root_context.existing_ids.update(existing_ids)
+    if '@added-links' in root_context.extras:
+        root_context.extras['@added-links'].clear()
+        root_context.extras['@added-links'].update(added_links)
+    misses = []
+    count = ppl.transform_by_rel_helper(rules, origins=shard,
+                handle_misses=misses.append if collect_misses else None,
+                root_context=root_context, workers=1)
+    # By value rather than position, in case rules removed links or compacted the model
+    new_links = [ link for (_, link) in local_model
+                    if link[ATTRIBUTES] or (link[ORIGIN], link[RELATIONSHIP], link[TARGET]) not in seeded ]
+    new_added_links = set(root_context.extras.get('@added-links', ())) - added_links
+    return count, new_links, misses, root_context.existing_ids - existing_ids, new_added_links
+
+
 class definition:
     '''
     Definition of a pipeline for transforming one Versa model to another
@@ -239,6 +339,7 @@ class definition:
     def __init__(self):
         self._stages = []
         self._stages_hash = None
+        self.workers = None
 
     def check_update_stages(self):
         stage_func_names = [ k for k in dir(self) if hasattr(getattr(self, k), 'pipeline_sort_key') ]
@@ -251,7 +352,7 @@ class definition:
             self._stages_hash = hash(tuple(stage_func_names))
         return
 
-    def run(self, input_model=None, raw_source=None, output_model=None, **kwargs):
+    def run(self, input_model=None, raw_source=None, output_model=None, workers=None, **kwargs):
         '''
         Process an input, either an input Versa model or in some raw record format
         through a sequence of transform stages, to generate a versa model of output resources
@@ -265,6 +366,10 @@ class definition:
                 represent as a Versa model, but can be interpreted by the stages as if it were
             output_model: optional output model, which might be provided to add transform results
                 to existing data, or to use a specialized Versa model implementation
+            workers: optional number of worker processes for the helpers which can run in parallel
+                (see transform_by_rel_helper). By default everything runs in this process.
+                Only for rules which don't rely on the output model or on state of their own,
+                as explained in parallel_transform_by_rel
             kwargs: any additional parameters which are passed as they are to all the stages
 
         Returns:
@@ -278,6 +383,7 @@ class definition:
 
         self._raw_source = raw_source
         self.fingerprints = {}
+        self.workers = workers
 
         # First tuple item is just sortkey, so discarded 
         for _, stage in self._stages:
@@ -287,6 +393,76 @@ class definition:
                 break
         return self.output_model
 
+    def run_iter(self, input_models, dedupe_shared=False, **kwargs):
+        '''
+        Process a stream of input models, e.g. one per record from versa.serial.csv.parse_iter,
+        running all the stages on each in turn, into its own new memory output model. Only one
+        record's input & output are held in memory at a time. If an output_model is passed on
+        to run() all the records go into that one instead, and it's yielded after each.
+
+        Resources materialized by the transform rules (i.e. other than the record's
+        fingerprinted resources), such as a Person shared by many records, are output
+        again with each record which has them, with that record's links from them.
+        A sink which refuses duplicate links, e.g. a memory model, ends up with the
+        same links as a single run of all the records.
+
+        Args:
+            input_models: iterable of Versa models, usually one per input record. Empty ones are skipped
+            dedupe_shared: if True, materialized resources are only described by the first record
+                to output them. Links from them in later records are dropped, much as materialize
+                does with the existing IDs of a single run, so each is e.g. serialized once.
+                Only for rules which don't attach record-specific links to shared resources,
+                and it means keeping the IDs of all output resources so far. The links are
+                removed from each record's own memory model, so it can't be combined with
+                an output_model, which raises ValueError
+            kwargs: any additional parameters which are passed as they are to run()
+
+        Yields:
+            output_model: new model with the results of the transform for each record
+        '''
+        if dedupe_shared and kwargs.get('output_model') is not None:
+            raise ValueError('dedupe_shared needs a new output model for each record, so no output_model')
+        output_ids = set()
+        for input_model in input_models:
+            if not input_model:
+                continue
+            output_model = self.run(input_model=input_model, **kwargs)
+            if dedupe_shared:
+                fingerprinted = set()
+                for mains, others in self.fingerprints.values():
+                    fingerprinted.update(mains)
+                    fingerprinted.update(others)
+                stale = [ ix for ix, link in output_model.match(include_ids=True)
+                            if link[ORIGIN] in output_ids and link[ORIGIN] not in fingerprinted ]
+                if stale:
+                    output_model.remove(stale)
+                output_ids.update(rid for rid, types in util.resourcetypes_index(output_model).items() if types)
+            yield output_model
+
+    def run_stream(self, input_models, sink, dedupe_shared=False, **kwargs):
+        '''
+        Process a stream of input models as run_iter, flushing the output for each record
+        to a sink as soon as its stages are done
+
+        Args:
+            input_models: iterable of Versa models, usually one per input record
+            sink: a Versa model, to which each record's output links are added, or a callable
+                which is passed each record's output model, e.g. a serializer such as
+                functools.partial(literate.write, out=fp)
+            dedupe_shared: if True, only output each materialized resource with the first record
+                which has it (see run_iter)
+            kwargs: any additional parameters which are passed as they are to run()
+
+        Returns:
+            count: number of records processed
+        '''
+        flush = sink if callable(sink) else lambda model: sink.add_many(list(model.match()))
+        count = 0
+        for output_model in self.run_iter(input_models, dedupe_shared=dedupe_shared, **kwargs):
+            flush(output_model)
+            count += 1
+        return count
+
     def fingerprint_helper(self, rules, root_context=DUMMY_CONTEXT):
         '''
         Implements a common fingerprinting strategy where the input model
@@ -297,9 +473,9 @@ class definition:
         # All output resources, whether or not from a direct fingerprint of an input resource
         new_rids = set()
 
-        resources = list(util.all_origins(self.input_model))
-        for rid in resources:
-            for typ in util.resourcetypes(self.input_model, rid):
+        # Types of all input resources, from one pass over the input model
+        for rid, types in util.resourcetypes_index(self.input_model).items():
+            for typ in types:
                 if typ in rules:
                     rule_tup = rules[typ]
                     rule_tup = (rule_tup
@@ -337,17 +513,36 @@ class definition:
         return new_rids
 
     def transform_by_rel_helper(self, rules, origins=None, handle_misses=None,
-                                    root_context=DUMMY_CONTEXT):
+                                    root_context=DUMMY_CONTEXT, workers=None):
         '''
         Implements a common transform strategy where each fingerprinted
         input model resource is examined for outbound links, and each one matched
         by relationship to the passed-in rules. If matched the corresponding action
         is run to update the output model
+
+        Rules can look up the main output resources of any fingerprinted input resource
+        in ctx.extras['@resource']. It's a read-only resource_map (a collections.abc.Mapping,
+        not a dict) shared by all the rule runs, so it supports lookups, in, get, keys,
+        items & the like, but not assignment. Use dict(ctx.extras['@resource']) for a
+        mutable copy
+
+        workers - number of processes over which to spread the input resources.
+            Defaults to the workers given to run(). Ignored unless the output model is
+            an ordinary memory model. See parallel_transform_by_rel
         '''
         origins = origins or self.fingerprints
+        # Pipelines whose __init__ doesn't call this class's have no workers attribute
+        workers = workers or getattr(self, 'workers', None)
+        if workers and workers > 1 and len(origins) > 1 \
+                and type(self.output_model) is memory.connection \
+                and 'fork' in multiprocessing.get_all_start_methods():
+            return self.parallel_transform_by_rel(rules, origins, handle_misses, root_context, workers)
         # Really just for lightweight sanity checks
         applied_rules_count = 0
         types_cache = {}
+        # Input resource to main output resources, for rules to look up
+        resources = resource_map(self.fingerprints)
+        dispatch = compile_rel_rules(rules)
         for rid in origins:
             (mains, others) = origins[rid]
             # import pprint; pprint.pprint([mains, others])
@@ -361,21 +556,19 @@ class definition:
 
                 # Collect node/match pairs
                 match_sets = set()
+                scalar_rule, typed_rules = dispatch.get(r, (None, ()))
                 for out_rid in itertools.chain(mains, others):
-                    for (rspec, rule) in rules.items():
-                        if (out_rid in mains) and rspec == r:
-                            match_sets.add((rule, out_rid))
-                        elif rspec[0] == r:
-                            if out_rid in types_cache:
-                                out_rid_types = types_cache[out_rid]
-                            else:
-                                out_rid_types = frozenset(util.resourcetypes(self.output_model, out_rid))
-                                types_cache[out_rid] = out_rid_types
-                            _, *typs = rspec
-                            for typ in typs:
-                                if typ in out_rid_types:
-                                    match_sets.add((rule, out_rid))
-                                    break
+                    if scalar_rule is not None and out_rid in mains:
+                        match_sets.add((scalar_rule, out_rid))
+                    if typed_rules:
+                        if out_rid in types_cache:
+                            out_rid_types = types_cache[out_rid]
+                        else:
+                            out_rid_types = frozenset(util.resourcetypes(self.output_model, out_rid))
+                            types_cache[out_rid] = out_rid_types
+                        for typs, rule in typed_rules:
+                            if not typs.isdisjoint(out_rid_types):
+                                match_sets.add((rule, out_rid))
 
                 # If nothing matched, trigger caller's miss handler, if any
                 if not match_sets:
@@ -392,7 +585,7 @@ class definition:
                     variables = root_context.variables.copy()
                     variables.update({'input-resource': rid})
                     extras = root_context.extras.copy()
-                    extras.update({'@resource': { k: list(m) for (k, (m, o)) in self.fingerprints.items() }})
+                    extras['@resource'] = resources
                     ctx = root_context.copy(current_link=link, input_model=self.input_model,
                                                 output_model=self.output_model, variables=variables,
                                                 extras=extras)
@@ -401,6 +594,57 @@ class definition:
                     applied_rules_count += 1
         return applied_rules_count
 
+    def parallel_transform_by_rel(self, rules, origins, handle_misses, root_context, workers):
+        '''
+        Runs transform_by_rel_helper across a pool of worker processes. The input resources
+        are split, in order, into contiguous shards, and each worker transforms a shard into
+        its own output model. The resulting links are then added to the output model shard
+        by shard, so the output is the same from run to run.
+
+        Workers are forked, inheriting the pipeline & rules, which only works where the fork
+        start method is available (e.g. not on Windows), and the output model has to be an
+        ordinary memory model, whose snapshot the workers read, since DB handles can't be
+        shared across fork(). Forking is also best done before starting any threads.
+
+        Rules don't see what they would in a serial run, so this is only for rule sets which
+        work regardless, such as the stock actions:
+
+        * ctx.output_model only has the types of the shard's output resources, plus the links
+          added by the shard, so rules shouldn't read other links from it
+        * Changes rules make to their own state, e.g. in closures or ctx.extras, are lost
+          with the worker, except for ctx.extras['@added-links'] & ctx.existing_ids
+        * Miss handlers are called in this process, after all the shards are done
+        * Only links added by rules are carried back, not any they remove
+
+        If a resource is materialized in more than one shard, links from it after
+        the first shard are dropped, as the existing IDs check would in a serial run
+        '''
+        rids = list(origins)
+        # Several shards per worker, to even out the load
+        shard_size = -(-len(rids) // (workers * 4))
+        shards = [ { rid: origins[rid] for rid in rids[start:start + shard_size] }
+                    for start in range(0, len(rids), shard_size) ]
+
+        # Workers run more than one shard, so they need the state as of now to reset to
+        job = (self, rules, shards, root_context, handle_misses is not None, self.output_model.snapshot(),
+                set(root_context.existing_ids), set(root_context.extras.get('@added-links', ())))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=_init_shard_worker, initargs=(job,)) as executor:
+            results = list(executor.map(_transform_shard, range(len(shards))))
+
+        applied_rules_count = 0
+        for count, new_links, misses, new_ids, new_added_links in results:
+            dupe_ids = new_ids & root_context.existing_ids
+            self.output_model.add_many([ link for link in new_links if link[ORIGIN] not in dupe_ids ])
+            root_context.existing_ids.update(new_ids)
+            if new_added_links:
+                root_context.extras['@added-links'].update(new_added_links)
+            for miss in misses:
+                handle_misses(miss)
+            applied_rules_count += count
+        return applied_rules_count
+
     def labelize_helper(self, rules, label_rel=VLABEL_REL, origins=None,
                             handle_misses=None, root_context=DUMMY_CONTEXT):
         '''
@@ -411,8 +655,8 @@ class definition:
         new_labels = {}
         # Anything with a Versa type is an output resource
         # FIXME weid, redundant logic
-        for out_rid in util.all_origins(self.output_model, of_types='*'):
-            for typ in util.resourcetypes(self.output_model, out_rid):
+        for out_rid, types in util.resourcetypes_index(self.output_model).items():
+            for typ in types:
                 if typ in rules:
                     rule = rules[typ]
                     link = (out_rid, VTYPE_REL, typ, {})
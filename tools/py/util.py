@@ -10,6 +10,7 @@ import re
 import sys
 import json
 from collections import OrderedDict
+from itertools import islice
 
 from amara3 import iri
 
@@ -53,6 +54,10 @@ def transitive_closure(m, orig, rel):
         yield from transitive_closure(m, target, rel)
 
 
+#Number of origins all_origins looks up the types of in each match_many call
+ALL_ORIGINS_BATCH_SIZE = 1000
+
+
 def all_origins(m, of_types=None, only_types=None):
     '''
     Generate all unique statement origins in the given model
@@ -63,14 +68,22 @@ def all_origins(m, of_types=None, only_types=None):
     if isinstance(of_types, I): of_types = {of_types}
     of_types = set(of_types) if of_types else set()
     if '*' in of_types: of_types = {'*'}
-    for link in m.match():
-        origin = link[ORIGIN]
-        if origin not in seen:
-            seen.add(origin)
-            if not of_types:
+    if not of_types:
+        for link in m.match():
+            origin = link[ORIGIN]
+            if origin not in seen:
+                seen.add(origin)
                 yield origin
-                continue
-            otypes = set(resourcetypes(m, origin))
+        return
+    origins = column(m, ORIGIN)
+    # Look up the types of the origins a batch at a time, so results still start coming right away
+    while True:
+        batch = list(islice(origins, ALL_ORIGINS_BATCH_SIZE))
+        if not batch:
+            break
+        typelinks = m.match_many([ (origin, VTYPE_REL) for origin in batch ])
+        for origin, links in zip(batch, typelinks):
+            otypes = set(link[TARGET] for link in links)
             if ('*' in of_types and otypes) or (of_types & otypes):
                 yield origin
 
@@ -96,6 +109,20 @@ def resourcetypes(m, rid):
         yield t
 
 
+def resourcetypes_index(m):
+    '''
+    Create a mapping from each origin in the model to a list of its Versa types,
+    in one pass over the links, rather than a match per origin as with resourcetypes.
+    Origins are in order of first appearance, and origins without types map to an empty list
+    '''
+    index = {}
+    for link in m.match():
+        types = index.setdefault(link[ORIGIN], [])
+        if link[RELATIONSHIP] == VTYPE_REL:
+            types.append(link[TARGET])
+    return index
+
+
 def labels(m, rid):
     '''
     Yield a list of Versa labels for a resource
@@ -182,12 +209,14 @@ def replace_entity_resource(model, oldres, newres):
     :return: None
     '''
     oldrids = set()
-    for rid, link in model:
-        if link[ORIGIN] == oldres or link[TARGET] == oldres or oldres in link[ATTRIBUTES].values():
+    new_links = []
+    for rid, (o, r, t, a) in model:
+        if o == oldres or t == oldres or oldres in a.values():
             oldrids.add(rid)
-            new_link = (newres if o == oldres else o, r, newres if t == oldres else t, dict((k, newres if v == oldres else v) for k, v in a.items()))
-            model.add(*new_link)
-    model.delete(oldrids)
+            new_links.append((newres if o == oldres else o, r, newres if t == oldres else t, dict((k, newres if v == oldres else v) for k, v in a.items())))
+    # Remove first, so replacements identical to removed links aren't refused as dupes
+    model.remove(oldrids)
+    model.add_many(new_links)
     return
 
 